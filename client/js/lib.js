@@ -135,10 +135,16 @@ function scheduleMessage(sessionid) {
         })
     }
 }
-// Get all messages and add them as msg cards
-function getMessages(sessionId) {
+// Number of messages to request per page
+const messagePageSize = 25
+// Get messages a page at a time and add them as msg cards
+function getMessages(sessionId, cursor) {
     tz = Intl.DateTimeFormat().resolvedOptions().timeZone
-    fetch(baseApiUrl + 'messages?session=' + sessionId + '&timezone=' + tz, {
+    let url = baseApiUrl + 'messages?session=' + sessionId + '&timezone=' + tz + '&limit=' + messagePageSize
+    if (cursor) {
+        url = url + '&cursor=' + encodeURIComponent(cursor)
+    }
+    fetch(url, {
         method: 'GET',
         headers: {
             'Content-Type': 'application/json'
@@ -149,22 +155,26 @@ function getMessages(sessionId) {
     .then(data => {
         if (data.success) {
             loaderHidden(true)
-            clearMsgCards()
-            addMsgCards(sessionId, data.results)
+            if (!cursor) { clearMsgCards() }
+            addMsgCards(sessionId, data.results, data.timezone)
+            // Keep fetching until the last page
+            if (data.cursor) { getMessages(sessionId, data.cursor) }
         }
     })
 }
-// Get all messages and add them as cards on messages page
-function addMsgCards(sessionId, data) {
+// Add messages as cards on messages page, after any already shown. Times
+// are local when the server converted them to timezone, UTC otherwise.
+function addMsgCards(sessionId, data, timezone) {
     let msgRow = document.getElementById('msgRow')
     let msgCard = document.getElementById('msgCard')
+    let offset = msgRow.children.length
     for (let i = 0; i < data.length; i++) {
-        msg = data[i]
+        let msg = data[i]
         let cln = msgCard.cloneNode(true)
         msgRow.appendChild(cln)
-        cln.id = 'msgCard' + i
+        cln.id = 'msgCard' + (offset + i)
         cln.querySelector('#msgCardEmail').innerText = msg.person
-        cln.querySelector('#msgCardTime').innerText = UtcToLocalDatetimeString(msg.time)
+        cln.querySelector('#msgCardTime').innerText = timezone ? localDatetimeString(msg.time) : UtcToLocalDatetimeString(msg.time)
         cln.querySelector('#msgCardText').innerText = msg.msg
         cln.querySelector('#msgCardDelete').addEventListener('click',
             function() {
@@ -179,6 +189,10 @@ function UtcToLocalDatetimeString(dt) {
     dt = dt + 'Z'
     return new Date(dt).toLocaleString()
 }
+// Local ISO datetime into local string format
+function localDatetimeString(dt) {
+    return new Date(dt).toLocaleString()
+}
 // Delete all message cards on messages page
 function clearMsgCards() {
     let msgRow = document.getElementById('msgRow')
@@ -6,5 +6,5 @@ cd packages
 zip -r ../deployment-package.zip *
 cd ../
 zip -r ./deployment-package.zip models
-zip -g ./deployment-package.zip lambda_function.py
+zip -g ./deployment-package.zip lambda_function.py dispatch.py scheduler.py
 aws lambda update-function-code --function-name mindful-messages-sender --zip-file fileb://deployment-package.zip
\ No newline at end of file
@@ -0,0 +1,67 @@
+import json
+import uuid
+import boto3
+from collections import deque
+
+
+# SQS accepts at most 10 messages per batch call
+sqs_batch_size = 10
+
+
+def dispatch_job(msg):
+    # Compact job body, the worker reads the message itself
+    return {'id': msg['id'], 'user_id': msg['user_id']}
+
+
+class SqsQueue(object):
+    def __init__(self, queue_url, client=None):
+        self.queue_url = queue_url
+        self.client = client or boto3.client('sqs')
+
+    def send_jobs(self, jobs):
+        failed = []
+        for i in range(0, len(jobs), sqs_batch_size):
+            entries = [
+                {'Id': str(n), 'MessageBody': json.dumps(job)}
+                for n, job in enumerate(jobs[i:i + sqs_batch_size])
+            ]
+            resp = self.client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries)
+            for failure in resp.get('Failed', []):
+                failed.append(jobs[i + int(failure['Id'])])
+        return failed
+
+
+class MemoryQueue(object):
+    # In process stand-in for SQS, for tests and running locally. Received
+    # batches come back in the same shape as an SQS Lambda event.
+    def __init__(self):
+        self.messages = deque()
+
+    def send_jobs(self, jobs):
+        for job in jobs:
+            self.messages.append(
+                {'messageId': uuid.uuid4().hex, 'body': json.dumps(job)})
+        return []
+
+    def receive_event(self, max_messages=sqs_batch_size):
+        records = []
+        while self.messages and len(records) < max_messages:
+            records.append(self.messages.popleft())
+        return {'Records': records}
+
+    def requeue(self, event, failures):
+        # Put back the records a worker reported as failed, like SQS would
+        # after the visibility timeout
+        failed_ids = {f['itemIdentifier'] for f in failures}
+        for record in event['Records']:
+            if record['messageId'] in failed_ids:
+                self.messages.append(record)
+
+
+def get_queue(queue_url):
+    if queue_url == 'memory':
+        return MemoryQueue()
+    if queue_url:
+        return SqsQueue(queue_url)
+    return None
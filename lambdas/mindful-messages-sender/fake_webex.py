@@ -0,0 +1,142 @@
+import json
+import time
+import random
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the Webex OAuth, people and messages endpoints.
+# latency adds a delay to every response, rate_limit_next makes the next
+# n requests answer 429 with the given Retry-After, rate_limit_ratio makes
+# that share of requests answer 429, and messages to any address in
+# unknown_emails fail with a 404. With person_per_token each access token
+# is its own person, for logging in many users.
+class FakeWebex(object):
+    def __init__(self, latency=0, people=None, rate_limit_ratio=0,
+                 person_per_token=False, seed=None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.person_per_token = person_per_token
+        self.random = random.Random(seed)
+        self.people = people or [
+            {'id': '123', 'displayName': 'Test User', 'nickName': 'Test',
+             'emails': ['test@domain.com']}
+        ]
+        self.messages = []
+        self.unknown_emails = set()
+        self.requests = 0
+        self.rate_limited = 0
+        self.retry_after = 1
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/v1/'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rate_limit_next(self, n, retry_after=1):
+        with self.lock:
+            self.rate_limited = n
+            self.retry_after = retry_after
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open so client connection reuse is exercised
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=None, headers=None):
+                data = json.dumps(body or {}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length).decode() if length else ''
+                if self.headers.get('Content-Type', '').startswith(
+                        'application/json'):
+                    return json.loads(raw or '{}')
+                return {k: v[0] for k, v in parse_qs(raw).items()}
+
+            def limited(self):
+                time.sleep(fake.latency)
+                with fake.lock:
+                    fake.requests += 1
+                    ratio_limited = (
+                        fake.rate_limit_ratio and
+                        fake.random.random() < fake.rate_limit_ratio)
+                    if fake.rate_limited or ratio_limited:
+                        fake.rate_limited = max(0, fake.rate_limited - 1)
+                        self.reply(
+                            429, {'message': 'Too Many Requests'},
+                            {'Retry-After': str(fake.retry_after)})
+                        return True
+                return False
+
+            def me(self):
+                if not fake.person_per_token:
+                    return fake.people[0]
+                token = self.headers.get('Authorization', '').split()[-1]
+                return {'id': token, 'displayName': f'User {token}',
+                        'nickName': token, 'emails': [f'{token}@domain.com']}
+
+            def do_GET(self):
+                if self.limited():
+                    return
+                url = urlparse(self.path)
+                if url.path == '/v1/people/me':
+                    self.reply(200, self.me())
+                elif url.path == '/v1/people':
+                    name = parse_qs(url.query).get('displayName', [''])[0]
+                    items = [p for p in fake.people
+                             if name.lower() in p['displayName'].lower()]
+                    self.reply(200, {'items': items})
+                else:
+                    self.reply(404, {'message': 'Not found'})
+
+            def do_POST(self):
+                # Always read the body so the connection can be reused
+                body = self.body()
+                if self.limited():
+                    return
+                url = urlparse(self.path)
+                if url.path == '/v1/messages':
+                    if body.get('toPersonEmail') in fake.unknown_emails:
+                        self.reply(404, {'message': 'Person not found'})
+                        return
+                    with fake.lock:
+                        fake.messages.append(body)
+                    body['id'] = str(len(fake.messages))
+                    self.reply(200, body)
+                elif url.path == '/v1/access_token':
+                    self.reply(200, {
+                        'access_token': f'token-{body.get("code") or "r"}',
+                        'expires_in': 1209600,
+                        'refresh_token': 'refresh-token',
+                        'refresh_token_expires_in': 7776000
+                    })
+                else:
+                    self.reply(404, {'message': 'Not found'})
+
+        return Handler
@@ -1,60 +1,470 @@
 import os
-import epsagon
+import math
+import json
+import uuid
+import heapq
+import threading
 import boto3
 from boto3.dynamodb.conditions import Key
-from webexteamssdk import WebexTeamsAPI
-from models import MessageItem, UserItem
-from datetime import datetime
+from models import MessageItem, UserItem, ScheduleItem, DeleteUserJob
+from models import time_fmt, db_error, due_queue, due_queue_cursor_key
+from models import due_shard_count
+from models.retry import default_retry_policy, botocore_config
+from models.routing import TableRouter
+from models.profiling import default_profiler
+from models.tracing import default_tracer
+from models.webex import default_pool, webex_base_url, WebexRateLimited
+from models.webex import refresh_access_token
+from dispatch import get_queue, dispatch_job, MemoryQueue
+from scheduler import get_scheduler, wakeup_time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 
 
 table_name = os.environ['TABLE_NAME']
+# Same routes as the app, e.g. session=mindful-sessions
+table_router = TableRouter(table_name, os.environ.get('TABLE_ROUTES'))
+# Sparse index of schedules, refresh records and jobs by their listed type
 index_name = os.environ['INDEX_NAME']
-epsagon_token = os.environ['EPSAGON_TOKEN']
+user_index_name = os.environ.get('USER_INDEX_NAME', 'user-index')
+# Sharded due#hour#shard index the messages are read from
+due_index_name = os.environ.get('DUE_INDEX_NAME', 'due-index')
+# Minute buckets a run reads when it has no cursor, and at most per run
+due_queue_lookback_minutes = 60
+due_queue_max_buckets = 24 * 60
+# Shard queries run on threads kept across invocations, each with a table
+# of its own, see thread_table
+shard_pool = ThreadPoolExecutor(max_workers=due_shard_count)
+thread_tables = threading.local()
+# SQS queue URL for dispatch jobs, 'memory' for an in process queue. When
+# unset messages are sent by the scanner itself.
+dispatch_queue = get_queue(os.environ.get('DISPATCH_QUEUE_URL'))
+# One-shot EventBridge schedule that wakes the sender at the next due time,
+# 'memory' for an in process emulator. Disabled when unset.
+wakeup_scheduler = get_scheduler(
+    os.environ.get('WAKEUP_SCHEDULE_NAME'),
+    os.environ.get('WAKEUP_TARGET_ARN'),
+    os.environ.get('WAKEUP_ROLE_ARN'))
+# OAuth client used to renew users' access tokens, skipped when unset
+client_id = os.environ.get('OAUTH_CLIENT_ID')
+client_secret = os.environ.get('OAUTH_CLIENT_SECRET')
 app_name = os.environ['APP_NAME']
+# Messages expanded from schedules get IDs from the schedule and occurrence
+schedule_namespace = uuid.UUID('26f7617a-0136-4a17-b8b4-e0023dc2abe4')
 
-epsagon.init(
-    token=epsagon_token,
-    app_name=app_name,
-    metadata_only=False,
-)
+# No-op unless TRACING is set
+default_tracer.init(app_name)
 
 
-def get_table(table_name=table_name):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
-    return table
+def get_table():
+    # TABLE_NAME, or a table that routes each record type to its own
+    return table_router.table()
 
 
-def get_msgs_by_datetime(table, index_name, isoformat_string):
-    resp = table.query(
-        # Add the name of the index you want to use in your query.
+def thread_table():
+    # The calling thread's table, on a session of its own since the default
+    # session is not safe to share between threads. Made once per thread.
+    if getattr(thread_tables, 'table', None) is None:
+        session = boto3.session.Session()
+        thread_tables.table = TableRouter(
+            table_name, table_router.routes,
+            lambda: session.resource(
+                'dynamodb', config=botocore_config)).table()
+    return thread_tables.table
+
+
+def get_msgs_by_due_key(table, due_index_name, due_key):
+    kwargs = {
+        'IndexName': due_index_name,
+        'KeyConditionExpression': Key('due').eq(due_key)
+    }
+    items = []
+    while True:
+        resp = default_retry_policy.call(table.query, **kwargs)
+        items.extend(MessageItem.decode(item) for item in resp['Items'])
+        if 'LastEvaluatedKey' not in resp:
+            return items
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def get_msgs_by_due_shards(table_factory, due_index_name, isoformat_string):
+    # Query every shard of the hour in parallel on shard_pool, each thread
+    # with the table table_factory gives it. Shard results are already in
+    # send time order, so they are merged rather than sorted.
+    due_keys = MessageItem.due_keys(isoformat_string)
+    shards = list(shard_pool.map(
+        lambda due_key: get_msgs_by_due_key(
+            table_factory(), due_index_name, due_key),
+        due_keys))
+    return list(heapq.merge(*shards, key=lambda msg: msg['sk']))
+
+
+def get_first_due_at(table, due_index_name, due_key, after):
+    # Send time of the shard's first message due after the given time
+    resp = default_retry_policy.call(
+        table.query,
+        IndexName=due_index_name,
+        KeyConditionExpression=Key('due').eq(due_key) & Key('sk').gt(after),
+        Limit=1
+    )
+    return resp['Items'][0]['sk'] if resp['Items'] else None
+
+
+def due_queue_buckets(cursor, now, lookback=due_queue_lookback_minutes,
+                      limit=due_queue_max_buckets):
+    # Minutes after the cursor up to and including the current one, e.g.
+    # ['2030-01-01T09:04', '2030-01-01T09:05']
+    minute = now.replace(second=0, microsecond=0)
+    if cursor:
+        start = datetime.strptime(cursor, '%Y-%m-%dT%H:%M') + \
+            timedelta(minutes=1)
+    else:
+        start = minute - timedelta(minutes=lookback)
+    buckets = []
+    while start <= minute and len(buckets) < limit:
+        buckets.append(start.strftime('%Y-%m-%dT%H:%M'))
+        start += timedelta(minutes=1)
+    return buckets
+
+
+def get_msgs_by_due_queue(table, now):
+    # One query per minute bucket since the last run. Returns the due
+    # messages, with the key of their entry, and the minute the queue can
+    # be marked drained up to once they are handled. The last two minutes
+    # are read again next run, for entries written while this one ran.
+    resp = default_retry_policy.call(
+        table.get_item, Key=due_queue_cursor_key)
+    cursor = resp.get('Item', {}).get('minute')
+    now_string = now.strftime(time_fmt)
+    settled = (now - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M')
+    msgs = []
+    drained = cursor
+    for bucket in due_queue_buckets(cursor, now):
+        kwargs = {'KeyConditionExpression': Key('pk').eq(f'due#{bucket}')}
+        while True:
+            resp = default_retry_policy.call(table.query, **kwargs)
+            for entry in resp['Items']:
+                time = entry['sk'].partition('#')[0]
+                # Later in the current minute, left for the next run
+                if time <= now_string:
+                    msgs.append({
+                        'id': entry['id'],
+                        'user_id': entry['user_id'],
+                        'sk': time,
+                        'entry': {'pk': entry['pk'], 'sk': entry['sk']}
+                    })
+            if 'LastEvaluatedKey' not in resp:
+                break
+            kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+        if bucket < settled:
+            drained = bucket
+    msgs.sort(key=lambda msg: msg['sk'])
+    return msgs, drained
+
+
+def clear_due_queue(table, msgs, drained):
+    # Delete the entries of handled messages and move the cursor on
+    def batch_write_item():
+        with table.batch_writer() as batch:
+            for msg in msgs:
+                batch.delete_item(Key=msg['entry'])
+    default_retry_policy.call(batch_write_item)
+    if drained:
+        default_retry_policy.call(
+            table.put_item, Item=dict(due_queue_cursor_key, minute=drained))
+
+
+def get_schedules_due_before(table, index_name, isoformat_string):
+    resp = default_retry_policy.call(
+        table.query,
         IndexName=index_name,
-        KeyConditionExpression=Key('record_type').eq('message') &
-        Key('sk').begins_with(isoformat_string)
+        KeyConditionExpression=Key('listed').eq('schedule') &
+        Key('sk').lt(isoformat_string)
     )
     return resp['Items']
 
 
-@epsagon.lambda_wrapper
+def get_next_due_at(table_factory, index_name, due_index_name, now):
+    # Earliest message or schedule due after now and before the end of the
+    # next hour, None if there is none. Later ones are found by the runs in
+    # between. Every query stops at the first item, the due shards of an
+    # hour are queried in parallel as in get_msgs_by_due_shards.
+    now_string = now.strftime(time_fmt)
+    end = (now + timedelta(hours=2)).strftime('%Y-%m-%dT%H:')
+    resp = default_retry_policy.call(
+        table_factory().query,
+        IndexName=index_name,
+        KeyConditionExpression=Key('listed').eq('schedule') &
+        Key('sk').between(now_string, end),
+        Limit=1
+    )
+    times = [item['sk'] for item in resp['Items'] if item['sk'] > now_string]
+    for hour in (now, now + timedelta(hours=1)):
+        due_keys = MessageItem.due_keys(hour.strftime(time_fmt))
+        found = [t for t in shard_pool.map(
+            lambda due_key: get_first_due_at(
+                table_factory(), due_index_name, due_key, now_string),
+            due_keys) if t]
+        times.extend(found)
+        # Messages of the next hour are all later
+        if found:
+            break
+    return min(times, default=None)
+
+
+def schedule_wakeup(scheduler, next_due_at):
+    if not (scheduler and next_due_at):
+        return None
+    try:
+        return scheduler.schedule(wakeup_time(next_due_at))
+    except Exception as e:
+        # The fixed schedule still picks the messages up
+        print(e)
+        return None
+
+
+def expand_schedules(table, index_name, now):
+    # Turn each recurring schedule due before the end of this hour into a
+    # single message, then move the schedule on to its next occurrence.
+    hour_start = now.strftime("%Y-%m-%dT%H:")
+    next_hour_start = (now + timedelta(hours=1)).strftime("%Y-%m-%dT%H:")
+    expanded = 0
+    for schedule in get_schedules_due_before(
+            table, index_name, next_hour_start):
+        schedule_item = ScheduleItem(table=table, schedule_id=schedule['id'])
+        if not schedule_item.is_valid:
+            continue
+        time = schedule_item.time
+        # Occurrences missed by earlier runs go out in this run
+        if time < hour_start:
+            time = hour_start + '00:00'
+        user_item = UserItem(table=table, user_id=schedule_item.user_id)
+        if not user_item.is_valid:
+            schedule_item.delete()
+            continue
+        # Overlapping runs expand an occurrence into the same message, only
+        # the run that creates it adds it to the user. Both advance the
+        # schedule to the same next occurrence.
+        msg_id = uuid.uuid5(
+            schedule_namespace,
+            f'{schedule_item.id}:{int(schedule_item.occurrence)}').hex
+        message_item = MessageItem(
+            table=table,
+            msg_id=msg_id,
+            user_id=user_item.id,
+            time=time,
+            msg=schedule_item.msg,
+            person=schedule_item.person)
+        if message_item.created:
+            user_item.add_message(message_item.id)
+            expanded += 1
+        if not schedule_item.advance(now.strftime(time_fmt)):
+            user_item.remove_schedule(schedule_item.id)
+    return expanded
+
+
+def resume_jobs(table, index_name, time_left=None):
+    # Finish user deletions that ran out of time in the API
+    resp = default_retry_policy.call(
+        table.query,
+        IndexName=index_name,
+        KeyConditionExpression=Key('listed').eq('job')
+    )
+    finished = 0
+    for job in resp['Items']:
+        if job.get('job_type') == 'delete_user':
+            job_item = DeleteUserJob(table=table, user_id=job['target_id'])
+            if job_item.run(user_index_name, time_left=time_left):
+                finished += 1
+    return finished
+
+
+def refresh_tokens(table, index_name, now):
+    # Renew access tokens that are close to expiring, one batch per run,
+    # so sends never wait on Webex OAuth. Failures are tried next run.
+    if not (client_id and client_secret):
+        return 0
+    refreshed = 0
+    for record in UserItem.refresh_due(
+            table, index_name, now.strftime(time_fmt)):
+        user_item = UserItem(table=table, user_id=record['user_id'])
+        # Stale records, and users who can only renew by logging in again
+        if (not user_item.is_valid or user_item.wbx_refresh_token_expired
+                or getattr(user_item, 'refresh_at', None) != record['sk']):
+            default_retry_policy.call(
+                table.delete_item,
+                Key={'pk': record['pk'], 'sk': record['sk']})
+            continue
+        try:
+            oauth_token = refresh_access_token(
+                client_id, client_secret, user_item.wbx_refresh_token,
+                base_url=webex_base_url)
+        except Exception as e:
+            print(e)
+            continue
+        if user_item.update_oauth_token(oauth_token) != db_error:
+            refreshed += 1
+    return refreshed
+
+
+def send_message(table, message_id, user_id, claim_id):
+    # Send one due message and clean it up. Returns the outcome, one of
+    # sent, skipped, rescheduled, failed or dead_letter.
+    message_item = MessageItem(table=table, msg_id=message_id)
+    if not (message_item.is_valid and message_item.expired):
+        return 'skipped'
+    user_item = UserItem(table=table, user_id=user_id)
+    # Skip users that are gone or being deleted
+    if not user_item.is_valid:
+        return 'skipped'
+    # Overlapping runs and redelivered jobs lose the claim and skip it
+    if not message_item.claim(claim_id):
+        return 'skipped'
+    # A run that sent but failed to clean up only needs the clean up
+    if not message_item.was_sent():
+        try:
+            default_pool.call(
+                user_item.wbx_token,
+                lambda api: api.messages.create(
+                    toPersonEmail=message_item.person,
+                    text=message_item.msg),
+                'messages.create')
+        except WebexRateLimited as e:
+            # Not a failure, try again once Retry-After has passed without
+            # using up one of the message's attempts
+            message_item.reschedule(
+                math.ceil(e.retry_after), attempted=False)
+            return 'rescheduled'
+        except Exception as e:
+            print(e)
+            status = message_item.fail(str(e))
+            if status == 'dead_letter':
+                user_item.remove_message(message_id)
+            return status
+        message_item.mark_sent()
+    user_item.remove_message(message_item.id)
+    message_item.delete()
+    return 'sent'
+
+
+def queue_due(queue, msgs, now):
+    # Scanner stage, queue a compact job for each message that is due.
+    # Returns the messages queued.
+    now_string = now.strftime(time_fmt)
+    due = [msg for msg in msgs if msg['sk'] <= now_string]
+    failed = queue.send_jobs([dispatch_job(msg) for msg in due])
+    return [msg for msg in due if dispatch_job(msg) not in failed]
+
+
+def enqueue_due(queue, msgs, now):
+    return len(queue_due(queue, msgs, now))
+
+
+def drain_memory_queue(queue):
+    # Run the worker stage in process until the local queue is empty
+    outcomes = Counter()
+    while queue.messages:
+        event = queue.receive_event()
+        failures, batch_outcomes = process_jobs(event.get('Records', []))
+        outcomes.update(batch_outcomes)
+        queue.requeue(event, failures)
+        if len(failures) == len(event['Records']):
+            # Nothing in this batch can be processed, leave it for next run
+            break
+    return outcomes
+
+
+def summary(outcomes):
+    # e.g. {'sent count': 3, 'failed count': 1}
+    return {f'{outcome} count': n for outcome, n in outcomes.items()}
+
+
+@default_tracer.traced(flush=True)
+@default_profiler.profiled()
 def lambda_handler(event, context):
     # 10 minute
     # datetime_search_string = datetime.utcnow().strftime(
     #   "%Y-%m-%dT%H:%M")[:-1]
     # 1 hour
-    datetime_search_string = datetime.utcnow().strftime("%Y-%m-%dT%H:")
-    msgs = get_msgs_by_datetime(
-        get_table(), index_name, datetime_search_string)
-    results = []
-    for msg in msgs:
-        user_id = msg.get('user_id')
-        message_id = msg.get('id')
-        message_item = MessageItem(table=get_table(), msg_id=message_id)
-        if message_item.is_valid and message_item.expired:
-            user_item = UserItem(table=get_table(), user_id=user_id)
-            wbxapi = WebexTeamsAPI(access_token=user_item.wbx_token)
-            wbxapi.messages.create(
-                toPersonEmail=message_item.person, text=message_item.msg)
-            user_item.remove_message(message_item.id)
-            message_item.delete()
-            results.append(msg)
-    return {'message count': len(results)}
+    now = datetime.utcnow()
+    time_left = getattr(context, 'get_remaining_time_in_millis', None)
+    refresh_count = refresh_tokens(get_table(), index_name, now)
+    schedule_count = expand_schedules(get_table(), index_name, now)
+    datetime_search_string = now.strftime("%Y-%m-%dT%H:")
+    drained = None
+    if due_queue:
+        msgs, drained = get_msgs_by_due_queue(get_table(), now)
+    else:
+        msgs = get_msgs_by_due_shards(
+            thread_table, due_index_name, datetime_search_string)
+    counts = {
+        'schedule count': schedule_count,
+        'refresh count': refresh_count
+    }
+    if dispatch_queue:
+        handled = queue_due(dispatch_queue, msgs, now)
+        counts['queued count'] = len(handled)
+        # A local queue has no workers of its own, drain it here
+        if isinstance(dispatch_queue, MemoryQueue):
+            outcomes = drain_memory_queue(dispatch_queue)
+            counts['message count'] = outcomes['sent']
+            counts.update(summary(outcomes))
+    else:
+        claim_id = (
+            getattr(context, 'aws_request_id', None) or uuid.uuid4().hex)
+        outcomes = Counter()
+        handled = []
+        for msg in msgs:
+            # One bad message must not stop the rest of the run
+            try:
+                outcomes[send_message(
+                    get_table(), msg.get('id'), msg.get('user_id'),
+                    claim_id)] += 1
+                handled.append(msg)
+            except Exception as e:
+                print(e)
+                outcomes['error'] += 1
+        counts['message count'] = outcomes['sent']
+        counts.update(summary(outcomes))
+    if due_queue:
+        # Errors keep their entries, and the cursor, for the next run
+        if len(handled) < len(msgs):
+            drained = None
+        clear_due_queue(get_table(), handled, drained)
+    # Leftover account deletions get what is left of the run, sends come
+    # first. Messages of users being deleted are skipped meanwhile.
+    counts['job count'] = resume_jobs(get_table(), index_name, time_left)
+    # Rescheduled sends count too, so look from the end of the run
+    next_due_at = get_next_due_at(
+        thread_table, index_name, due_index_name, datetime.utcnow())
+    counts['next due at'] = next_due_at
+    counts['wakeup at'] = schedule_wakeup(wakeup_scheduler, next_due_at)
+    return counts
+
+
+def process_jobs(records):
+    # Send the message for each dispatch job record. Send failures are
+    # recorded on the message and retried by later runs, so only records
+    # that could not be processed at all are returned, in SQS partial batch
+    # response form, with a count of the outcomes.
+    failures = []
+    outcomes = Counter()
+    for record in records:
+        try:
+            job = json.loads(record['body'])
+            # Redelivery of the same SQS message reuses its claim
+            outcomes[send_message(get_table(), job['id'], job['user_id'],
+                                  record['messageId'])] += 1
+        except Exception as e:
+            print(e)
+            failures.append({'itemIdentifier': record['messageId']})
+    return failures, outcomes
+
+
+@default_tracer.traced(flush=True)
+def worker_handler(event, context):
+    # Worker stage, consumes SQS batches of dispatch jobs. Failed records
+    # are reported individually so the rest of the batch is not retried.
+    failures, outcomes = process_jobs(event.get('Records', []))
+    return {'batchItemFailures': failures}
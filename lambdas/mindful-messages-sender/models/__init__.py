@@ -1,14 +1,67 @@
 from datetime import datetime, timedelta
+from bisect import bisect_right
+import os
+import base64
+import calendar
+import json
 import uuid
 import secrets
+import zlib
 import pytz
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import Binary
+from .retry import default_retry_policy
 
 
 # Session and token expiration constants
 session_expiration_hours = 2
 webex_token_expiration_days = 13
+# Tokens are renewed in the background this long before they expire, and
+# this many users are renewed per sender run
+webex_token_refresh_days = 2
+token_refresh_batch_size = 25
 time_fmt = "%Y-%m-%dT%H:%M:%S"
+# Latest possible message time. It sorts before non message sort keys such
+# as 'sessionid#...' which share the user_id index partition.
+max_time = '9999-12-31T23:59:59'
+# Message attributes a client may ask for, and the page size limits
+message_fields = ('id', 'time', 'msg', 'person')
+default_page_size = 50
+max_page_size = 100
+# Tries at a user's message list before giving up on concurrent changes
+list_update_attempts = 5
+# How long a sender run holds its claim on a message, and how long the
+# record of a sent message is kept to stop it being sent again
+claim_lease_seconds = 300
+sent_record_days = 7
+# Failed sends are retried after retry_base_seconds, doubling each time
+# up to retry_max_seconds, and dead lettered after max_send_attempts
+max_send_attempts = 5
+retry_base_seconds = 60
+retry_max_seconds = 3600
+# Messages are spread over this many due index partitions per hour
+due_shard_count = int(os.environ.get('DUE_SHARD_COUNT', '8'))
+# Also file each message in a due queue, one partition of dispatch entries
+# per minute, which the sender drains instead of querying the indexes. The
+# app and the sender must agree on this.
+due_queue = os.environ.get('DUE_QUEUE', '') == 'true'
+due_queue_cursor_key = {'pk': 'due#cursor', 'sk': 'due#cursor'}
+# Write messages in a compact form: short attribute names, no id or time
+# when the keys hold them, and msg compressed once it is longer than
+# message_compress_bytes. Both forms are read, so it can be turned on at
+# any time. Attributes the indexes or updates use keep their names.
+compact_messages = os.environ.get('COMPACT_MESSAGES', '') == 'true'
+message_compress_bytes = int(os.environ.get('MESSAGE_COMPRESS_BYTES', '200'))
+compact_names = {'msg': 'm', 'person': 'p', 'time': 't'}
+# Keys deleted per page by a user deletion job, the BatchWriteItem limit
+delete_page_size = 25
+# Time a deletion job leaves for the rest of the invocation
+delete_reserve_ms = 5000
+# Keep a snapshot of the user on their session so most requests need
+# only the session read. The app and the sender must agree on this.
+session_snapshot = os.environ.get('SESSION_SNAPSHOT', '') == 'true'
+# Supported recurrence frequencies for schedules
+schedule_frequencies = ('daily', 'weekly', 'monthly')
 
 # Errors
 auth_error = {'success': False, 'results': {'error': 'Authorization error.'}}
@@ -17,12 +70,18 @@ db_error = {'success': False, 'results': {'error': 'Database error.'}}
 
 # DB Item Classes
 class Item(object):
+    # Throttles are retried with backoff, anything else fails immediately
+    retry_policy = default_retry_policy
+
     def __init__(self, table):
         self.table = table
 
-    def _create_item(self, item: dict) -> dict:
+    def _create_item(self, item: dict, condition_exp: str = None) -> dict:
+        kwargs = {'Item': item}
+        if condition_exp:
+            kwargs['ConditionExpression'] = condition_exp
         try:
-            resp = self.table.put_item(Item=item)
+            resp = self.retry_policy.call(self.table.put_item, **kwargs)
             return resp
         except Exception as e:
             print(e)
@@ -30,7 +89,7 @@ class Item(object):
 
     def _get_item(self, key: dict) -> dict:
         try:
-            resp = self.table.get_item(Key=key)
+            resp = self.retry_policy.call(self.table.get_item, Key=key)
             return resp
         except Exception as e:
             print(e)
@@ -38,7 +97,8 @@ class Item(object):
 
     def _query_item(self, key_cond_exp: Key) -> dict:
         try:
-            resp = self.table.query(
+            resp = self.retry_policy.call(
+                self.table.query,
                 KeyConditionExpression=key_cond_exp
                 )
             return resp
@@ -50,35 +110,32 @@ class Item(object):
             self,
             key: dict,
             update_exp: str,
-            exp_attr_values: dict = None) -> dict:
+            exp_attr_values: dict = None,
+            condition_exp: str = None,
+            exp_attr_names: dict = None) -> dict:
+        kwargs = {
+            'Key': key,
+            'UpdateExpression': update_exp,
+            'ReturnValues': 'ALL_NEW'
+        }
         if exp_attr_values:
-            try:
-                resp = self.table.update_item(
-                    Key=key,
-                    UpdateExpression=update_exp,
-                    ExpressionAttributeValues=exp_attr_values,
-                    ReturnValues='ALL_NEW'
-                    )
-                return resp
-            except Exception as e:
-                print(e)
-                return db_error
-        else:
-            try:
-                resp = self.table.update_item(
-                    Key=key,
-                    UpdateExpression=update_exp,
-                    ReturnValues='ALL_NEW'
-                    )
-                return resp
-            except Exception as e:
-                print(e)
-                return db_error
+            kwargs['ExpressionAttributeValues'] = exp_attr_values
+        if exp_attr_names:
+            kwargs['ExpressionAttributeNames'] = exp_attr_names
+        # Failed conditions are not retried and come back as db_error
+        if condition_exp:
+            kwargs['ConditionExpression'] = condition_exp
+        try:
+            resp = self.retry_policy.call(self.table.update_item, **kwargs)
+            return resp
+        except Exception as e:
+            print(e)
+            return db_error
 
     def _delete_item(self, key):
         try:
             # Delete user item
-            self.table.delete_item(Key=key)
+            self.retry_policy.call(self.table.delete_item, Key=key)
             return True
         except Exception as e:
             print(e)
@@ -104,6 +161,24 @@ class Item(object):
             tz.localize(dt)).astimezone(
                 pytz.utc).strftime(time_fmt)
 
+    @staticmethod
+    def to_utc_bulk(pairs):
+        # Convert many (datetime, timezone) pairs, looking each zone up once.
+        # Pairs that fail to convert come back as the exception raised.
+        zones = {}
+        results = []
+        for dt, tz in pairs:
+            try:
+                if tz not in zones:
+                    zones[tz] = pytz.timezone(tz)
+                zone = zones[tz]
+                local_dt = zone.localize(datetime.fromisoformat(dt))
+                results.append(zone.normalize(local_dt).astimezone(
+                    pytz.utc).strftime(time_fmt))
+            except Exception as e:
+                results.append(e)
+        return results
+
     @staticmethod
     def from_utc(dt, tz):
         dt = datetime.fromisoformat(dt)
@@ -111,6 +186,32 @@ class Item(object):
         # Return timezone naive datetime string, ex. '2021-12-09T16:04:42'
         return tz.fromutc(dt).strftime(time_fmt)
 
+    @staticmethod
+    def from_utc_bulk(times, tz):
+        # Convert many UTC times to one zone, as from_utc does. The offset
+        # is looked up once per DST period, in the zone's transition table
+        # as pytz's fromutc does, and reused while times stay within it.
+        # Raises for an unknown zone.
+        zone = pytz.timezone(tz)
+        transitions = getattr(zone, '_utc_transition_times', None)
+        if not transitions:
+            # A fixed offset, e.g. UTC
+            offset = zone.utcoffset(datetime.utcnow())
+            return [(datetime.fromisoformat(t) + offset).strftime(time_fmt)
+                    for t in times]
+        start = end = offset = None
+        results = []
+        for t in times:
+            dt = datetime.fromisoformat(t)
+            if offset is None or not start <= dt < end:
+                i = max(0, bisect_right(transitions, dt) - 1)
+                offset = zone._transition_info[i][0]
+                start = transitions[i]
+                end = transitions[i + 1] if i + 1 < len(transitions) \
+                    else datetime.max
+            results.append((dt + offset).strftime(time_fmt))
+        return results
+
     @staticmethod
     def get_uuid():
         return uuid.uuid4().hex
@@ -127,6 +228,16 @@ class Item(object):
     def get_session_expiration(hours):
         return datetime.utcnow() + timedelta(hours=hours)
 
+    @staticmethod
+    def encode_cursor(key):
+        # Opaque, URL safe form of a LastEvaluatedKey
+        return base64.urlsafe_b64encode(
+            json.dumps(key, sort_keys=True).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
     def _reflect_item_attrs(self, d):
         if not isinstance(d, dict):
             return False
@@ -154,6 +265,9 @@ class SessionItem(Item):
 
     @property
     def expired(self):
+        # Missing or deleted sessions count as expired
+        if not self.expires:
+            return True
         return self.is_datetime_expired(self.expires)
 
     def create(self, delta=session_expiration_hours):
@@ -200,16 +314,32 @@ class SessionItem(Item):
 
 
 class UserItem(Item):
+    session_snapshot = session_snapshot
+    # User attributes copied onto the session
+    snapshot_fields = ('displayname', 'wbx_token_expires', 'version',
+                       'deleted_at')
+    # True for users built from a session snapshot without a user read
+    is_snapshot = False
+
     def __init__(
-            self, table=None, user_id=None, wbx_person=None, wbx_token=None):
+            self,
+            table=None,
+            user_id=None,
+            wbx_person=None,
+            wbx_token=None,
+            oauth_token=None):
         super().__init__(table)
         self.id = user_id
         self.wbx_person = wbx_person
         self.wbx_token = wbx_token
+        # Webex AccessToken, with the refresh token and expiry times
+        self.oauth_token = oauth_token
+        if oauth_token:
+            self.wbx_token = oauth_token.access_token
         self.is_valid = False
         if user_id:
             self.get()
-        elif wbx_person and wbx_token:
+        elif wbx_person and self.wbx_token:
             self.create()
 
     @property
@@ -217,6 +347,83 @@ class UserItem(Item):
         if self.is_valid:
             return self.is_datetime_expired(self.wbx_token_expires)
 
+    @property
+    def wbx_refresh_token_expired(self):
+        # Also True for users who logged in before refresh tokens were kept
+        expires = getattr(self, 'wbx_refresh_token_expires', None)
+        return not expires or self.is_datetime_expired(expires)
+
+    def snapshot(self):
+        snapshot = {
+            field: getattr(self, field) for field in self.snapshot_fields
+            if getattr(self, field, None) is not None}
+        snapshot['message_count'] = len(getattr(self, 'messages', []) or [])
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, table, user_id, session_id, snapshot):
+        # Enough of the user to render pages and check etags. Anything that
+        # needs the message or schedule lists, or the token, reads the user.
+        user_item = cls(table=table)
+        user_item.id = user_id
+        user_item.session_id = session_id
+        user_item._reflect_item_attrs(snapshot)
+        user_item.is_valid = not snapshot.get('deleted_at')
+        user_item.is_snapshot = True
+        return user_item
+
+    def sync_session(self):
+        # Copy the snapshot onto the user's session. The version condition
+        # stops a slow writer replacing a newer snapshot with an older one.
+        if not (self.session_snapshot and getattr(self, 'session_id', None)):
+            return None
+        key = {
+            'pk': f'sessionid#{self.session_id}',
+            'sk': f'sessionid#{self.session_id}'
+        }
+        update_exp = 'SET user_snapshot = :s, user_version = :v'
+        exp_attr_values = {
+            ':s': self.snapshot(),
+            ':v': int(getattr(self, 'version', 0))
+        }
+        condition_exp = ('attribute_exists(pk) AND '
+                         '(attribute_not_exists(user_version) OR '
+                         'user_version <= :v)')
+        return self._update_item(
+            key, update_exp, exp_attr_values, condition_exp)
+
+    def _get_synced(self):
+        resp = self.get()
+        self.sync_session()
+        return resp
+
+    @property
+    def refresh_key(self):
+        return {'pk': f'refresh#{self.id}', 'sk': self.refresh_at}
+
+    @staticmethod
+    def oauth_token_attrs(oauth_token, days=webex_token_refresh_days):
+        # Token attributes, and when to renew the access token. Short lived
+        # tokens are renewed half way through their lifetime.
+        now = datetime.utcnow()
+        lifetime = timedelta(seconds=int(oauth_token.expires_in))
+        expires = now + lifetime
+        refresh_expires = now + timedelta(
+            seconds=int(oauth_token.refresh_token_expires_in))
+        refresh_at = expires - min(timedelta(days=days), lifetime / 2)
+        return {
+            'wbx_token': oauth_token.access_token,
+            'wbx_token_expires': expires.isoformat(),
+            'wbx_refresh_token': oauth_token.refresh_token,
+            'wbx_refresh_token_expires': refresh_expires.isoformat(),
+            'refresh_at': refresh_at.strftime(time_fmt)
+        }
+
+    @property
+    def etag(self):
+        # Changes whenever the user's messages change
+        return f'"{self.id}.{int(getattr(self, "version", 0))}"'
+
     def create(self, days=webex_token_expiration_days):
         self.id = self.wbx_person.id
         item = {
@@ -231,7 +438,12 @@ class UserItem(Item):
             'record_type': 'user',
             'id': self.id
         }
+        if self.oauth_token:
+            item.update(self.oauth_token_attrs(self.oauth_token))
         self._create_item(item)
+        if self.oauth_token:
+            self.refresh_at = item['refresh_at']
+            self._create_refresh_record()
         return self.get()
 
     def get(self):
@@ -240,10 +452,20 @@ class UserItem(Item):
         resp_item = resp.get('Item')
         if resp_item:
             self.is_valid = self._reflect_item_attrs(resp_item)
+            # Users that are being deleted read as missing
+            if resp_item.get('deleted_at'):
+                self.is_valid = False
             return resp_item
         else:
             return resp
 
+    def tombstone(self):
+        key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
+        update_exp = 'SET deleted_at = :i'
+        exp_attr_values = {':i': datetime.utcnow().isoformat()}
+        self._update_item(key, update_exp, exp_attr_values)
+        return self._get_synced()
+
     def delete(self):
         key = {
             'pk': f'userid#{self.id}',
@@ -265,7 +487,57 @@ class UserItem(Item):
         exp_attr_values = {':i': wbx_token}
         self._update_item(key, update_exp, exp_attr_values)
         self._update_wbx_token_expiration(key)
-        return self.get()
+        return self._get_synced()
+
+    def update_oauth_token(self, oauth_token) -> dict:
+        # Store a new access and refresh token, and move the user's refresh
+        # record to the new renewal time
+        key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
+        attrs = self.oauth_token_attrs(oauth_token)
+        old_refresh_key = None
+        if getattr(self, 'refresh_at', None):
+            old_refresh_key = self.refresh_key
+        update_exp = 'SET ' + ', '.join(f'{name} = :{name}' for name in attrs)
+        exp_attr_values = {f':{name}': value for name, value in attrs.items()}
+        resp = self._update_item(key, update_exp, exp_attr_values)
+        if resp == db_error:
+            return resp
+        self.refresh_at = attrs['refresh_at']
+        self._create_refresh_record()
+        if old_refresh_key and old_refresh_key != self.refresh_key:
+            self._delete_item(old_refresh_key)
+        return self._get_synced()
+
+    def _create_refresh_record(self):
+        # Sorted by renewal time in the listed index, and keyed by user_id
+        # so account deletion removes it with the user's items
+        item = dict(self.refresh_key)
+        item['user_id'] = self.id
+        item['record_type'] = 'refresh'
+        item['listed'] = 'refresh'
+        return self._create_item(item)
+
+    def remove_refresh_record(self):
+        if getattr(self, 'refresh_at', None):
+            return self._delete_item(self.refresh_key)
+        return None
+
+    @classmethod
+    def refresh_due(
+            cls, table, index_name, before, limit=token_refresh_batch_size):
+        # Refresh records of users whose tokens should be renewed by before
+        try:
+            resp = cls.retry_policy.call(
+                table.query,
+                IndexName=index_name,
+                KeyConditionExpression=Key('listed').eq('refresh') &
+                Key('sk').lte(before),
+                Limit=limit
+            )
+            return resp['Items']
+        except Exception as e:
+            print(e)
+            return []
 
     def _update_wbx_token_expiration(
             self,
@@ -281,7 +553,7 @@ class UserItem(Item):
         update_exp = 'SET session_id = :i'
         exp_attr_values = {':i': session_id}
         self._update_item(key, update_exp, exp_attr_values)
-        return self.get()
+        return self._get_synced()
 
     def remove_session(self):
         key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
@@ -291,21 +563,65 @@ class UserItem(Item):
         return self.get()
 
     def add_message(self, msg_id):
+        return self.add_messages([msg_id])
+
+    def add_messages(self, msg_ids):
+        # Append many msg IDs to the user item in a single update
+        key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
+        # Bump the version so cached message lists are invalidated
+        update_exp = ('SET messages = list_append(messages, :i) '
+                      'ADD version :one')
+        exp_attr_values = {':i': list(msg_ids), ':one': 1}
+        self._update_item(key, update_exp, exp_attr_values)
+        return self._get_synced()
+
+    def add_schedule(self, schedule_id):
         key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
-        update_exp = 'SET messages = list_append(messages, :i)'
-        exp_attr_values = {':i': [msg_id]}
+        # Users created before schedules existed have no schedules list
+        update_exp = ('SET schedules = list_append('
+                      'if_not_exists(schedules, :empty), :i)')
+        exp_attr_values = {':i': [schedule_id], ':empty': []}
         self._update_item(key, update_exp, exp_attr_values)
         return self.get()
 
-    def remove_message(self, msg_id):
-        # Remove given msg, update msg list on user item
-        msgs = [m for m in self.messages if not m == msg_id]
+    def remove_schedule(self, schedule_id):
+        schedules = getattr(self, 'schedules', [])
+        schedules = [s for s in schedules if not s == schedule_id]
         key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
-        update_exp = 'SET messages = :msgs'
-        exp_attr_values = {':msgs': msgs}
+        update_exp = 'SET schedules = :schedules'
+        exp_attr_values = {':schedules': schedules}
         self._update_item(key, update_exp, exp_attr_values)
         return self.get()
 
+    def remove_message(self, msg_id):
+        return self.remove_messages([msg_id])
+
+    def remove_messages(self, msg_ids, attempts=list_update_attempts):
+        # Remove given msgs, update msg list on user item. The list is
+        # written back only if the version is still the one it was read
+        # at, so removals and appends made meanwhile by other workers or
+        # POST /schedule are kept. Otherwise re-read and try again.
+        msg_ids = set(msg_ids)
+        key = {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'}
+        update_exp = 'SET messages = :msgs ADD version :one'
+        for _ in range(attempts):
+            msgs = [m for m in self.messages if m not in msg_ids]
+            exp_attr_values = {':msgs': msgs, ':one': 1}
+            if hasattr(self, 'version'):
+                condition_exp = 'version = :v'
+                exp_attr_values[':v'] = self.version
+            else:
+                # Users get a version with their first list change
+                condition_exp = 'attribute_not_exists(version)'
+            resp = self._update_item(
+                key, update_exp, exp_attr_values, condition_exp)
+            if resp != db_error:
+                break
+            self.get()
+            if not self.is_valid:
+                break
+        return self._get_synced()
+
 
 class MessageItem(Item):
     def __init__(
@@ -324,6 +640,7 @@ class MessageItem(Item):
         self.msg = msg
         self.person = person
         self.is_valid = False
+        self.created = False
         self.index_name = index_name
         if user_id and time and msg and person:
             self.create()
@@ -332,25 +649,420 @@ class MessageItem(Item):
 
     @property
     def expired(self):
-        return self.is_datetime_expired(self.time)
+        # Due once the sort key, the next time to try it, has passed
+        return self.is_datetime_expired(self.key['sk'])
 
-    def create(self):
-        self.id = self.get_uuid()
-        item = {
+    @staticmethod
+    def due_key(time, shard):
+        # e.g. due#2021-12-09T16#shard-3 for any time in that hour
+        return f'due#{time[:13]}#shard-{shard}'
+
+    @classmethod
+    def due_keys(cls, time, shards=None):
+        # Every shard's due key for the hour of the given time
+        shards = shards or due_shard_count
+        return [cls.due_key(time, shard) for shard in range(shards)]
+
+    @staticmethod
+    def queue_bucket(time, now=None):
+        # e.g. due#2021-12-09T16:05. Messages already due go in the current
+        # minute, which the sender reads again until it is over.
+        now = now or datetime.utcnow().strftime(time_fmt)
+        return f'due#{max(time, now)[:16]}'
+
+    @classmethod
+    def queue_entry(cls, item, days=sent_record_days):
+        # The dispatch job for a message item, filed under the minute it is
+        # next due. ttl clears entries of messages deleted before then.
+        due_at = datetime.strptime(item['sk'][:19], time_fmt)
+        return {
+            'pk': cls.queue_bucket(item['sk']),
+            'sk': f'{item["sk"]}#{item["id"]}',
+            'id': item['id'],
+            'user_id': item['user_id'],
+            'ttl': calendar.timegm(
+                (due_at + timedelta(days=days)).utctimetuple())
+        }
+
+    def enqueue(self):
+        # The due queue entry alone, for a message written while the queue
+        # was off
+        return self._create_item(self.queue_entry(
+            {'sk': self.key['sk'], 'id': self.id, 'user_id': self.user_id}))
+
+    def _create_queued_item(self, item, condition_exp=None):
+        # The entry goes first, an entry without its message is skipped
+        if due_queue:
+            self._create_item(self.queue_entry(item))
+        return self._create_item(self.encode(item), condition_exp)
+
+    @staticmethod
+    def encode(item):
+        # The form a message item is written in, see compact_messages
+        if not compact_messages:
+            return item
+        item = dict(item)
+        if item['pk'].endswith(f'#{item["id"]}'):
+            del item['id']
+        if item['time'] == item['sk']:
+            del item['time']
+        msg = item['msg'].encode()
+        if len(msg) > message_compress_bytes:
+            item['msg'] = Binary(zlib.compress(msg))
+        for name, short in compact_names.items():
+            if name in item:
+                item[short] = item.pop(name)
+        return item
+
+    @staticmethod
+    def decode(item):
+        # A message item as read, in either form, with the long names
+        item = dict(item)
+        for name, short in compact_names.items():
+            if short in item:
+                item[name] = item.pop(short)
+        if isinstance(item.get('msg'), Binary):
+            item['msg'] = zlib.decompress(item['msg'].value).decode()
+        if 'id' not in item and 'pk' in item:
+            item['id'] = item['pk'].partition('#')[2]
+        # Only dropped while it is a message's sort key
+        if 'time' not in item and item.get('pk', '').startswith('message#'):
+            item['time'] = item['sk']
+        return item
+
+    @classmethod
+    def new_item(cls, msg_id, user_id, time, msg, person, sk=None):
+        # The sort key is the time the sender should next try the message.
+        # It only differs from time once a send has been retried.
+        sk = sk or time
+        # Message IDs are uuid4 hex, so they spread evenly over the shards
+        shard = int(msg_id, 16) % due_shard_count
+        return {
+            'pk': f'message#{msg_id}',
+            'sk': sk,
+            'id': msg_id,
+            'msg': msg,
+            'person': person,
+            'user_id': user_id,
+            'time': time,
+            'due': cls.due_key(sk, shard),
+            'status': 'pending',
+            'attempts': 0,
+            'record_type': 'message'
+        }
+
+    @property
+    def key(self):
+        return {
             'pk': f'message#{self.id}',
+            'sk': getattr(self, 'sk', None) or self.time
+        }
+
+    def create(self):
+        # A given ID is written once. Creating it again leaves the message
+        # as it is, with created False.
+        self.id = self.id or self.get_uuid()
+        item = self.new_item(
+            self.id, self.user_id, self.time, self.msg, self.person)
+        resp = self._create_queued_item(item, 'attribute_not_exists(pk)')
+        self.created = resp != db_error
+        return self.get()
+
+    @classmethod
+    def batch_create(cls, table, user_id, messages):
+        # Write many messages for a user with a batch writer.
+        # messages is a list of dicts with time, msg and person keys, and
+        # optionally an id so that writing them again overwrites them.
+        items = [
+            cls.new_item(
+                m.get('id') or cls.get_uuid(), user_id, m['time'], m['msg'],
+                m['person'])
+            for m in messages
+        ]
+        entries = [cls.queue_entry(item) for item in items] \
+            if due_queue else []
+
+        def batch_write_item():
+            with table.batch_writer() as batch:
+                for item in entries + [cls.encode(i) for i in items]:
+                    batch.put_item(Item=item)
+        try:
+            # Puts are idempotent so a throttled batch is safe to resend
+            cls.retry_policy.call(batch_write_item)
+            return items
+        except Exception as e:
+            print(e)
+            return db_error
+
+    def get(self):
+        key_exp = Key('pk').eq(f'message#{self.id}')
+        resp = self._query_item(key_exp)
+        resp_items = resp.get('Items')
+        if resp_items:
+            resp_item = self.decode(resp_items[0])
+            self.is_valid = self._reflect_item_attrs(resp_item)
+            return resp_item
+        else:
+            return resp_items
+
+    def delete(self):
+        self._delete_item(self.key)
+        self.id = None,
+        self.user_id = None
+        self.sk = None
+        self.time = None
+        self.msg = None
+        self.person = None
+        self.is_valid = False
+        return True
+
+    def to_dict(self):
+        output = {}
+        output['id'] = self.id
+        output['time'] = self.time
+        output['msg'] = self.msg
+        output['person'] = self.person
+        return output
+
+    def claim(self, claim_id, lease=claim_lease_seconds):
+        # Conditionally take the message for one sender run and count the
+        # attempt. Fails if another run holds an unexpired claim. Returns
+        # True if the claim was won.
+        now = datetime.utcnow()
+        key = self.key
+        update_exp = ('SET claimed_by = :c, claim_expires = :e, '
+                      '#status = :claimed ADD attempts :one')
+        exp_attr_values = {
+            ':c': claim_id,
+            ':e': (now + timedelta(seconds=lease)).isoformat(),
+            ':now': now.isoformat(),
+            ':claimed': 'claimed',
+            ':one': 1
+        }
+        condition_exp = ('attribute_exists(pk) AND '
+                         '(attribute_not_exists(claimed_by) OR '
+                         'claim_expires < :now OR claimed_by = :c)')
+        resp = self._update_item(
+            key, update_exp, exp_attr_values, condition_exp,
+            {'#status': 'status'})
+        if 'Attributes' in resp:
+            self._reflect_item_attrs(self.decode(resp['Attributes']))
+            return True
+        return False
+
+    def reschedule(self, seconds, status='pending', error=None,
+                   attempted=True):
+        # Move the message's sort key, and so its place in the sender's
+        # indexes, to a later time. The claim is dropped with the old item.
+        # attempted=False gives back the attempt the claim counted, e.g.
+        # for a send that was rate limited.
+        retry_time = (
+            datetime.utcnow() + timedelta(seconds=seconds)).strftime(time_fmt)
+        old_key = self.key
+        item = self.new_item(
+            self.id, self.user_id, self.time, self.msg, self.person,
+            sk=retry_time)
+        item['status'] = status
+        item['attempts'] = int(getattr(self, 'attempts', 0))
+        if not attempted:
+            item['attempts'] = max(0, item['attempts'] - 1)
+        if error:
+            item['last_error'] = error[:500]
+        self._create_queued_item(item)
+        self._delete_item(old_key)
+        self._reflect_item_attrs(item)
+        return retry_time
+
+    def fail(self, error, attempts=max_send_attempts):
+        # Record a failed send. Retries back off exponentially, and after the
+        # last attempt the message moves to a dead letter record. Returns
+        # 'failed' or 'dead_letter'.
+        tried = int(getattr(self, 'attempts', 0))
+        if tried >= attempts:
+            self.dead_letter(error)
+            return 'dead_letter'
+        backoff = min(
+            retry_max_seconds, retry_base_seconds * 2 ** max(0, tried - 1))
+        self.reschedule(backoff, 'failed', error)
+        return 'failed'
+
+    def dead_letter(self, error):
+        item = self.new_item(
+            self.id, self.user_id, self.time, self.msg, self.person)
+        item['pk'] = f'deadletter#{self.id}'
+        item['sk'] = f'deadletter#{self.id}'
+        item['status'] = 'dead_letter'
+        item['attempts'] = int(getattr(self, 'attempts', 0))
+        item['last_error'] = error[:500]
+        item['record_type'] = 'dead_letter'
+        # Not in the sender's due index any more
+        del item['due']
+        self._create_item(self.encode(item))
+        return self.delete()
+
+    @property
+    def sent_key(self):
+        return {'pk': f'sent#{self.id}', 'sk': f'sent#{self.id}'}
+
+    def was_sent(self):
+        resp = self._get_item(self.sent_key)
+        return 'Item' in resp
+
+    def mark_sent(self, days=sent_record_days):
+        # Idempotency record written after a successful send. ttl lets
+        # DynamoDB expire it once overlapping runs are no longer possible.
+        now = datetime.utcnow()
+        item = dict(self.sent_key)
+        item['sent_at'] = now.isoformat()
+        item['status'] = 'sent'
+        item['ttl'] = calendar.timegm(
+            (now + timedelta(days=days)).utctimetuple())
+        item['record_type'] = 'sent'
+        resp = self._create_item(item, 'attribute_not_exists(pk)')
+        return not resp == db_error
+
+    @classmethod
+    def query_by_user(
+            cls,
+            table,
+            index_name,
+            user_id,
+            limit=default_page_size,
+            cursor=None,
+            fields=None,
+            descending=False,
+            after=None):
+        # One page of a user's messages due after the given UTC time, read
+        # from the user_id/sk index. Returns (items, next cursor).
+        after = after or datetime.utcnow().strftime(time_fmt)
+        key_cond_exp = (Key('user_id').eq(user_id) &
+                        Key('sk').between(after, max_time))
+        kwargs = {
+            'IndexName': index_name,
+            'KeyConditionExpression': key_cond_exp,
+            # Schedules share the index partition
+            'FilterExpression': Attr('record_type').eq('message'),
+            'Limit': min(int(limit), max_page_size),
+            'ScanIndexForward': not descending
+        }
+        if cursor:
+            kwargs['ExclusiveStartKey'] = cls.decode_cursor(cursor)
+        wanted = fields or message_fields
+        if fields:
+            # Key attributes are kept so the page can be resumed from them,
+            # and id and time may only be in the keys
+            projected = list(fields) + [
+                compact_names[f] for f in fields if f in compact_names]
+            projected += ['pk', 'sk', 'user_id']
+            names = {f'#f{i}': f for i, f in enumerate(projected)}
+            kwargs['ProjectionExpression'] = ', '.join(names)
+            kwargs['ExpressionAttributeNames'] = names
+        try:
+            resp = cls.retry_policy.call(table.query, **kwargs)
+        except Exception as e:
+            print(e)
+            return db_error, None
+        next_key = resp.get('LastEvaluatedKey')
+        next_cursor = cls.encode_cursor(next_key) if next_key else None
+        items = [{k: v for k, v in cls.decode(item).items() if k in wanted}
+                 for item in resp.get('Items', [])]
+        return items, next_cursor
+
+
+class ScheduleItem(Item):
+    # A recurring message. Only the next occurrence is indexed, listed as
+    # 'schedule' with the UTC fire time as the sort key, and the
+    # sender turns it into a MessageItem when it comes due.
+    def __init__(
+            self,
+            table=None,
+            schedule_id=None,
+            user_id=None,
+            start=None,
+            timezone=None,
+            msg=None,
+            person=None,
+            freq=None,
+            interval=1,
+            until=None):
+        super().__init__(table)
+        self.id = schedule_id
+        self.user_id = user_id
+        self.start = start
+        self.timezone = timezone
+        self.msg = msg
+        self.person = person
+        self.freq = freq
+        self.interval = interval
+        self.until = until
+        self.occurrence = 0
+        self.time = None
+        self.is_valid = False
+        if user_id and start and timezone and msg and person and freq:
+            self.create()
+        elif schedule_id:
+            self.get()
+
+    @staticmethod
+    def add_months(dt, months):
+        # Clamp the day so Jan 31 plus a month is the last day of Feb
+        month = dt.month - 1 + months
+        year = dt.year + month // 12
+        month = month % 12 + 1
+        day = min(dt.day, calendar.monthrange(year, month)[1])
+        return dt.replace(year=year, month=month, day=day)
+
+    @classmethod
+    def occurrence_time(cls, start, freq, interval, n):
+        # Local datetime string of the nth occurrence, counted from start
+        start = datetime.fromisoformat(start)
+        if freq == 'daily':
+            local = start + timedelta(days=n * interval)
+        elif freq == 'weekly':
+            local = start + timedelta(weeks=n * interval)
+        elif freq == 'monthly':
+            local = cls.add_months(start, n * interval)
+        else:
+            raise ValueError(f'Unsupported frequency: {freq}')
+        return local.strftime(time_fmt)
+
+    def fire_time(self, n):
+        # UTC fire time of the nth occurrence, or None after until
+        local = self.occurrence_time(
+            self.start, self.freq, int(self.interval), n)
+        if self.until and local > self.until:
+            return None
+        return self.to_utc(local, self.timezone)
+
+    def _item(self):
+        return {
+            'pk': f'schedule#{self.id}',
             'sk': self.time,
             'id': self.id,
             'msg': self.msg,
             'person': self.person,
             'user_id': self.user_id,
             'time': self.time,
-            'record_type': 'message'
+            'start': self.start,
+            'timezone': self.timezone,
+            'freq': self.freq,
+            'interval': int(self.interval),
+            'until': self.until,
+            'occurrence': int(self.occurrence),
+            'record_type': 'schedule',
+            'listed': 'schedule'
         }
-        self._create_item(item)
+
+    def create(self):
+        if self.freq not in schedule_frequencies:
+            raise ValueError(f'Unsupported frequency: {self.freq}')
+        self.id = self.get_uuid()
+        self.time = self.fire_time(0)
+        self._create_item(self._item())
         return self.get()
 
     def get(self):
-        key_exp = Key('pk').eq(f'message#{self.id}')
+        key_exp = Key('pk').eq(f'schedule#{self.id}')
         resp = self._query_item(key_exp)
         resp_items = resp.get('Items')
         if resp_items:
@@ -360,19 +1072,32 @@ class MessageItem(Item):
         else:
             return resp_items
 
+    def advance(self, after):
+        # Move the index entry to the first occurrence after the given UTC
+        # datetime string. Returns False once the schedule has run out.
+        old_key = {'pk': f'schedule#{self.id}', 'sk': self.time}
+        n = int(self.occurrence) + 1
+        time = self.fire_time(n)
+        while time and time <= after:
+            n += 1
+            time = self.fire_time(n)
+        if not time:
+            self.delete()
+            return False
+        self.occurrence = n
+        self.time = time
+        self._create_item(self._item())
+        self._delete_item(old_key)
+        return True
+
     def delete(self):
         key = {
-            'pk': f'message#{self.id}',
+            'pk': f'schedule#{self.id}',
             'sk': self.time
         }
-        self._delete_item(key)
-        self.id = None,
-        self.user_id = None
-        self.time = None
-        self.msg = None
-        self.person = None
+        resp = self._delete_item(key)
         self.is_valid = False
-        return True
+        return resp
 
     def to_dict(self):
         output = {}
@@ -380,4 +1105,97 @@ class MessageItem(Item):
         output['time'] = self.time
         output['msg'] = self.msg
         output['person'] = self.person
+        output['freq'] = self.freq
+        output['interval'] = int(self.interval)
+        output['until'] = self.until
         return output
+
+
+class DeleteUserJob(Item):
+    # Resumable deletion of everything a user owns. Keys are streamed a page
+    # at a time from the user_id index and batch deleted, and the position
+    # is checkpointed on the job record so the sender can finish the job
+    # if the request runs out of time.
+    def __init__(self, table=None, user_id=None):
+        super().__init__(table)
+        self.id = user_id
+        self.cursor = None
+        self.is_valid = False
+        if user_id:
+            self.get()
+
+    @property
+    def key(self):
+        return {
+            'pk': f'job#delete_user#{self.id}',
+            'sk': f'job#delete_user#{self.id}'
+        }
+
+    def create(self):
+        item = dict(self.key)
+        # Not named user_id, the job must not show up in the user's index
+        item['target_id'] = self.id
+        item['job_type'] = 'delete_user'
+        item['created'] = datetime.utcnow().isoformat()
+        item['record_type'] = 'job'
+        item['listed'] = 'job'
+        self._create_item(item)
+        return self.get()
+
+    def get(self):
+        resp = self._get_item(self.key)
+        resp_item = resp.get('Item')
+        if resp_item:
+            self.is_valid = True
+            self.cursor = resp_item.get('last_key')
+            return resp_item
+        else:
+            return resp
+
+    def checkpoint(self, cursor):
+        self.cursor = cursor
+        update_exp = 'SET last_key = :i'
+        exp_attr_values = {':i': cursor}
+        self._update_item(self.key, update_exp, exp_attr_values)
+
+    def _delete_page(self, index_name):
+        kwargs = {
+            'IndexName': index_name,
+            'KeyConditionExpression': Key('user_id').eq(self.id),
+            'ProjectionExpression': 'pk, sk, user_id',
+            'Limit': delete_page_size
+        }
+        if self.cursor:
+            kwargs['ExclusiveStartKey'] = self.decode_cursor(self.cursor)
+        resp = self.retry_policy.call(self.table.query, **kwargs)
+
+        def batch_write_item():
+            with self.table.batch_writer() as batch:
+                for item in resp.get('Items', []):
+                    batch.delete_item(
+                        Key={'pk': item['pk'], 'sk': item['sk']})
+        self.retry_policy.call(batch_write_item)
+        next_key = resp.get('LastEvaluatedKey')
+        return self.encode_cursor(next_key) if next_key else None
+
+    def run(self, index_name, time_left=None, reserve_ms=delete_reserve_ms):
+        # time_left returns the milliseconds left in the invocation. Returns
+        # True when the user is gone, False when there is more to do.
+        if not self.is_valid:
+            self.create()
+        try:
+            while True:
+                cursor = self._delete_page(index_name)
+                if not cursor:
+                    break
+                self.checkpoint(cursor)
+                if time_left and time_left() < reserve_ms:
+                    return False
+        except Exception as e:
+            print(e)
+            return False
+        self._delete_item(
+            {'pk': f'userid#{self.id}', 'sk': f'userid#{self.id}'})
+        self._delete_item(self.key)
+        self.is_valid = False
+        return True
@@ -0,0 +1,74 @@
+from collections import Counter
+from . import SessionItem, UserItem
+
+
+class RequestContext(object):
+    # Per request loader for the session, the user and anything else a
+    # route reads. Each value is loaded at most once and the loads are
+    # counted, so a route's DynamoDB reads can be checked against a budget.
+    # With session snapshots on, user is usually read from the session.
+    def __init__(self, table_factory, session_id=None):
+        self.table_factory = table_factory
+        self.session_id = session_id
+        self.loaded = {}
+        self.loads = Counter()
+        self._table = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.table_factory()
+        return self._table
+
+    def load(self, name, fn):
+        # fn(table) is only called the first time name is asked for
+        if name not in self.loaded:
+            self.loaded[name] = fn(self.table)
+            self.loads[name] += 1
+        return self.loaded[name]
+
+    def load_many(self, **loaders):
+        # Run the loaders that are not loaded yet, one after the other on
+        # the request's table. Threads would each need their own resource,
+        # and a new resource and connection cost more than the few single
+        # item reads a route needs.
+        for name, fn in loaders.items():
+            self.load(name, fn)
+        return {name: self.loaded[name] for name in loaders}
+
+    def load_session(self, table):
+        return SessionItem(table=table, session_id=self.session_id)
+
+    def load_user(self, table):
+        # From the session's snapshot when there is one, without a read
+        snapshot = getattr(self.session, 'user_snapshot', None)
+        if UserItem.session_snapshot and snapshot:
+            return UserItem.from_snapshot(
+                table, self.session.user_id, self.session.id, snapshot)
+        return self.load_full_user(table)
+
+    def load_full_user(self, table):
+        return UserItem(table=table, user_id=self.session.user_id)
+
+    @property
+    def session(self):
+        return self.load('session', self.load_session)
+
+    @property
+    def user(self):
+        return self.load('user', self.load_user)
+
+    @property
+    def full_user(self):
+        # The whole user item, for routes that need more than the snapshot
+        user = self.loaded.get('user')
+        if user is not None and not user.is_snapshot:
+            return user
+        return self.load('full_user', self.load_full_user)
+
+    def session_expired(self):
+        # Expired sessions are deleted the first time they are seen
+        if self.session.expired:
+            self.session.delete()
+            return True
+        return False
@@ -0,0 +1,199 @@
+import contextlib
+import boto3
+from boto3.dynamodb.conditions import ConditionBase
+from .retry import botocore_config
+
+
+# Record types that can be given their own table. Records that only
+# support another type are kept with it, e.g. sent# with messages.
+record_types = ('user', 'session', 'state', 'message', 'schedule', 'job',
+                'queue')
+# pk prefixes and record_type values by the record type they belong to
+kinds = {
+    'userid': 'user',
+    'user': 'user',
+    'refresh': 'user',
+    'sessionid': 'session',
+    'session': 'session',
+    'state': 'state',
+    'nonce': 'state',
+    'message': 'message',
+    'sent': 'message',
+    'deadletter': 'message',
+    'dead_letter': 'message',
+    'schedule': 'schedule',
+    'job': 'job',
+    'due': 'queue'
+}
+# Record types only read by key, whose tables need no indexes. They are
+# left out of index queries over every table, e.g. a user's items, and
+# expire by ttl.
+keyed_only = ('queue',)
+# Marks which table a fanned out query's LastEvaluatedKey came from
+table_marker = '_table'
+
+
+def parse_routes(routes):
+    # e.g. 'session=mindful-sessions,state=mindful-sessions'
+    parsed = {}
+    for route in (routes or '').split(','):
+        if not route.strip():
+            continue
+        kind, _, name = (part.strip() for part in route.partition('='))
+        if kind not in record_types or not name:
+            raise ValueError(f'Invalid table route: {route}')
+        parsed[kind] = name
+    return parsed
+
+
+def kind_of_pk(pk):
+    return kinds.get(pk.split('#')[0])
+
+
+def equals_values(condition):
+    # {attribute: value} for the equality parts of a condition, through ANDs
+    values = {}
+    if not isinstance(condition, ConditionBase):
+        return values
+    expression = condition.get_expression()
+    if expression['operator'] == '=':
+        attribute, value = expression['values']
+        values[attribute.name] = value
+    elif expression['operator'] == 'AND':
+        for part in expression['values']:
+            values.update(equals_values(part))
+    return values
+
+
+class TableRouter(object):
+    # Maps record types to tables. Types without a route use the default.
+    def __init__(self, default_table_name, routes=None,
+                 resource_factory=None):
+        self.default_table_name = default_table_name
+        if isinstance(routes, dict):
+            self.routes = dict(routes)
+        else:
+            self.routes = parse_routes(routes)
+        self.resource_factory = resource_factory or (
+            lambda: boto3.resource('dynamodb', config=botocore_config))
+
+    def table_name(self, kind):
+        return self.routes.get(kind, self.default_table_name)
+
+    @property
+    def table_names(self):
+        # Every table in use, the default first
+        names = [self.default_table_name]
+        for kind in record_types:
+            if self.table_name(kind) not in names:
+                names.append(self.table_name(kind))
+        return names
+
+    def table(self):
+        # Like boto3 resources, not to be shared between threads. A plain
+        # table while everything is in one.
+        dynamodb = self.resource_factory()
+        if len(self.table_names) == 1:
+            return dynamodb.Table(self.default_table_name)
+        return RoutedTable(self, dynamodb)
+
+
+class RoutedTable(object):
+    # Stands in for a boto3 Table, sending each call to the table of the
+    # record type it is for
+    def __init__(self, router, dynamodb):
+        self.router = router
+        self.dynamodb = dynamodb
+        self.tables = {}
+        self.name = router.default_table_name
+
+    def table_for(self, kind):
+        name = self.router.table_name(kind)
+        if name not in self.tables:
+            self.tables[name] = self.dynamodb.Table(name)
+        return self.tables[name]
+
+    def table_for_key(self, key):
+        return self.table_for(kind_of_pk(key['pk']))
+
+    def put_item(self, **kwargs):
+        return self.table_for_key(kwargs['Item']).put_item(**kwargs)
+
+    def get_item(self, **kwargs):
+        return self.table_for_key(kwargs['Key']).get_item(**kwargs)
+
+    def update_item(self, **kwargs):
+        return self.table_for_key(kwargs['Key']).update_item(**kwargs)
+
+    def delete_item(self, **kwargs):
+        return self.table_for_key(kwargs['Key']).delete_item(**kwargs)
+
+    def batch_writer(self):
+        return RoutedBatchWriter(self)
+
+    def query_tables(self, kwargs):
+        keys = equals_values(kwargs.get('KeyConditionExpression'))
+        if 'pk' in keys:
+            query_kinds = [kind_of_pk(keys['pk'])]
+        elif 'listed' in keys:
+            query_kinds = [kinds.get(keys['listed'])]
+        elif 'due' in keys:
+            query_kinds = ['message']
+        else:
+            # e.g. a user's items, narrowed by a record_type filter
+            record_type = equals_values(
+                kwargs.get('FilterExpression')).get('record_type')
+            query_kinds = [kinds.get(record_type)] if record_type \
+                else [k for k in record_types if k not in keyed_only]
+        tables = []
+        for kind in query_kinds:
+            if self.table_for(kind) not in tables:
+                tables.append(self.table_for(kind))
+        return tables
+
+    def query(self, **kwargs):
+        tables = self.query_tables(kwargs)
+        if len(tables) == 1:
+            return tables[0].query(**kwargs)
+        # One table per page. The LastEvaluatedKey says which table it is
+        # from, and once a table is done it points at the next one.
+        names = [table.name for table in tables]
+        start = dict(kwargs.pop('ExclusiveStartKey', None) or {})
+        index = names.index(start.pop(table_marker, names[0]))
+        if start:
+            kwargs['ExclusiveStartKey'] = start
+        resp = tables[index].query(**kwargs)
+        last_key = resp.get('LastEvaluatedKey')
+        if last_key:
+            resp['LastEvaluatedKey'] = dict(
+                last_key, **{table_marker: names[index]})
+        elif index + 1 < len(names):
+            resp['LastEvaluatedKey'] = {table_marker: names[index + 1]}
+        return resp
+
+
+class RoutedBatchWriter(object):
+    # A batch writer per table, opened on first use and flushed on exit
+    def __init__(self, routed_table):
+        self.routed_table = routed_table
+        self.writers = {}
+        self.stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.stack.__exit__(*exc_info)
+
+    def writer(self, key):
+        table = self.routed_table.table_for_key(key)
+        if table.name not in self.writers:
+            self.writers[table.name] = self.stack.enter_context(
+                table.batch_writer())
+        return self.writers[table.name]
+
+    def put_item(self, Item):
+        self.writer(Item).put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.writer(Key).delete_item(Key=Key)
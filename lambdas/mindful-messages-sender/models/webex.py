@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from webexteamssdk import WebexTeamsAPI
+from webexteamssdk.api.access_tokens import AccessTokensAPI
+from webexteamssdk.exceptions import RateLimitError
+from webexteamssdk.models.immutable import immutable_data_factory
+from .retry import TokenBucket
+from .tracing import span
+
+
+# Webex API base URL, pointed at a fake server in tests
+webex_base_url = os.environ.get('WEBEX_BASE_URL', 'https://webexapis.com/v1/')
+# Client side limits, per access token and across the whole process
+token_requests_per_second = 5.0
+global_requests_per_second = 50.0
+# Clients kept warm, each holds a requests.Session with pooled connections
+max_clients = 64
+
+
+def access_tokens_api(base_url=webex_base_url):
+    return AccessTokensAPI(base_url, immutable_data_factory)
+
+
+def exchange_code(client_id, client_secret, code, redirect_uri,
+                  base_url=webex_base_url):
+    # Trade an OAuth code for tokens. Unlike WebexTeamsAPI(oauth_code=...)
+    # this keeps the refresh token and the expiry times.
+    with span('webex.access_tokens.get'):
+        return access_tokens_api(base_url).get(
+            client_id=client_id,
+            client_secret=client_secret,
+            code=code,
+            redirect_uri=redirect_uri)
+
+
+def refresh_access_token(client_id, client_secret, refresh_token,
+                         base_url=webex_base_url):
+    with span('webex.access_tokens.refresh'):
+        return access_tokens_api(base_url).refresh(
+            client_id=client_id,
+            client_secret=client_secret,
+            refresh_token=refresh_token)
+
+
+class WebexRateLimited(Exception):
+    # Raised instead of sleeping when Webex asks us to back off
+    def __init__(self, token, retry_after):
+        super().__init__(f'Rate limited, retry after {retry_after}s')
+        self.token = token
+        self.retry_after = retry_after
+
+
+class WebexClientPool(object):
+    # Shares one WebexTeamsAPI per access token so HTTP connections are
+    # reused, and limits request rates per token and globally. A 429 blocks
+    # the token until its Retry-After has passed.
+    def __init__(
+            self,
+            base_url=webex_base_url,
+            token_rate=token_requests_per_second,
+            global_rate=global_requests_per_second,
+            size=max_clients,
+            clock=time.monotonic,
+            sleep=time.sleep):
+        self.base_url = base_url
+        self.token_rate = token_rate
+        self.size = size
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(
+            rate=global_rate, clock=clock, sleep=sleep)
+        self.clients = OrderedDict()
+        self.buckets = {}
+        self.blocked_until = {}
+        self.lock = threading.Lock()
+
+    def _get(self, token):
+        with self.lock:
+            if token in self.clients:
+                self.clients.move_to_end(token)
+                return self.clients[token], self.buckets[token]
+            client = WebexTeamsAPI(
+                access_token=token,
+                base_url=self.base_url,
+                wait_on_rate_limit=False)
+            bucket = TokenBucket(
+                rate=self.token_rate, clock=self.clock, sleep=self.sleep)
+            self.clients[token] = client
+            self.buckets[token] = bucket
+            # Drop the least recently used client
+            if len(self.clients) > self.size:
+                old_token, _ = self.clients.popitem(last=False)
+                self.buckets.pop(old_token, None)
+                self.blocked_until.pop(old_token, None)
+            return client, bucket
+
+    def get_client(self, token):
+        return self._get(token)[0]
+
+    def retry_after(self, token):
+        # Seconds until the token may be used again, 0 if it is not blocked
+        blocked_until = self.blocked_until.get(token, 0)
+        return max(0, blocked_until - self.clock())
+
+    def call(self, token, fn, name='call'):
+        # Run fn(api) for the token. Raises WebexRateLimited without calling
+        # Webex if the token is still blocked by an earlier 429.
+        with span(f'webex.{name}'):
+            client, bucket = self._get(token)
+            wait = self.retry_after(token)
+            if wait:
+                raise WebexRateLimited(token, wait)
+            self.global_bucket.acquire()
+            bucket.acquire()
+            try:
+                resp = fn(client)
+            except RateLimitError as e:
+                self.blocked_until[token] = self.clock() + e.retry_after
+                bucket.throttled()
+                raise WebexRateLimited(token, e.retry_after)
+            # A throttled token creeps back up to its rate
+            bucket.succeeded()
+            return resp
+
+
+default_pool = WebexClientPool()
@@ -0,0 +1,73 @@
+import json
+import boto3
+from datetime import datetime, timedelta
+
+
+# Same format as the message times, e.g. 2021-12-09T16:05:00
+wakeup_fmt = '%Y-%m-%dT%H:%M:00'
+
+
+def wakeup_time(next_due_at):
+    # Round up to the whole minute, a wakeup must never be early
+    due = datetime.fromisoformat(next_due_at)
+    if due.second or due.microsecond:
+        due = due.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    return due.strftime(wakeup_fmt)
+
+
+class EventBridgeScheduler(object):
+    # Keeps one named one-shot EventBridge Scheduler schedule that invokes
+    # the sender at the next due time. The schedule deletes itself after it
+    # fires, the sender's fixed schedule keeps running as a safety net.
+    def __init__(self, name, target_arn, role_arn, client=None):
+        self.name = name
+        self.target_arn = target_arn
+        self.role_arn = role_arn
+        self.client = client or boto3.client('scheduler')
+
+    def schedule(self, at):
+        kwargs = {
+            'Name': self.name,
+            'ScheduleExpression': f'at({at})',
+            'ScheduleExpressionTimezone': 'UTC',
+            'FlexibleTimeWindow': {'Mode': 'OFF'},
+            'ActionAfterCompletion': 'DELETE',
+            'Target': {
+                'Arn': self.target_arn,
+                'RoleArn': self.role_arn,
+                'Input': json.dumps({'source': 'wakeup', 'time': at})
+            }
+        }
+        try:
+            self.client.update_schedule(**kwargs)
+        except self.client.exceptions.ResourceNotFoundException:
+            self.client.create_schedule(**kwargs)
+        return at
+
+
+class LocalScheduler(object):
+    # In process stand-in for EventBridge Scheduler, for tests and running
+    # locally. Like the real one it holds a single pending wakeup.
+    def __init__(self):
+        self.at = None
+        self.wakeups = []
+
+    def schedule(self, at):
+        self.at = at
+        self.wakeups.append(at)
+        return at
+
+    def pop_due(self, now):
+        # The pending wakeup time if it has fired by now, once
+        if self.at and self.at <= now.strftime(wakeup_fmt):
+            at, self.at = self.at, None
+            return at
+        return None
+
+
+def get_scheduler(name, target_arn=None, role_arn=None):
+    if name == 'memory':
+        return LocalScheduler()
+    if name and target_arn and role_arn:
+        return EventBridgeScheduler(name, target_arn, role_arn)
+    return None
@@ -0,0 +1,528 @@
+import os
+import boto3
+import threading
+from unittest import TestCase, mock
+from datetime import datetime, timedelta
+from moto import mock_dynamodb2
+from boto3.dynamodb.conditions import Key
+from botocore.stub import Stubber
+from models import UserItem, MessageItem, ScheduleItem
+from models import due_queue_cursor_key
+from dispatch import MemoryQueue
+from scheduler import LocalScheduler, EventBridgeScheduler, wakeup_time
+from scheduler import get_scheduler
+from fake_webex import FakeWebex
+from models.webex import WebexClientPool
+
+
+@mock_dynamodb2
+class TestLambdaFunction(TestCase):
+    def setUp(self):
+        # Mock environmental variables setup
+        self.table_name = 'test-table'
+        self.index_name = 'listed-index'
+        self.env_vars = {
+            'TABLE_NAME': self.table_name,
+            'INDEX_NAME': self.index_name,
+            'APP_NAME': 'test_app'
+        }
+        self.env_patch = mock.patch.dict(os.environ, self.env_vars)
+        self.env_patch.start()
+        import lambda_function
+        self.lambda_function = lambda_function
+        # Mock DynamoDB table setup, with the index the sender queries
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName=self.table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'pk',
+                    'KeyType': 'HASH'  # Partition key
+                },
+                {
+                    'AttributeName': 'sk',
+                    'KeyType': 'RANGE'  # Sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'pk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'sk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'listed',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'due',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': self.index_name,
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'listed',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'sk',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 1,
+                        'WriteCapacityUnits': 1
+                    }
+                },
+                {
+                    'IndexName': 'due-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'due',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'sk',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 1,
+                        'WriteCapacityUnits': 1
+                    }
+                }
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        self.table.meta.client.get_waiter('table_exists').wait(
+            TableName=self.table_name)
+        # Mock DB items setup
+        self.wbx_person = mock.Mock()
+        self.wbx_person.id = '123'
+        self.wbx_person.nickName = 'Test'
+        self.user_item = UserItem(
+            table=self.table, wbx_person=self.wbx_person, wbx_token='123')
+        # Fake Webex server setup
+        self.webex = FakeWebex().start()
+        self.pool_patch = mock.patch(
+            'lambda_function.default_pool',
+            WebexClientPool(base_url=self.webex.base_url))
+        self.pool_patch.start()
+
+    def tearDown(self):
+        self.pool_patch.stop()
+        self.webex.stop()
+        self.env_patch.stop()
+        self.table.delete()
+        self.dynamodb = None
+
+    def test_expand_schedules(self):
+        schedule_item = ScheduleItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            start='2030-01-01T09:00:00',
+            timezone='UTC',
+            msg='Stand up',
+            person='test@domain.com',
+            freq='daily')
+        self.user_item.add_schedule(schedule_item.id)
+        now = datetime(2030, 1, 1, 9, 5)
+        expanded = self.lambda_function.expand_schedules(
+            self.table, self.index_name, now)
+        self.assertEqual(expanded, 1)
+        # One message for today, the schedule moves on to tomorrow
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(len(user_item.messages), 1)
+        message_item = MessageItem(
+            table=self.table, msg_id=user_item.messages[0])
+        self.assertEqual(message_item.time, '2030-01-01T09:00:00')
+        schedule_item.get()
+        self.assertEqual(schedule_item.time, '2030-01-02T09:00:00')
+        # Nothing else is due this hour
+        self.assertEqual(self.lambda_function.expand_schedules(
+            self.table, self.index_name, now), 0)
+
+    def test_expand_schedules_overlapping(self):
+        schedule_item = ScheduleItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            start='2030-01-01T08:00:00',
+            timezone='UTC',
+            msg='Stand up',
+            person='test@domain.com',
+            freq='daily')
+        self.user_item.add_schedule(schedule_item.id)
+        now = datetime(2030, 1, 1, 9, 5)
+        # A second run reads the schedule before the first advances it
+        with mock.patch.object(ScheduleItem, 'advance', return_value=True):
+            self.assertEqual(self.lambda_function.expand_schedules(
+                self.table, self.index_name, now), 1)
+        self.assertEqual(self.lambda_function.expand_schedules(
+            self.table, self.index_name, now + timedelta(seconds=30)), 0)
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(len(user_item.messages), 1)
+        messages = self.lambda_function.get_msgs_by_due_shards(
+            lambda: self.table, 'due-index', '2030-01-01T09:')
+        self.assertEqual([m['time'] for m in messages],
+                         ['2030-01-01T09:00:00'])
+        schedule_item.get()
+        self.assertEqual(schedule_item.time, '2030-01-02T08:00:00')
+
+    def test_get_msgs_by_due_shards(self):
+        times = ['2030-01-01T09:%02d:00' % m for m in range(0, 60, 5)]
+        for time in reversed(times):
+            MessageItem(
+                table=self.table,
+                user_id=self.user_item.id,
+                time=time,
+                msg='Test',
+                person='test@domain.com')
+        MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2030-01-01T10:00:00',
+            msg='Next hour',
+            person='test@domain.com')
+        msgs = self.lambda_function.get_msgs_by_due_shards(
+            lambda: self.table, 'due-index', '2030-01-01T09:')
+        self.assertEqual([msg['time'] for msg in msgs], times)
+        self.assertGreater(len({msg['due'] for msg in msgs}), 1)
+        # As the handler runs it, with a table per pool thread
+        with mock.patch.object(
+                self.lambda_function, 'thread_tables', threading.local()):
+            msgs = self.lambda_function.get_msgs_by_due_shards(
+                self.lambda_function.thread_table, 'due-index',
+                '2030-01-01T09:')
+            self.assertEqual([msg['time'] for msg in msgs], times)
+            table = self.lambda_function.thread_table()
+            self.assertIs(self.lambda_function.thread_table(), table)
+            other = self.lambda_function.shard_pool.submit(
+                self.lambda_function.thread_table).result()
+            self.assertIsNot(other.meta.client, table.meta.client)
+
+    def test_due_queue(self):
+        with mock.patch('models.due_queue', True), \
+                mock.patch('lambda_function.due_queue', True):
+            # A message already due goes out on the next run
+            message_item = MessageItem(
+                table=self.table,
+                user_id=self.user_item.id,
+                time='2020-01-01T09:00:00',
+                msg='Test',
+                person='test@domain.com')
+            self.user_item.add_message(message_item.id)
+            with mock.patch('lambda_function.get_table',
+                            return_value=self.table):
+                counts = self.lambda_function.lambda_handler({}, None)
+            self.assertEqual(counts['sent count'], 1)
+            self.assertFalse(MessageItem(
+                table=self.table, msg_id=message_item.id).is_valid)
+            self.table.delete_item(Key=due_queue_cursor_key)
+            for time in ('2030-01-01T09:00:00', '2030-01-01T09:05:00',
+                         '2030-01-01T09:05:30', '2030-01-01T09:20:00'):
+                MessageItem(
+                    table=self.table,
+                    user_id=self.user_item.id,
+                    time=time,
+                    msg='Test',
+                    person='test@domain.com')
+            now = datetime(2030, 1, 1, 9, 5, 10)
+            msgs, drained = self.lambda_function.get_msgs_by_due_queue(
+                self.table, now)
+            self.assertEqual([msg['sk'] for msg in msgs],
+                             ['2030-01-01T09:00:00', '2030-01-01T09:05:00'])
+            # The last two minutes are read again next run
+            self.assertEqual(drained, '2030-01-01T09:03')
+            self.lambda_function.clear_due_queue(self.table, msgs, drained)
+            now += timedelta(minutes=1)
+            self.assertEqual(
+                self.lambda_function.due_queue_buckets(drained, now),
+                ['2030-01-01T09:04', '2030-01-01T09:05', '2030-01-01T09:06'])
+            msgs, drained = self.lambda_function.get_msgs_by_due_queue(
+                self.table, now)
+            self.assertEqual([msg['sk'] for msg in msgs],
+                             ['2030-01-01T09:05:30'])
+            self.assertEqual(drained, '2030-01-01T09:04')
+
+    def test_jobs_after_dispatch(self):
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time=datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'),
+            msg='Test',
+            person='test@domain.com')
+        self.user_item.add_message(message_item.id)
+
+        def resume_jobs(table, index_name, time_left):
+            # Sent before deletions get the rest of the run
+            self.assertFalse(MessageItem(
+                table=self.table, msg_id=message_item.id).is_valid)
+            return 1
+        with mock.patch('lambda_function.get_table',
+                        return_value=self.table), \
+                mock.patch('lambda_function.resume_jobs',
+                           side_effect=resume_jobs) as resume:
+            counts = self.lambda_function.lambda_handler({}, None)
+        self.assertEqual(counts['sent count'], 1)
+        self.assertEqual(counts['job count'], 1)
+        resume.assert_called_once()
+
+    def test_next_due_wakeup(self):
+        now = datetime.utcnow()
+        due = (now + timedelta(minutes=5)).replace(second=30, microsecond=0)
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time=due.isoformat(),
+            msg='Test',
+            person='test@domain.com')
+        ScheduleItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            start=(now + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S'),
+            timezone='UTC',
+            msg='Stand up',
+            person='test@domain.com',
+            freq='daily')
+        scheduler = LocalScheduler()
+        with mock.patch('lambda_function.get_table',
+                        return_value=self.table), \
+                mock.patch('lambda_function.wakeup_scheduler', scheduler):
+            counts = self.lambda_function.lambda_handler({}, None)
+        self.assertEqual(counts['next due at'], message_item.time)
+        # Woken on the minute after the message is due
+        wakeup = (due + timedelta(seconds=30)).isoformat()
+        self.assertEqual(counts['wakeup at'], wakeup)
+        self.assertIsNone(scheduler.pop_due(now))
+        self.assertEqual(scheduler.pop_due(now + timedelta(minutes=6)), wakeup)
+        self.assertIsNone(scheduler.pop_due(now + timedelta(minutes=6)))
+
+    def test_next_due_at(self):
+        for time in ('2030-01-01T10:30:00', '2030-01-01T10:45:00',
+                     '2030-01-01T12:00:00'):
+            MessageItem(
+                table=self.table,
+                user_id=self.user_item.id,
+                time=time,
+                msg='Test',
+                person='test@domain.com')
+        ScheduleItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            start='2030-01-01T10:50:00',
+            timezone='UTC',
+            msg='Stand up',
+            person='test@domain.com',
+            freq='daily')
+        # Messages are only read from the due shards
+        resp = self.table.query(
+            IndexName=self.index_name,
+            KeyConditionExpression=Key('listed').eq('message'))
+        self.assertEqual(resp['Items'], [])
+
+        def next_due_at(now):
+            return self.lambda_function.get_next_due_at(
+                lambda: self.table, self.index_name, 'due-index', now)
+        self.assertEqual(next_due_at(datetime(2030, 1, 1, 9, 5)),
+                         '2030-01-01T10:30:00')
+        self.assertEqual(next_due_at(datetime(2030, 1, 1, 10, 40)),
+                         '2030-01-01T10:45:00')
+        self.assertEqual(next_due_at(datetime(2030, 1, 1, 10, 46)),
+                         '2030-01-01T10:50:00')
+        # Beyond the next hour
+        self.assertIsNone(next_due_at(datetime(2030, 1, 1, 7, 0)))
+
+    def test_refresh_tokens(self):
+        oauth_token = mock.Mock(
+            access_token='456', expires_in=3600,
+            refresh_token='789', refresh_token_expires_in=7776000)
+        self.user_item.update_oauth_token(oauth_token)
+        refresh_at = self.user_item.refresh_at
+        # A user who can only renew by logging in again
+        wbx_person = mock.Mock(id='456', nickName='Old')
+        old_user_item = UserItem(
+            table=self.table, wbx_person=wbx_person, wbx_token='123')
+        old_user_item.refresh_at = refresh_at
+        old_user_item._create_refresh_record()
+        now = datetime.utcnow()
+        with mock.patch.multiple(
+                'lambda_function', client_id='123', client_secret='123',
+                webex_base_url=self.webex.base_url):
+            # Not due yet
+            self.assertEqual(self.lambda_function.refresh_tokens(
+                self.table, self.index_name, now), 0)
+            self.assertEqual(self.lambda_function.refresh_tokens(
+                self.table, self.index_name, now + timedelta(hours=1)), 1)
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(user_item.wbx_token, 'token-r')
+        self.assertGreater(user_item.refresh_at, refresh_at)
+        self.assertEqual(UserItem.refresh_due(
+            self.table, self.index_name,
+            (now + timedelta(hours=1)).isoformat()), [])
+
+    def test_wakeup_time(self):
+        self.assertEqual(
+            wakeup_time('2030-01-01T09:17:00'), '2030-01-01T09:17:00')
+        self.assertEqual(
+            wakeup_time('2030-01-01T09:17:01'), '2030-01-01T09:18:00')
+        self.assertEqual(
+            wakeup_time('2030-01-01T23:59:30'), '2030-01-02T00:00:00')
+
+    def test_eventbridge_scheduler(self):
+        # The pinned botocore must know EventBridge Scheduler
+        self.assertIsInstance(
+            get_scheduler('wakeup', 'arn:target', 'arn:role'),
+            EventBridgeScheduler)
+        client = boto3.client('scheduler', region_name='us-east-1')
+        scheduler = EventBridgeScheduler(
+            'wakeup', 'arn:target', 'arn:role', client=client)
+        schedule = {
+            'Name': 'wakeup',
+            'ScheduleExpression': 'at(2030-01-01T09:05:00)',
+            'ScheduleExpressionTimezone': 'UTC',
+            'FlexibleTimeWindow': {'Mode': 'OFF'},
+            'ActionAfterCompletion': 'DELETE',
+            'Target': {
+                'Arn': 'arn:target',
+                'RoleArn': 'arn:role',
+                'Input': '{"source": "wakeup", "time": '
+                         '"2030-01-01T09:05:00"}'
+            }
+        }
+        arn = {'ScheduleArn': 'arn:aws:scheduler:us-east-1:1:schedule/wakeup'}
+        with Stubber(client) as stubber:
+            # Created the first time, updated after
+            stubber.add_client_error(
+                'update_schedule', 'ResourceNotFoundException',
+                expected_params=schedule)
+            stubber.add_response('create_schedule', arn, schedule)
+            stubber.add_response('update_schedule', arn, schedule)
+            self.assertEqual(scheduler.schedule('2030-01-01T09:05:00'),
+                             '2030-01-01T09:05:00')
+            self.assertEqual(scheduler.schedule('2030-01-01T09:05:00'),
+                             '2030-01-01T09:05:00')
+            stubber.assert_no_pending_responses()
+
+    def test_queue_fan_out(self):
+        good_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2020-01-01T09:00:00',
+            msg='Test',
+            person='good@domain.com')
+        bad_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2020-01-01T09:05:00',
+            msg='Test',
+            person='bad@domain.com')
+        msgs = self.lambda_function.get_msgs_by_due_shards(
+            lambda: self.table, 'due-index', '2020-01-01T09:')
+        queue = MemoryQueue()
+        queued = self.lambda_function.enqueue_due(
+            queue, msgs, datetime(2020, 1, 1, 9, 30))
+        self.assertEqual(queued, 2)
+        self.webex.unknown_emails.add('bad@domain.com')
+        with mock.patch('lambda_function.get_table', return_value=self.table):
+            event = queue.receive_event()
+            resp = self.lambda_function.worker_handler(event, None)
+        # The failed send is recorded on the message, not retried by SQS
+        self.assertEqual(resp['batchItemFailures'], [])
+        self.assertFalse(MessageItem(
+            table=self.table, msg_id=good_item.id).is_valid)
+        bad_item = MessageItem(table=self.table, msg_id=bad_item.id)
+        self.assertTrue(bad_item.is_valid)
+        self.assertEqual(bad_item.status, 'failed')
+        self.assertEqual(bad_item.attempts, 1)
+        self.assertIn('404', bad_item.last_error)
+        self.assertGreater(bad_item.sk, '2020-01-01T09:05:00')
+        # Not due again until the retry time
+        self.assertFalse(bad_item.expired)
+
+    def test_send_message_once(self):
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2020-01-01T09:00:00',
+            msg='Test',
+            person='test@domain.com')
+        # Held by another run
+        message_item.claim('other-run')
+        self.assertEqual(self.lambda_function.send_message(
+            self.table, message_item.id, self.user_item.id, 'run'), 'skipped')
+        # Sent by an earlier run that failed to clean up
+        message_item.claim('other-run', lease=-1)
+        message_item.mark_sent()
+        self.assertEqual(self.lambda_function.send_message(
+            self.table, message_item.id, self.user_item.id, 'run'), 'sent')
+        self.assertEqual(self.webex.messages, [])
+        self.assertFalse(MessageItem(
+            table=self.table, msg_id=message_item.id).is_valid)
+
+    def test_send_message_rate_limited(self):
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2020-01-01T09:00:00',
+            msg='Test',
+            person='test@domain.com')
+        self.webex.rate_limit_next(1, retry_after=60)
+        self.assertEqual(self.lambda_function.send_message(
+            self.table, message_item.id, self.user_item.id, 'run'),
+            'rescheduled')
+        # Moved past Retry-After, so it is not due yet and is not a failure
+        message_item = MessageItem(table=self.table, msg_id=message_item.id)
+        self.assertEqual(message_item.status, 'pending')
+        self.assertEqual(message_item.attempts, 0)
+        self.assertEqual(message_item.time, '2020-01-01T09:00:00')
+        self.assertFalse(message_item.expired)
+        self.assertEqual(self.lambda_function.send_message(
+            self.table, message_item.id, self.user_item.id, 'run'), 'skipped')
+        self.assertEqual(self.webex.messages, [])
+        # Refused by the pool without calling Webex, still not an attempt
+        message_item.reschedule(-60)
+        self.assertEqual(self.lambda_function.send_message(
+            self.table, message_item.id, self.user_item.id, 'run'),
+            'rescheduled')
+        message_item = MessageItem(table=self.table, msg_id=message_item.id)
+        self.assertEqual(message_item.attempts, 0)
+
+    def test_send_message_dead_letter(self):
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2020-01-01T09:00:00',
+            msg='Test',
+            person='bad@domain.com')
+        self.user_item.add_message(message_item.id)
+        self.webex.unknown_emails.add('bad@domain.com')
+        outcomes = []
+        for attempt in range(5):
+            # Make each retry due straight away
+            message_item = MessageItem(
+                table=self.table, msg_id=message_item.id)
+            message_item.reschedule(-60, message_item.status)
+            outcomes.append(self.lambda_function.send_message(
+                self.table, message_item.id, self.user_item.id, 'run'))
+        self.assertEqual(outcomes, ['failed'] * 4 + ['dead_letter'])
+        self.assertFalse(MessageItem(
+            table=self.table, msg_id=message_item.id).is_valid)
+        dead = self.table.get_item(Key={
+            'pk': f'deadletter#{message_item.id}',
+            'sk': f'deadletter#{message_item.id}'})['Item']
+        self.assertEqual(dead['attempts'], 5)
+        self.assertIn('404', dead['last_error'])
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(user_item.messages, [])
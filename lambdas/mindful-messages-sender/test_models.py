@@ -1,12 +1,15 @@
+import sys
 import boto3
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from datetime import datetime, timedelta
 from moto import mock_dynamodb2
+from boto3.dynamodb.conditions import Key
 from models import (
     UserItem,
     SessionItem,
     MessageItem,
+    ScheduleItem,
     session_expiration_hours
 )
 
@@ -87,6 +90,28 @@ class TestUserItem(TestCase):
         self.assertEqual('456', self.user_item.wbx_token)
         self.assertGreater(post_exp_dt, pre_exp_dt)
 
+    def test_user_oauth_token(self):
+        self.assertTrue(self.user_item.wbx_refresh_token_expired)
+        oauth_token = Mock(
+            access_token='456', expires_in=1209600,
+            refresh_token='789', refresh_token_expires_in=7776000)
+        self.user_item.update_oauth_token(oauth_token)
+        self.assertEqual(self.user_item.wbx_token, '456')
+        self.assertEqual(self.user_item.wbx_refresh_token, '789')
+        self.assertFalse(self.user_item.wbx_refresh_token_expired)
+        # Renewed two days before the token expires
+        refresh_at = datetime.fromisoformat(self.user_item.refresh_at)
+        expires = datetime.fromisoformat(self.user_item.wbx_token_expires)
+        self.assertEqual((expires - refresh_at).days, 2)
+        old_refresh_key = self.user_item.refresh_key
+        self.assertIn('Item', self.table.get_item(Key=old_refresh_key))
+        # A short lived token is renewed half way, the record moves
+        oauth_token.expires_in = 3600
+        self.user_item.update_oauth_token(oauth_token)
+        self.assertNotIn('Item', self.table.get_item(Key=old_refresh_key))
+        self.assertIn(
+            'Item', self.table.get_item(Key=self.user_item.refresh_key))
+
     def test_user_add_session(self):
         self.user_item.add_session(self.session_id)
         self.assertEqual(self.user_item.session_id, self.session_id)
@@ -100,11 +125,41 @@ class TestUserItem(TestCase):
         self.user_item.add_message(self.message_id)
         self.assertIn(self.message_id, self.user_item.messages)
 
+    def test_user_add_messages(self):
+        self.user_item.add_messages(['1', '2'])
+        self.assertEqual(self.user_item.messages, ['1', '2'])
+
+    def test_user_add_schedule(self):
+        self.user_item.add_schedule('123')
+        self.assertIn('123', self.user_item.schedules)
+        self.user_item.remove_schedule('123')
+        self.assertNotIn('123', self.user_item.schedules)
+
     def test_user_remove_message(self):
         self.user_item.add_message(self.message_id)
         self.user_item.remove_message(self.message_id)
         self.assertNotIn(self.message_id, self.user_item.messages)
 
+    def test_user_remove_messages_concurrently(self):
+        self.user_item.add_messages(['1', '2', '3'])
+        # Both read the list before either writes
+        other = UserItem(table=self.table, user_id=self.user_item.id)
+        self.user_item.remove_message('1')
+        # An append in between, e.g. from POST /schedule
+        UserItem(table=self.table, user_id=self.user_item.id).add_message('4')
+        other.remove_message('2')
+        self.assertEqual(other.messages, ['3', '4'])
+        self.assertEqual(UserItem(
+            table=self.table, user_id=self.user_item.id).messages, ['3', '4'])
+
+    def test_user_etag(self):
+        etag = self.user_item.etag
+        self.user_item.add_message(self.message_id)
+        self.assertNotEqual(self.user_item.etag, etag)
+        etag = self.user_item.etag
+        self.user_item.remove_message(self.message_id)
+        self.assertNotEqual(self.user_item.etag, etag)
+
     def test_user_delete(self):
         self.user_item.delete()
         self.assertFalse(self.user_item.is_valid)
@@ -267,9 +322,222 @@ class TestMessageItem(TestCase):
         self.assertTrue(deleted)
         self.assertEqual(message_item_get.user_id, None)
 
+    def test_message_due_key(self):
+        message_item = MessageItem(
+            table=self.table, msg_id=self.message_item.id)
+        self.assertIn(message_item.due, MessageItem.due_keys(self.time))
+        self.assertTrue(message_item.due.startswith(
+            f'due#{self.time[:13]}#shard-'))
+
+    def test_message_claim(self):
+        self.assertTrue(self.message_item.claim('run-1'))
+        self.assertFalse(self.message_item.claim('run-2'))
+        self.assertTrue(self.message_item.claim('run-1'))
+        # An expired lease can be taken over
+        self.assertTrue(self.message_item.claim('run-1', lease=-1))
+        self.assertTrue(self.message_item.claim('run-2'))
+
+    def test_message_claim_deleted(self):
+        message_item = MessageItem(
+            table=self.table, msg_id=self.message_item.id)
+        message_item.delete()
+        self.assertFalse(self.message_item.claim('run-1'))
+
+    def test_message_fail(self):
+        self.message_item.claim('run-1')
+        self.assertEqual(self.message_item.fail('Not found'), 'failed')
+        message_item = MessageItem(
+            table=self.table, msg_id=self.message_item.id)
+        self.assertEqual(message_item.status, 'failed')
+        self.assertEqual(message_item.attempts, 1)
+        self.assertEqual(message_item.last_error, 'Not found')
+        self.assertEqual(message_item.time, self.time)
+        self.assertGreater(message_item.sk, self.time)
+        self.assertEqual(message_item.due[:17], f'due#{message_item.sk[:13]}')
+        # The claim went with the old item
+        self.assertTrue(message_item.claim('run-2'))
+
+    def test_message_dead_letter(self):
+        msg_id = self.message_item.id
+        self.message_item.claim('run-1')
+        self.assertEqual(
+            self.message_item.fail('Not found', attempts=1), 'dead_letter')
+        self.assertFalse(MessageItem(table=self.table, msg_id=msg_id).is_valid)
+        key = {'pk': f'deadletter#{msg_id}', 'sk': f'deadletter#{msg_id}'}
+        item = self.table.get_item(Key=key)['Item']
+        self.assertEqual(item['status'], 'dead_letter')
+        self.assertEqual(item['last_error'], 'Not found')
+        self.assertNotIn('due', item)
+
+    def test_message_mark_sent(self):
+        self.assertFalse(self.message_item.was_sent())
+        self.assertTrue(self.message_item.mark_sent())
+        self.assertTrue(self.message_item.was_sent())
+        self.assertFalse(self.message_item.mark_sent())
+
+    def test_message_batch_create(self):
+        items = MessageItem.batch_create(
+            self.table, self.user_id,
+            [{'time': self.time, 'msg': self.msg, 'person': self.person}] * 3)
+        self.assertEqual(len(items), 3)
+        message_item_get = MessageItem(table=self.table, msg_id=items[0]['id'])
+        self.assertEqual(message_item_get.msg, self.msg)
+
+    def test_message_queue_entry(self):
+        # Patched where MessageItem reads it, chalicelib or models
+        module = sys.modules[MessageItem.__module__]
+        with patch.object(module, 'due_queue', True):
+            message_item = MessageItem(
+                table=self.table,
+                user_id=self.user_id,
+                time='2030-01-01T09:05:30',
+                msg=self.msg,
+                person=self.person)
+            entries = self.table.query(
+                KeyConditionExpression=Key('pk').eq('due#2030-01-01T09:05'))
+            self.assertEqual(entries['Items'][0]['sk'],
+                             f'2030-01-01T09:05:30#{message_item.id}')
+            self.assertEqual(entries['Items'][0]['user_id'], self.user_id)
+            # A retry is filed under its new time
+            message_item.reschedule(120)
+            entries = self.table.query(KeyConditionExpression=Key('pk').eq(
+                f'due#{message_item.sk[:16]}'))
+            self.assertEqual(entries['Items'][0]['id'], message_item.id)
+        # Messages already due go in the current minute
+        self.assertEqual(MessageItem.queue_bucket(
+            '2020-01-01T09:00:00', '2030-01-01T10:00:00'),
+            'due#2030-01-01T10:00')
+
+    def test_message_compact(self):
+        module = sys.modules[MessageItem.__module__]
+        long_msg = 'Remember to breathe. ' * 40
+        with patch.object(module, 'compact_messages', True):
+            message_item = MessageItem(
+                table=self.table,
+                user_id=self.user_id,
+                time=self.time,
+                msg=long_msg,
+                person=self.person)
+            item = self.table.get_item(Key=message_item.key)['Item']
+            self.assertNotIn('id', item)
+            self.assertNotIn('t', item)
+            self.assertEqual(item['p'], self.person)
+            self.assertLess(len(item['m'].value), len(long_msg))
+            message_item = MessageItem(
+                table=self.table, msg_id=message_item.id)
+            self.assertEqual(message_item.msg, long_msg)
+            self.assertEqual(message_item.time, self.time)
+            # Once retried the time is no longer the sort key
+            message_item.reschedule(60)
+            item = self.table.get_item(Key=message_item.key)['Item']
+            self.assertEqual(item['t'], self.time)
+            message_item = MessageItem(
+                table=self.table, msg_id=message_item.id)
+            self.assertEqual(message_item.time, self.time)
+            self.assertEqual(message_item.to_dict()['msg'], long_msg)
+        # Items written before still read the same
+        self.assertEqual(MessageItem(
+            table=self.table, msg_id=self.message_item.id).msg, self.msg)
+
+    def test_message_to_utc_bulk(self):
+        results = MessageItem.to_utc_bulk([
+            ('2021-12-09T08:04:42', 'US/Pacific'),
+            ('2021-12-09T08:04:42', 'Not/AZone')])
+        self.assertEqual(results[0], '2021-12-09T16:04:42')
+        self.assertIsInstance(results[1], Exception)
+
+    def test_message_from_utc_bulk(self):
+        times = ['2021-03-14T09:59:59', '2021-03-14T10:00:00',
+                 '2021-11-07T08:30:00', '2021-12-09T16:04:42']
+        self.assertEqual(
+            MessageItem.from_utc_bulk(times, 'US/Pacific'),
+            [MessageItem.from_utc(t, 'US/Pacific') for t in times])
+        self.assertEqual(MessageItem.from_utc_bulk(times[-1:], 'UTC'),
+                         times[-1:])
+
     def test_message_to_dict(self):
         dict = self.message_item.to_dict()
         self.assertEqual(dict['id'], self.message_item.id)
         self.assertEqual(dict['time'], self.message_item.time)
         self.assertEqual(dict['msg'], self.message_item.msg)
         self.assertEqual(dict['person'], self.message_item.person)
+
+
+@mock_dynamodb2
+class TestScheduleItem(TestCase):
+    def setUp(self):
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[
+                {
+                    'AttributeName': 'pk',
+                    'KeyType': 'HASH'  # Partition key
+                },
+                {
+                    'AttributeName': 'sk',
+                    'KeyType': 'RANGE'  # Sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'pk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'sk',
+                    'AttributeType': 'S'
+                },
+
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        self.table.meta.client.get_waiter('table_exists').wait(
+            TableName='test-table')
+        assert self.table.table_status == 'ACTIVE'
+        self.schedule_item = ScheduleItem(
+            table=self.table,
+            user_id='123',
+            start='2030-01-31T09:00:00',
+            timezone='US/Eastern',
+            msg='Test',
+            person='person@domain.com',
+            freq='monthly',
+            until='2030-04-30T00:00:00'
+        )
+
+    def tearDown(self):
+        self.table.delete()
+        self.dynamodb = None
+
+    def test_schedule_create(self):
+        self.assertEqual(len(self.schedule_item.id), 32)
+        # US/Eastern is UTC-5 in January
+        self.assertEqual(self.schedule_item.time, '2030-01-31T14:00:00')
+
+    def test_schedule_get(self):
+        schedule_item = ScheduleItem(
+            table=self.table, schedule_id=self.schedule_item.id)
+        self.assertEqual(schedule_item.freq, 'monthly')
+        self.assertEqual(schedule_item.time, self.schedule_item.time)
+
+    def test_schedule_advance(self):
+        self.assertTrue(self.schedule_item.advance(self.schedule_item.time))
+        # Day clamped to the end of February
+        self.assertEqual(self.schedule_item.time, '2030-02-28T14:00:00')
+        # Skips missed occurrences, March is after DST starts
+        self.assertTrue(self.schedule_item.advance('2030-03-01T00:00:00'))
+        self.assertEqual(self.schedule_item.time, '2030-03-31T13:00:00')
+        schedule_item = ScheduleItem(
+            table=self.table, schedule_id=self.schedule_item.id)
+        self.assertEqual(schedule_item.time, '2030-03-31T13:00:00')
+
+    def test_schedule_advance_until(self):
+        self.assertFalse(self.schedule_item.advance('2030-04-01T00:00:00'))
+        schedule_item = ScheduleItem(
+            table=self.table, schedule_id=self.schedule_item.id)
+        self.assertFalse(schedule_item.is_valid)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# Offline maintenance for the table. A parallel segmented scan finds drifted
+# records, and they are fixed with batched, rate limited writes. Nothing is
+# written without --apply.
+#
+#   expired_sessions    sessions past their expiry
+#   stale_states        OAuth state and nonce rows past their ttl, or without
+#   orphan_message_ids  IDs in a user's message list with no message
+#   orphan_messages     messages of users that are gone, and not being deleted
+#   missed_messages     messages more than --missed-hours overdue, the sender
+#                       only looks at the current hour so they never go out
+#   reindex             messages whose due shard key is out of date, e.g.
+#                       after DUE_SHARD_COUNT changed
+#   relist              schedules, refresh records and jobs missing from the
+#                       listed index, e.g. written before it existed
+#   enqueue             with DUE_QUEUE=true, messages with no due queue
+#                       entry, e.g. written before the queue was turned on
+#
+#   cd lambdas/mindful-messages
+#   python admin.py --table mindful-messages
+#   python admin.py --table mindful-messages --apply --rate 10
+#   python admin.py --table mindful-messages --workers 4 --segments 16 \
+#       --endpoint-url http://localhost:8000
+#
+# With TABLE_ROUTES set, or --routes, every routed table is scanned.
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+from collections import Counter
+from multiprocessing import Pool
+
+import boto3
+from chalicelib import Item, UserItem, MessageItem, db_error
+from chalicelib import time_fmt, due_shard_count, due_queue
+from chalicelib.retry import RetryPolicy, TokenBucket, botocore_config
+from chalicelib.routing import TableRouter
+
+checks = ('expired_sessions', 'stale_states', 'orphan_message_ids',
+          'orphan_messages', 'missed_messages', 'reindex', 'relist',
+          'enqueue')
+# Attributes read by the scan
+scan_attributes = ('pk', 'sk', 'id', 'user_id', 'target_id', 'record_type',
+                   'messages', 'expires', 'ttl', 'due', 'deleted_at',
+                   'listed')
+# Record kinds the sender finds through the listed index
+listed_kinds = ('schedule', 'refresh', 'job')
+# Keys per batch write, the DynamoDB maximum
+batch_size = 25
+
+
+def get_table(table_name, endpoint_url=None, routes=None):
+    # The table, or with routes a table routing to all of them
+    return TableRouter(
+        table_name, routes,
+        lambda: boto3.resource(
+            'dynamodb', endpoint_url=endpoint_url,
+            config=botocore_config)).table()
+
+
+def run_segments(fn, options, workers):
+    # Yields fn's results as segments finish, in worker processes unless
+    # there is only one worker
+    if workers > 1:
+        with Pool(workers) as pool:
+            yield from pool.imap_unordered(fn, options)
+    else:
+        yield from map(fn, options)
+
+
+def record_kind(item):
+    # State and nonce rows have no record_type, their pk prefix stands in
+    return item.get('record_type') or item['pk'].split('#')[0]
+
+
+def new_result():
+    return {
+        'items': 0,
+        'kinds': Counter(),
+        'users': {},
+        'messages': {},
+        'delete_jobs': set(),
+        'queued': set(),
+        'expired_sessions': [],
+        'stale_states': [],
+        'missed_messages': [],
+        'reindex': [],
+        'relist': []
+    }
+
+
+def classify(result, item, now, missed_before, shards):
+    # Adds one scanned item to a segment's result. Checks that need more
+    # than one record are left to plan() once every segment is in.
+    result['items'] += 1
+    kind = record_kind(item)
+    result['kinds'][kind] += 1
+    key = {'pk': item['pk'], 'sk': item['sk']}
+    if kind == 'user':
+        result['users'][item['id']] = list(item.get('messages', []))
+    elif kind == 'session':
+        if not item.get('expires') or Item.is_datetime_expired(
+                item['expires']):
+            result['expired_sessions'].append(key)
+    elif kind in ('state', 'nonce'):
+        if int(item.get('ttl', 0)) < now.timestamp():
+            result['stale_states'].append(key)
+    elif kind == 'job':
+        result['delete_jobs'].add(item.get('target_id'))
+    elif kind == 'due' and 'id' in item:
+        # A due queue entry, the cursor has no id
+        result['queued'].add(item['id'])
+    elif kind == 'message':
+        # Compact messages keep their id only in the pk
+        msg_id = MessageItem.decode(item)['id']
+        result['messages'][msg_id] = item.get('user_id')
+        if item['sk'] < missed_before:
+            result['missed_messages'].append(msg_id)
+        due = MessageItem.due_key(item['sk'], int(msg_id, 16) % shards)
+        if item.get('due') != due:
+            result['reindex'].append((key, due))
+    if kind in listed_kinds and item.get('listed') != kind:
+        result['relist'].append((key, kind))
+
+
+def scan_segment(options):
+    # Runs in a worker process, or in process with one worker
+    (table_name, endpoint_url, segment, segments, now, missed_hours,
+     shards, rate) = options
+    table = get_table(table_name, endpoint_url)
+    policy = RetryPolicy(bucket=TokenBucket(rate=rate))
+    missed_before = (now - timedelta(hours=missed_hours)).strftime(time_fmt)
+    names = {f'#a{i}': a for i, a in enumerate(scan_attributes)}
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': segments,
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+    result = new_result()
+    while True:
+        resp = policy.call(table.scan, **kwargs)
+        for item in resp.get('Items', []):
+            classify(result, item, now, missed_before, shards)
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+    return segment, result
+
+
+def merge(results):
+    merged = new_result()
+    for result in results:
+        merged['items'] += result['items']
+        merged['kinds'].update(result['kinds'])
+        merged['delete_jobs'].update(result['delete_jobs'])
+        merged['queued'].update(result['queued'])
+        for name in ('users', 'messages'):
+            merged[name].update(result[name])
+        for name in ('expired_sessions', 'stale_states', 'missed_messages',
+                     'reindex', 'relist'):
+            merged[name].extend(result[name])
+    return merged
+
+
+def scan(table_names, endpoint_url=None, segments=8, workers=4,
+         missed_hours=2, shards=due_shard_count, rate=50.0, now=None):
+    # Every segment of every table, merged
+    if isinstance(table_names, str):
+        table_names = [table_names]
+    now = now or datetime.utcnow()
+    options = [(table_name, endpoint_url, segment, segments, now,
+                missed_hours, shards, rate / max(1, workers))
+               for table_name in table_names for segment in range(segments)]
+    results = []
+    for segment, result in run_segments(scan_segment, options, workers):
+        results.append(result)
+        print(f'Scanned segment {segment + 1}/{segments}, '
+              f'{len(results)}/{len(options)} done, '
+              f'{sum(r["items"] for r in results)} items')
+    return merge(results)
+
+
+def plan(scanned, queue=None):
+    # Fixes by check, from the merged scan. Queue entries are only checked
+    # with the due queue on.
+    queue = due_queue if queue is None else queue
+    users = scanned['users']
+    messages = scanned['messages']
+    orphan_ids = {}
+    for user_id, msg_ids in users.items():
+        missing = [m for m in msg_ids if m not in messages]
+        if missing:
+            orphan_ids[user_id] = missing
+    # A user being deleted loses their messages first, leave them to the job
+    orphan_messages = [
+        msg_id for msg_id, user_id in messages.items()
+        if user_id not in users and user_id not in scanned['delete_jobs']]
+    orphans = set(orphan_messages)
+    missed = [m for m in scanned['missed_messages'] if m not in orphans]
+    # Missed messages are dead lettered or requeued instead
+    skip = scanned['queued'] | orphans | set(missed)
+    unqueued = [m for m in messages if m not in skip] if queue else []
+    return {
+        'expired_sessions': scanned['expired_sessions'],
+        'stale_states': scanned['stale_states'],
+        'orphan_message_ids': orphan_ids,
+        'orphan_messages': orphan_messages,
+        'missed_messages': missed,
+        'reindex': [(key, due) for key, due in scanned['reindex']
+                    if key['pk'][len('message#'):] not in orphans],
+        'relist': scanned['relist'],
+        'enqueue': unqueued
+    }
+
+
+def chunks(items, size=batch_size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def report_progress(check, done, total):
+    if done == total or done % (batch_size * 10) == 0:
+        print(f'  {check}: {done}/{total}')
+
+
+def delete_keys(table, policy, check, keys):
+    done = 0
+    for chunk in chunks(keys):
+        def batch_write_item():
+            with table.batch_writer() as batch:
+                for key in chunk:
+                    batch.delete_item(Key=key)
+        policy.call(batch_write_item)
+        done += len(chunk)
+        report_progress(check, done, len(keys))
+
+
+def delete_messages(table, policy, msg_ids):
+    # Messages are keyed by time as well as ID, so look each one up
+    keys = []
+    for msg_id in msg_ids:
+        message_item = MessageItem(table=table, msg_id=msg_id)
+        if not message_item.is_valid:
+            continue
+        # The user may have signed up after their segment was scanned
+        if UserItem(table=table, user_id=message_item.user_id).is_valid:
+            continue
+        keys.append(message_item.key)
+    delete_keys(table, policy, 'orphan_messages', keys)
+    return len(keys)
+
+
+def apply(table, policy, fixes, missed_action='dead_letter'):
+    # Every model write goes through the rate limited policy
+    Item.retry_policy = policy
+    outcomes = Counter()
+    delete_keys(table, policy, 'expired_sessions', fixes['expired_sessions'])
+    outcomes['expired_sessions'] = len(fixes['expired_sessions'])
+    delete_keys(table, policy, 'stale_states', fixes['stale_states'])
+    outcomes['stale_states'] = len(fixes['stale_states'])
+    orphan_ids = fixes['orphan_message_ids']
+    for n, (user_id, msg_ids) in enumerate(orphan_ids.items(), 1):
+        user_item = UserItem(table=table, user_id=user_id)
+        # Only IDs whose message is still missing, it may have been
+        # created since the scan
+        msg_ids = [msg_id for msg_id in msg_ids if not MessageItem(
+            table=table, msg_id=msg_id).is_valid]
+        if user_item.is_valid and msg_ids:
+            user_item.remove_messages(msg_ids)
+            outcomes['orphan_message_ids'] += len(msg_ids)
+        report_progress('orphan_message_ids', n, len(orphan_ids))
+    outcomes['orphan_messages'] = delete_messages(
+        table, policy, fixes['orphan_messages'])
+    missed = fixes['missed_messages']
+    dead_letters = {}
+    for n, msg_id in enumerate(missed, 1):
+        message_item = MessageItem(table=table, msg_id=msg_id)
+        if message_item.is_valid:
+            if missed_action == 'requeue':
+                # Due now, the next sender run sends it
+                message_item.reschedule(0)
+            else:
+                # Off the user's list too, as the sender does
+                dead_letters.setdefault(
+                    message_item.user_id, []).append(msg_id)
+                message_item.dead_letter('Missed by the sender.')
+            outcomes['missed_messages'] += 1
+        report_progress('missed_messages', n, len(missed))
+    for user_id, msg_ids in dead_letters.items():
+        user_item = UserItem(table=table, user_id=user_id)
+        if user_item.is_valid:
+            user_item.remove_messages(msg_ids)
+    for n, (key, due) in enumerate(fixes['reindex'], 1):
+        try:
+            policy.call(
+                table.update_item, Key=key,
+                UpdateExpression='SET due = :d',
+                ExpressionAttributeValues={':d': due},
+                ConditionExpression='attribute_exists(pk)')
+            outcomes['reindex'] += 1
+        except Exception as e:
+            # Sent or moved since the scan
+            print(e)
+        report_progress('reindex', n, len(fixes['reindex']))
+    for n, (key, kind) in enumerate(fixes['relist'], 1):
+        try:
+            policy.call(
+                table.update_item, Key=key,
+                UpdateExpression='SET listed = :l',
+                ExpressionAttributeValues={':l': kind},
+                ConditionExpression='attribute_exists(pk)')
+            outcomes['relist'] += 1
+        except Exception as e:
+            # Advanced, renewed or finished since the scan
+            print(e)
+        report_progress('relist', n, len(fixes['relist']))
+    for n, msg_id in enumerate(fixes['enqueue'], 1):
+        # Sent or deleted since the scan otherwise. An entry written in
+        # the meantime is harmless, the claim stops a second send.
+        message_item = MessageItem(table=table, msg_id=msg_id)
+        if message_item.is_valid and message_item.enqueue() != db_error:
+            outcomes['enqueue'] += 1
+        report_progress('enqueue', n, len(fixes['enqueue']))
+    return outcomes
+
+
+def count_fixes(fixes):
+    counts = {check: len(fixes[check]) for check in checks}
+    counts['orphan_message_ids'] = sum(
+        len(ids) for ids in fixes['orphan_message_ids'].values())
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find and fix drifted records. Dry run unless --apply.')
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--routes', default=os.environ.get('TABLE_ROUTES'),
+                        help='e.g. session=mindful-sessions')
+    parser.add_argument('--endpoint-url',
+                        help='e.g. DynamoDB Local at http://localhost:8000')
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='DynamoDB requests per second, all workers')
+    parser.add_argument('--missed-hours', type=float, default=2)
+    parser.add_argument('--missed-action', default='dead_letter',
+                        choices=('dead_letter', 'requeue'))
+    parser.add_argument('--shards', type=int, default=due_shard_count,
+                        help='Due index shards the sender uses')
+    parser.add_argument('--apply', action='store_true')
+    args = parser.parse_args()
+    if not args.table:
+        sys.exit('Pass --table or set TABLE_NAME')
+    scanned = scan(
+        TableRouter(args.table, args.routes).table_names, args.endpoint_url,
+        args.segments, args.workers, args.missed_hours, args.shards,
+        args.rate)
+    print(f'{scanned["items"]} items: '
+          + ', '.join(f'{kind} {n}' for kind, n in
+                      sorted(scanned['kinds'].items())))
+    fixes = plan(scanned)
+    for check, n in count_fixes(fixes).items():
+        print(f'{check:<20} {n}')
+    if not args.apply:
+        print('Dry run, pass --apply to fix')
+        return
+    policy = RetryPolicy(bucket=TokenBucket(rate=args.rate))
+    table = get_table(args.table, args.endpoint_url, args.routes)
+    outcomes = apply(table, policy, fixes, args.missed_action)
+    print('Fixed: ' + ', '.join(
+        f'{check} {outcomes[check]}' for check in checks))
+
+
+if __name__ == '__main__':
+    main()
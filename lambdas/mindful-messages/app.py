@@ -1,10 +1,27 @@
-import boto3
 import os
-import epsagon
+import io
+import json
+import time
+import uuid
+import hashlib
+import itertools
 import bleach
+import pytz
 from webexteamssdk import WebexTeamsAPI
 from chalice import Chalice, Response, CORSConfig
-from chalicelib import UserItem, SessionItem, MessageItem
+from chalicelib import UserItem, SessionItem, MessageItem, ScheduleItem
+from chalicelib import DeleteUserJob
+from chalicelib import schedule_frequencies, message_fields
+from chalicelib import default_page_size, max_page_size
+from chalicelib.context import RequestContext
+from chalicelib.oauth_state import sign_state, verify_state, NonceCache
+from chalicelib.oauth_state import state_max_age_seconds
+from chalicelib.profiling import default_profiler
+from chalicelib.retry import default_retry_policy
+from chalicelib.routing import TableRouter
+from chalicelib.tracing import default_tracer, span
+from chalicelib.webex import default_pool, webex_base_url, WebexRateLimited
+from chalicelib.webex import exchange_code
 
 
 # Environmental variables of the lambda function
@@ -12,23 +29,42 @@ client_id = os.environ['OAUTH_CLIENT_ID']
 client_secret = os.environ['OAUTH_CLIENT_SECRET']
 redirect_uri = os.environ['OAUTH_REDIRECT_URI']
 table_name = os.environ['TABLE_NAME']
+# Tables for record types kept out of TABLE_NAME, e.g.
+# session=mindful-sessions,state=mindful-sessions
+table_router = TableRouter(table_name, os.environ.get('TABLE_ROUTES'))
+# Index on user_id and sk used to page through a user's messages
+user_index_name = os.environ.get('USER_INDEX_NAME', 'user-index')
 cors_allow_origin = os.environ['CORS_ALLOW_ORIGIN']
 redirect_resp_url = cors_allow_origin + '/index.html'
-epsagon_token = os.environ['EPSAGON_TOKEN']
 app_name = os.environ['APP_NAME']
 allowed_domains = os.environ['ALLOWED_DOMAINS']
 allowed_domains = allowed_domains.split(',')
-
-epsagon.init(
-  token=epsagon_token,
-  app_name=app_name,
-  metadata_only=False
-  )
+# When set, OAuth states are HMAC signed instead of stored. Single use is
+# enforced per process ('memory') or with a conditional write ('table').
+state_secret = os.environ.get('OAUTH_STATE_SECRET')
+state_single_use = os.environ.get('OAUTH_STATE_SINGLE_USE', 'memory')
+state_nonces = NonceCache()
+# Maximum number of messages accepted by one batch schedule request
+schedule_batch_limit = int(os.environ.get('SCHEDULE_BATCH_LIMIT', '25'))
+# Exports stop after the page that passes this size, under Lambda's 6 MB
+# response limit, and hand back a cursor for the rest
+export_max_bytes = int(os.environ.get('EXPORT_MAX_BYTES', str(4 * 2 ** 20)))
+# Import lines validated and written together
+import_chunk_size = 25
+# Imports stop with this much of the invocation left, the client resumes
+# from the returned line
+import_reserve_ms = 5000
+# Imported message IDs are derived from the user, line number and line
+import_namespace = uuid.UUID('8a6f1b1e-4f0c-4b8e-9d52-2f1c3b7d9e40')
+
+# No-op unless TRACING is set
+default_tracer.init(app_name)
 
 app = Chalice(app_name=app_name)
 
 cors_config = CORSConfig(
-    allow_origin=cors_allow_origin
+    allow_origin=cors_allow_origin,
+    expose_headers=['ETag', 'X-Cursor']
 )
 
 # Errors
@@ -46,19 +82,47 @@ def success_response(results=None):
     return {'success': True, 'results': results}
 
 
+def cached_response(request, etag, fn):
+    # Answer 304 if the client already has this version, otherwise call fn
+    # for the body. no-cache makes browsers revalidate on every page view.
+    # Errors get no ETag, or revalidating would keep answering 304 to them.
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(body='', status_code=304, headers=headers)
+    body = fn()
+    if not body.get('success'):
+        return Response(body=body, headers={'Cache-Control': 'no-store'})
+    return Response(body=body, headers=headers)
+
+
+def params_etag(etag, params):
+    # Combine a user's etag with the query params that shape the response
+    digest = hashlib.sha1(
+        repr(sorted(params.items())).encode()).hexdigest()[:12]
+    return f'{etag[:-1]}.{digest}"'
+
+
+def remaining_time_fn():
+    # Milliseconds left in this invocation, None when running locally
+    context = app.lambda_context
+    if context:
+        return context.get_remaining_time_in_millis
+    return None
+
+
 def authorize(code):
-    wbxapi = WebexTeamsAPI(client_id=client_id,
-                           client_secret=client_secret,
-                           oauth_code=code,
-                           redirect_uri=redirect_uri
+    # Exchange the code ourselves to keep the refresh token
+    oauth_token = exchange_code(client_id, client_secret, code, redirect_uri,
+                                base_url=webex_base_url)
+    wbxapi = WebexTeamsAPI(access_token=oauth_token.access_token,
+                           base_url=webex_base_url
                            )
-    return wbxapi
+    return wbxapi, oauth_token
 
 
-def get_table(table_name=table_name):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
-    return table
+def get_table():
+    # TABLE_NAME, or a table that routes each record type to its own
+    return table_router.table()
 
 
 def is_domain_allowed(domains, emails):
@@ -73,21 +137,88 @@ def is_domain_allowed(domains, emails):
 def delete_state(table, state):
     try:
         # Delete ephemeral OAuth2 state
-        resp = table.delete_item(Key={'pk': state, 'sk': state})
+        resp = default_retry_policy.call(
+            table.delete_item, Key={'pk': state, 'sk': state})
         return resp
     except Exception as e:
         print(e)
         return auth_error
 
 
+def state_ttl():
+    # Unused states expire through the table's TTL
+    return int(time.time()) + state_max_age_seconds
+
+
+def create_state(table):
+    if state_secret:
+        return sign_state(state_secret)
+    oauth_state = UserItem.get_token()
+    default_retry_policy.call(
+        table.put_item,
+        Item={'pk': f'state#{oauth_state}',
+              'sk': f'state#{oauth_state}',
+              'ttl': state_ttl()})
+    return oauth_state
+
+
+def use_signed_state(table, state):
+    # True once for each signed state handed out by /wbxauth
+    nonce = verify_state(state_secret, state)
+    if not nonce:
+        return False
+    if state_single_use != 'table':
+        return state_nonces.use(nonce)
+    try:
+        default_retry_policy.call(
+            table.put_item,
+            Item={'pk': f'nonce#{nonce}', 'sk': f'nonce#{nonce}',
+                  'ttl': state_ttl()},
+            ConditionExpression='attribute_not_exists(pk)')
+        return True
+    except Exception as e:
+        print(e)
+        return False
+
+
+@app.middleware('http')
+def trace_request(event, get_response):
+    # One span per request, the DynamoDB and Webex spans nest under it
+    try:
+        with default_tracer.span(f'{event.method} {event.path}', {
+                'http.method': event.method, 'http.route': event.path}):
+            return get_response(event)
+    finally:
+        default_tracer.flush()
+
+
+@app.middleware('http')
+def profile_request(event, get_response):
+    # Only with PROFILING on and an X-Profile header signed with
+    # PROFILE_SECRET, see benchmarks/profiles.py
+    if not default_profiler.allowed(event.headers.get('x-profile')):
+        return get_response(event)
+    with default_profiler.profile(event.path):
+        return get_response(event)
+
+
+@app.middleware('http')
+def request_context(event, get_response):
+    # Routes share one lazily loaded session and user through event.ctx
+    params = event.query_params or {}
+    session_id = params.get('session')
+    if session_id:
+        session_id = bleach.clean(session_id)
+    event.ctx = RequestContext(get_table, session_id)
+    return get_response(event)
+
+
 # App routes
 # Form and respond with the Webex authorizer link, store ephemeral OAuth2 state
 @app.route('/wbxauth', methods=['GET'], cors=cors_config)
 def wbxauth():
-    oauth_state = UserItem.get_token()
     try:
-        get_table().put_item(Item={'pk': f'state#{oauth_state}',
-                                   'sk': f'state#{oauth_state}'})
+        oauth_state = create_state(get_table())
         authorizer_url = (f'https://webexapis.com/v1/authorize'
                           f'?client_id={client_id}'
                           f'&response_type=code&redirect_uri={redirect_uri}'
@@ -108,32 +239,38 @@ def auth():
     request = app.current_request
     # Get ephemeral state to verify correct OAuth flow
     state = bleach.clean(request.query_params.get('state'))
-    try:
-        # Get the ephemeral state from the db
-        oauth_state = get_table().get_item(Key={
-            'pk': f'state#{state}', 'sk': f'state#{state}'})['Item']['pk']
-    except Exception as e:
-        print(e)
-        return db_error
-    # Verify state is the same between request and db
-    if 'code' in request.query_params and f'state#{state}' == oauth_state:
+    table = get_table()
+    if state_secret:
+        state_valid = use_signed_state(table, state)
+    else:
+        try:
+            # Get the ephemeral state from the db
+            oauth_state = default_retry_policy.call(
+                table.get_item,
+                Key={'pk': f'state#{state}', 'sk': f'state#{state}'}
+                )['Item']['pk']
+        except Exception as e:
+            print(e)
+            return db_error
+        # Verify state is the same between request and db
+        state_valid = f'state#{state}' == oauth_state
+        # States are single use whatever happens next
+        delete_state(table, oauth_state)
+    wbxapi = None
+    if 'code' in request.query_params and state_valid:
         # Get OAuth granted code from query params
         code = request.query_params.get('code')
-        wbxapi = None
-        wbxapi = authorize(code)
+        wbxapi, oauth_token = authorize(code)
     if wbxapi:
-        person = wbxapi.people.me()
-        table = get_table()
+        with span('webex.people.me'):
+            person = wbxapi.people.me()
         if not is_domain_allowed(allowed_domains, person.emails):
-            delete_state(table, oauth_state)
             return {'success': False, 'results': {'error': 'Not allowed.'}}
-        delete_state(table, oauth_state)
         user_item = UserItem(table=table, user_id=person.id)
         # User and Session exists
         if user_item.is_valid and user_item.session_id:
-            # Check wbx token, renew if needed
-            if user_item.wbx_token_expired:
-                user_item.update_wbx_token(wbxapi.access_token)
+            # Keep the new tokens, the refresh token renews them later
+            user_item.update_oauth_token(oauth_token)
             # Get session item from db
             session_item = SessionItem(
                 table=table, session_id=user_item.session_id
@@ -159,16 +296,14 @@ def auth():
             return resp
         # User exists but no session, create session and add to user
         elif user_item.is_valid:
-            if user_item.wbx_token_expired:
-                user_item.update_wbx_token(wbxapi.access_token)
+            user_item.update_oauth_token(oauth_token)
             session_item = SessionItem(table=table, user_id=user_item.id)
             user_item.add_session(session_item.id)
             return Response(**session_item.redirect_resp(redirect_resp_url))
         # No user or session exists, create both
         else:
             new_user_item = UserItem(
-                table=table, wbx_person=person,
-                wbx_token=wbxapi.access_token)
+                table=table, wbx_person=person, oauth_token=oauth_token)
             session_item = SessionItem(
                 table=table, user_id=new_user_item.id)
             new_user_item.add_session(session_item.id)
@@ -184,18 +319,17 @@ def auth():
 @app.route('/user', methods=['GET'], cors=cors_config)
 def get_user():
     request = app.current_request
-    session_id = bleach.clean(request.query_params.get('session'))
+    ctx = request.ctx
     try:
-        session_item = SessionItem(table=get_table(), session_id=session_id)
-        if session_item.expired:
-            session_item.delete()
+        if ctx.session_expired():
             return session_expired
         else:
-            user_item = UserItem(
-                table=get_table(), user_id=session_item.user_id)
-            return {
+            user_item = ctx.user
+            if not user_item.is_valid:
+                return auth_error
+            return cached_response(request, user_item.etag, lambda: {
                 'success': True,
-                'results': {'username': user_item.displayname}}
+                'results': {'username': user_item.displayname}})
     except Exception as e:
         print(e)
         return {'success': False, 'results': {'error': 'Database error.'}}
@@ -204,28 +338,21 @@ def get_user():
 # Delete the user given a session ID in the query params
 @app.route('/user', methods=['DELETE'], cors=cors_config)
 def delete_user():
-    request = app.current_request
-    session_id = bleach.clean(request.query_params.get('session'))
+    ctx = app.current_request.ctx
     try:
-        session_item = SessionItem(table=get_table(), session_id=session_id)
-        if session_item.expired:
-            session_item.delete()
+        if ctx.session_expired():
             return session_expired
         else:
-            user_item = UserItem(
-                table=get_table(), user_id=session_item.user_id)
-            if user_item.is_valid:
-                if hasattr(user_item, 'messages'):
-                    # For each msg ID in the user item, get item and delete it
-                    for message_id in user_item.messages:
-                        message_item = MessageItem(
-                            table=get_table(), msg_id=message_id)
-                        if message_item.is_valid:
-                            message_item.delete()
-                if user_item.delete():
-                    return {'success': True, 'results': 'User deleted.'}
-                else:
-                    return {'success': False, 'results': 'User not deleted.'}
+            user_item = ctx.user
+            if not user_item.is_valid:
+                return {'success': False, 'results': 'User not deleted.'}
+            # Tombstone first so every other read treats the user as gone
+            user_item.tombstone()
+            job = DeleteUserJob(table=ctx.table, user_id=user_item.id)
+            if job.run(user_index_name, time_left=remaining_time_fn()):
+                return {'success': True, 'results': 'User deleted.'}
+            # Out of time, the sender picks up the job from its checkpoint
+            return {'success': True, 'results': 'User deletion in progress.'}
     except Exception as e:
         print(e)
         return db_error
@@ -234,11 +361,8 @@ def delete_user():
 # Logout the user session given a session ID in the query params
 @app.route('/logout', methods=['GET'], cors=cors_config)
 def logout():
-    request = app.current_request
-    # Get sessionid query parameter from the request
-    session_id = bleach.clean(request.query_params.get('session'))
-    session_item = SessionItem(table=get_table(), session_id=session_id)
-    if session_item.delete():
+    ctx = app.current_request.ctx
+    if ctx.session.delete():
         return {'success': True}
 
 
@@ -246,8 +370,7 @@ def logout():
 @app.route('/schedule', methods=['POST'], cors=cors_config)
 def schedule():
     request = app.current_request
-    # Get the session id from query parameters
-    session_id = request.query_params.get('session')
+    ctx = request.ctx
     # Get the json body and the message details
     req_data = request.json_body
     message_txt = bleach.clean(req_data.get('msg'))
@@ -256,15 +379,19 @@ def schedule():
     message_timezone = bleach.clean(req_data.get('timezone'))
     message_datetime_utc = MessageItem.to_utc(
         message_datetime, message_timezone)
-    session_item = SessionItem(table=get_table(), session_id=session_id)
 
-    if session_item.expired:
-        session_item.delete()
+    if ctx.session_expired():
         return session_expired
+    # A repeat rule makes this a recurring schedule rather than one message
+    repeat = req_data.get('repeat')
+    if repeat:
+        return schedule_repeat(
+            ctx, repeat, message_datetime, message_timezone,
+            message_txt, message_recipient)
     else:
-        user_item = UserItem(table=get_table(), user_id=session_item.user_id)
+        user_item = ctx.user
         msg_item = MessageItem(
-            table=get_table(),
+            table=ctx.table,
             user_id=user_item.id,
             time=message_datetime_utc,
             msg=message_txt,
@@ -273,53 +400,334 @@ def schedule():
         return {'success': True}
 
 
-# Return list of messages given a sessionid
+def schedule_repeat(ctx, repeat, start, timezone, msg, person):
+    freq = bleach.clean(str(repeat.get('freq')))
+    until = repeat.get('until')
+    try:
+        interval = int(repeat.get('interval', 1))
+    except (TypeError, ValueError):
+        interval = 0
+    if freq not in schedule_frequencies or interval < 1:
+        return error_response({'error': 'Invalid repeat rule.'})
+    user_item = ctx.user
+    schedule_item = ScheduleItem(
+        table=ctx.table,
+        user_id=user_item.id,
+        start=start,
+        timezone=timezone,
+        msg=msg,
+        person=person,
+        freq=freq,
+        interval=interval,
+        until=bleach.clean(until) if until else None)
+    user_item.add_schedule(schedule_item.id)
+    return {'success': True, 'results': {'id': schedule_item.id}}
+
+
+def validate_messages(messages):
+    # Clean and check every message up front, then convert all times to UTC
+    # in one pass. Returns a list of (message dict, error) tuples.
+    cleaned = []
+    for m in messages:
+        if not isinstance(m, dict):
+            cleaned.append((None, 'Invalid message.'))
+            continue
+        fields = {k: bleach.clean(str(m.get(k) or ''))
+                  for k in ('msg', 'time', 'person', 'timezone')}
+        missing = [k for k, v in fields.items() if not v]
+        if missing:
+            cleaned.append((None, f'Missing {", ".join(missing)}.'))
+        else:
+            cleaned.append((fields, None))
+    valid = [m for m, error in cleaned if m]
+    utc_times = iter(MessageItem.to_utc_bulk(
+        [(m['time'], m['timezone']) for m in valid]))
+    results = []
+    for m, error in cleaned:
+        if m:
+            utc_time = next(utc_times)
+            if isinstance(utc_time, Exception):
+                m, error = None, 'Invalid time or timezone.'
+            else:
+                m['time'] = utc_time
+        results.append((m, error))
+    return results
+
+
+# Schedule many messages in one request given a session id
+@app.route('/schedule/batch', methods=['POST'], cors=cors_config)
+def schedule_batch():
+    request = app.current_request
+    ctx = request.ctx
+    req_data = request.json_body or {}
+    messages = req_data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return error_response({'error': 'No messages.'})
+    if len(messages) > schedule_batch_limit:
+        return error_response(
+            {'error': f'Limit is {schedule_batch_limit} messages.'})
+    if ctx.session_expired():
+        return session_expired
+    validated = validate_messages(messages)
+    valid = [m for m, error in validated if m]
+    items = []
+    if valid:
+        user_item = ctx.user
+        items = MessageItem.batch_create(ctx.table, user_item.id, valid)
+        if items == db_error:
+            return db_error
+        user_item.add_messages([item['id'] for item in items])
+    # Report the outcome of each message in request order
+    created = iter(items)
+    results = []
+    for m, error in validated:
+        if m:
+            results.append({'success': True, 'id': next(created)['id']})
+        else:
+            results.append({'success': False, 'error': error})
+    return {
+        'success': all(r['success'] for r in results), 'results': results}
+
+
+def local_times(items, timezone):
+    # Times in the given zone, converted for the whole list at once
+    if timezone and items and 'time' in items[0]:
+        times = MessageItem.from_utc_bulk(
+            [item['time'] for item in items], timezone)
+        for item, local in zip(items, times):
+            item['time'] = local
+    return items
+
+
+def valid_timezone(timezone):
+    try:
+        pytz.timezone(timezone)
+        return True
+    except pytz.UnknownTimeZoneError:
+        return False
+
+
+# Return a page of messages given a sessionid. Optional query params:
+# limit, cursor (from the previous page), fields (comma separated), order
+# (asc or desc by time) and timezone (times in UTC without one).
 @app.route('/messages', methods=['GET'], cors=cors_config)
 def messages():
     request = app.current_request
-    # Get the session id from query parameters
-    session_id = bleach.clean(request.query_params.get('session'))
-    # timezone = request.query_params.get('timezone')
-    session_item = SessionItem(table=get_table(), session_id=session_id)
-    if session_item.expired:
-        session_item.delete()
+    params = request.query_params or {}
+    ctx = request.ctx
+    timezone = params.get('timezone')
+    if timezone and not valid_timezone(timezone):
+        return error_response({'error': 'Invalid timezone.'})
+    try:
+        limit = int(params.get('limit', default_page_size))
+    except ValueError:
+        return error_response({'error': 'Invalid limit.'})
+    if limit < 1:
+        return error_response({'error': 'Invalid limit.'})
+    cursor = params.get('cursor')
+    fields = None
+    if params.get('fields'):
+        fields = [f for f in params.get('fields').split(',')
+                  if f in message_fields]
+        if not fields:
+            return error_response({'error': 'Invalid fields.'})
+    descending = params.get('order') == 'desc'
+    if ctx.session_expired():
         return session_expired
-    else:
-        user_item = UserItem(table=get_table(), user_id=session_item.user_id)
-        results = []
-        if hasattr(user_item, 'messages'):
-            # For each msg ID in user item, get msg item and append to list
-            for message_id in user_item.messages:
-                message_item = MessageItem(
-                    table=get_table(), msg_id=message_id)
-                if message_item.is_valid:
-                    if not message_item.is_datetime_expired(message_item.time):
-                        msg_dict = message_item.to_dict()
-                        # time = msg_dict['time']
-                        # time = message_item.from_utc(time, timezone)
-                        # msg_dict['time'] = time
-                        results.append(msg_dict)
-        return {'success': True, 'results': results}
+    # Only the user read is needed to answer a conditional request. Sent
+    # messages are removed by the sender, which bumps the user version.
+    user_item = ctx.user
+    if not user_item.is_valid:
+        return auth_error
+
+    def page():
+        results, next_cursor = MessageItem.query_by_user(
+            ctx.table, user_index_name, user_item.id,
+            limit=limit, cursor=cursor, fields=fields,
+            descending=descending)
+        if results == db_error:
+            return db_error
+        body = {'success': True, 'results': local_times(results, timezone),
+                'cursor': next_cursor}
+        if timezone:
+            body['timezone'] = timezone
+        return body
+    try:
+        return cached_response(
+            request, params_etag(user_item.etag, params), page)
+    except ValueError:
+        return error_response({'error': 'Invalid cursor.'})
+
+
+def export_pages(table, user_id, cursor=None, timezone='UTC'):
+    # NDJSON for a user's messages, yields (text, next cursor) a page at a
+    # time. Each line has its timezone, so it can be imported again.
+    while True:
+        items, cursor = MessageItem.query_by_user(
+            table, user_index_name, user_id, limit=max_page_size,
+            cursor=cursor)
+        if items == db_error:
+            raise RuntimeError('Export query failed')
+        if timezone != 'UTC':
+            items = local_times(items, timezone)
+        yield ''.join(json.dumps(dict(item, timezone=timezone)) + '\n'
+                      for item in items), cursor
+        if not cursor:
+            return
+
+
+# Export a user's scheduled messages as NDJSON given a session id, with
+# times in UTC or the timezone query param. Large exports come in parts,
+# the X-Cursor header is the cursor param for the next part and is absent
+# on the last one.
+@app.route('/messages/export', methods=['GET'], cors=cors_config)
+def export_messages():
+    request = app.current_request
+    params = request.query_params or {}
+    ctx = request.ctx
+    timezone = params.get('timezone') or 'UTC'
+    if not valid_timezone(timezone):
+        return error_response({'error': 'Invalid timezone.'})
+    if ctx.session_expired():
+        return session_expired
+    user_item = ctx.user
+    if not user_item.is_valid:
+        return auth_error
+    parts = []
+    size = 0
+    try:
+        for text, cursor in export_pages(
+                ctx.table, user_item.id, params.get('cursor'), timezone):
+            parts.append(text)
+            size += len(text)
+            if size >= export_max_bytes:
+                break
+    except ValueError:
+        return error_response({'error': 'Invalid cursor.'})
+    except Exception as e:
+        print(e)
+        return db_error
+    headers = {'Content-Type': 'application/x-ndjson'}
+    if cursor:
+        headers['X-Cursor'] = cursor
+    return Response(body=''.join(parts), headers=headers)
+
+
+def import_message_id(user_id, line_number, line):
+    # The same line of the same file always gets the same ID, so importing
+    # it again overwrites the message instead of adding another
+    return uuid.uuid5(
+        import_namespace, f'{user_id}:{line_number}:{line}').hex
+
+
+def parse_import_lines(user_id, numbered_lines, default_timezone=None):
+    # Returns (line number, message dict or None, error) for each non blank
+    # line, with times converted to UTC in bulk
+    parsed = []
+    for n, line in numbered_lines:
+        line = line.decode('utf-8', 'replace').strip()
+        if not line:
+            continue
+        try:
+            m = json.loads(line)
+        except ValueError:
+            parsed.append((n, line, None, 'Invalid JSON.'))
+            continue
+        if isinstance(m, dict) and default_timezone:
+            m.setdefault('timezone', default_timezone)
+        parsed.append((n, line, m, None))
+    validated = iter(validate_messages(
+        [m for n, line, m, error in parsed if not error]))
+    results = []
+    for n, line, m, error in parsed:
+        if not error:
+            m, error = next(validated)
+        if m:
+            m['id'] = import_message_id(user_id, n, line)
+        results.append((n, m, error))
+    return results
+
+
+# Import NDJSON messages, one JSON object with msg, time, person and
+# timezone per line, given a session id. Optional query params: start (the
+# line to start from, to resume) and timezone (for lines without one).
+@app.route('/messages/import', methods=['POST'], cors=cors_config,
+           content_types=['application/x-ndjson', 'application/json'])
+def import_messages():
+    request = app.current_request
+    params = request.query_params or {}
+    ctx = request.ctx
+    try:
+        start = int(params.get('start', 1))
+    except ValueError:
+        return error_response({'error': 'Invalid start.'})
+    default_timezone = params.get('timezone')
+    if default_timezone:
+        default_timezone = bleach.clean(default_timezone)
+    if ctx.session_expired():
+        return session_expired
+    # The message list is needed to leave out IDs the user already has
+    user_item = ctx.full_user
+    if not user_item.is_valid:
+        return auth_error
+    known = set(getattr(user_item, 'messages', []))
+    time_left = remaining_time_fn()
+    # Read line by line, only one chunk is parsed at a time
+    lines = itertools.dropwhile(
+        lambda numbered: numbered[0] < start,
+        enumerate(io.BytesIO(request.raw_body or b''), 1))
+    imported = 0
+    errors = []
+    next_line = None
+    while True:
+        chunk = list(itertools.islice(lines, import_chunk_size))
+        if not chunk:
+            break
+        if time_left and time_left() < import_reserve_ms:
+            next_line = chunk[0][0]
+            break
+        valid = []
+        for n, m, error in parse_import_lines(
+                user_item.id, chunk, default_timezone):
+            if m:
+                valid.append(m)
+            else:
+                errors.append({'line': n, 'error': error})
+        if valid:
+            items = MessageItem.batch_create(ctx.table, user_item.id, valid)
+            if items == db_error:
+                # Lines before this chunk are in, resume from it
+                next_line = chunk[0][0]
+                errors.append({'line': next_line, 'error': 'Database error.'})
+                break
+            new_ids = [i['id'] for i in items if i['id'] not in known]
+            if new_ids:
+                user_item.add_messages(new_ids)
+                known.update(new_ids)
+            imported += len(items)
+    return {
+        'success': not errors and next_line is None,
+        'results': {
+            'imported': imported, 'errors': errors, 'next_line': next_line}}
 
 
 # Delete message given a message ID and session ID
 @app.route('/message', methods=['DELETE'], cors=cors_config)
 def message():
     request = app.current_request
-    # Get the session id and message id from query parameters
-    session_id = bleach.clean(request.query_params.get('session'))
+    ctx = request.ctx
+    # Get the message id from query parameters
     message_id = bleach.clean(request.query_params.get('message'))
-    session_item = SessionItem(table=get_table(), session_id=session_id)
-    if session_item.expired:
-        session_item.delete()
+    if ctx.session_expired():
         return session_expired
     else:
-        message_item = MessageItem(table=get_table(), msg_id=message_id)
+        loaded = ctx.load_many(
+            full_user=ctx.load_full_user,
+            message=lambda table: MessageItem(table=table, msg_id=message_id))
+        message_item = loaded['message']
         if message_item.is_valid:
             if message_item.delete():
-                user_item = UserItem(table=get_table(),
-                                     user_id=session_item.user_id)
-                user_item.remove_message(message_id)
+                loaded['full_user'].remove_message(message_id)
                 return {'success': True, 'results': 'Message deleted.'}
             else:
                 return {'success': False, 'results': 'Message not deleted.'}
@@ -327,38 +735,71 @@ def message():
             return {'success': True, 'results': 'Message does not exist.'}
 
 
+# Return list of recurring schedules given a sessionid
+@app.route('/schedules', methods=['GET'], cors=cors_config)
+def schedules():
+    ctx = app.current_request.ctx
+    if ctx.session_expired():
+        return session_expired
+    user_item = ctx.full_user
+    results = []
+    for schedule_id in getattr(user_item, 'schedules', []):
+        schedule_item = ScheduleItem(
+            table=ctx.table, schedule_id=schedule_id)
+        if schedule_item.is_valid:
+            results.append(schedule_item.to_dict())
+    return {'success': True, 'results': results}
+
+
+# Delete a recurring schedule given a schedule ID and session ID
+@app.route('/schedule', methods=['DELETE'], cors=cors_config)
+def delete_schedule():
+    request = app.current_request
+    ctx = request.ctx
+    schedule_id = bleach.clean(request.query_params.get('schedule'))
+    if ctx.session_expired():
+        return session_expired
+    user_item = ctx.full_user
+    if schedule_id not in getattr(user_item, 'schedules', []):
+        return {'success': True, 'results': 'Schedule does not exist.'}
+    schedule_item = ScheduleItem(table=ctx.table, schedule_id=schedule_id)
+    if schedule_item.is_valid and not schedule_item.delete():
+        return {'success': False, 'results': 'Schedule not deleted.'}
+    user_item.remove_schedule(schedule_id)
+    return {'success': True, 'results': 'Schedule deleted.'}
+
+
 @app.route('/people', methods=['GET'], cors=cors_config)
 def people():
     request = app.current_request
-    # Get the session id and person query from query parameters
-    session_id = bleach.clean(request.query_params.get('session'))
+    ctx = request.ctx
+    # Get the person query from query parameters
     query = request.query_params.get('q')
     query = bleach.clean(str(query))
-    session_item = SessionItem(table=get_table(), session_id=session_id)
-    if session_item.expired:
-        session_item.delete()
+    if ctx.session_expired():
         return session_expired
     user_item = None
-    wbxapi = None
+    wbx_people = []
     results = []
     if all(chr.isalpha() or chr.isspace() for chr in query):
-        user_item = UserItem(table=get_table(), user_id=session_item.user_id)
+        user_item = ctx.full_user
     if user_item:
         if user_item.is_valid and not user_item.is_datetime_expired(
                 user_item.wbx_token_expires):
-            wbxapi = WebexTeamsAPI(access_token=user_item.wbx_token)
-    if wbxapi:
-        people = wbxapi.people.list(displayName=query)
-        for person in people:
-            result = {}
-            result['displayname'] = person.displayName
-            result['email'] = person.emails[0]
-            results.append(result)
+            try:
+                # Pooled client, reuses connections across requests
+                wbx_people = default_pool.call(
+                    user_item.wbx_token,
+                    lambda api: list(api.people.list(displayName=query)),
+                    'people.list')
+            except WebexRateLimited:
+                return error_response('Too many requests, try again later.')
+    for person in wbx_people:
+        result = {}
+        result['displayname'] = person.displayName
+        result['email'] = person.emails[0]
+        results.append(result)
     if len(results) > 0:
         return {'success': True, 'results': results}
     else:
         return {'success': False, 'results': 'No results.'}
-
-
-# Epsagon monitoring
-app = epsagon.chalice_wrapper(app)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# What routing the login path's records (users, sessions and OAuth states)
+# to their own on demand table does for the sender during a login storm.
+# moto has no capacity limits, so each table gets a simulated provisioned
+# capacity: units per second, past which calls get
+# ProvisionedThroughputExceededException, like DynamoDB with no burst
+# capacity left. Every call costs one unit. Throttled calls are retried by
+# RetryPolicy as in the app.
+#
+#   cd lambdas/mindful-messages
+#   python -m benchmarks.isolation --seconds 5 --logins 8 --send-rate 1.5
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import Counter
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3  # noqa: E402
+from moto import mock_dynamodb2  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from boto3.dynamodb.conditions import Key  # noqa: E402
+from chalicelib.retry import RetryPolicy, TokenBucket  # noqa: E402
+from chalicelib.routing import TableRouter  # noqa: E402
+
+main_table = 'bench-main'
+logins_table = 'bench-logins'
+# Read and write units per second, the template's provisioned capacity
+capacity = {main_table: (10, 5), logins_table: (None, None)}
+layouts = {
+    'shared': None,
+    'routed': f'user={logins_table},session={logins_table},'
+              f'state={logins_table}'
+}
+
+
+class Units(object):
+    # Units for the current second, None for on demand
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.second = None
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.per_second is None:
+            return True
+        with self.lock:
+            second = int(time.monotonic())
+            if second != self.second:
+                self.second, self.used = second, 0
+            if self.used >= self.per_second:
+                return False
+            self.used += 1
+            return True
+
+
+class CapacityTable(object):
+    # Wraps a moto table, spending a read or write unit per call
+    reads = ('get_item', 'query', 'scan')
+    writes = ('put_item', 'update_item', 'delete_item')
+
+    def __init__(self, table, units, throttles):
+        self.table = table
+        self.units = units
+        self.throttles = throttles
+        self.name = table.name
+
+    def __getattr__(self, name):
+        attr = getattr(self.table, name)
+        if name not in self.reads + self.writes:
+            return attr
+        units = self.units[0 if name in self.reads else 1]
+
+        def call(**kwargs):
+            if not units.take():
+                self.throttles[self.name] += 1
+                raise ClientError({'Error': {
+                    'Code': 'ProvisionedThroughputExceededException'}}, name)
+            return attr(**kwargs)
+        call.__name__ = name
+        return call
+
+
+class CapacityResource(object):
+    def __init__(self, dynamodb, throttles):
+        self.dynamodb = dynamodb
+        self.throttles = throttles
+        self.units = {name: (Units(r), Units(w))
+                      for name, (r, w) in capacity.items()}
+
+    def Table(self, name):
+        return CapacityTable(
+            self.dynamodb.Table(name), self.units[name], self.throttles)
+
+
+def create_tables(dynamodb):
+    for name in capacity:
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[
+                {'AttributeName': 'pk', 'KeyType': 'HASH'},
+                {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'pk', 'AttributeType': 'S'},
+                {'AttributeName': 'sk', 'AttributeType': 'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST')
+
+
+def login(table, policy, n):
+    # The table calls of /wbxauth and /auth for a returning user
+    state = {'pk': f'state#{n}', 'sk': f'state#{n}'}
+    user = {'pk': 'userid#1', 'sk': 'userid#1'}
+    session = {'pk': f'sessionid#{n}', 'sk': f'sessionid#{n}'}
+    policy.call(table.put_item, Item=state)
+    policy.call(table.get_item, Key=state)
+    policy.call(table.delete_item, Key=state)
+    policy.call(table.get_item, Key=user)
+    policy.call(table.put_item, Item=dict(session, user_id='1'))
+    policy.call(table.update_item, Key=user,
+                UpdateExpression='SET session_id = :s',
+                ExpressionAttributeValues={':s': str(n)})
+
+
+def send(table, policy, n):
+    # The sender's calls for one message: read, claim, mark sent
+    message = {'pk': f'message#{n}', 'sk': '2030-01-01T00:00:00'}
+    policy.call(table.query, KeyConditionExpression=Key('pk').eq(
+        message['pk']))
+    policy.call(table.put_item, Item=dict(message, status='claimed'))
+    policy.call(table.put_item,
+                Item={'pk': f'sent#{n}', 'sk': f'sent#{n}'})
+
+
+def worker(role, table_factory, stop, results, n_offset, send_rate):
+    table = table_factory()
+    # Client side rate limits out of the way, only capacity limits count
+    policy = RetryPolicy(bucket=TokenBucket(rate=10000))
+    fn = login if role == 'login' else send
+    n = n_offset
+    while not stop.is_set():
+        n += 1
+        start = time.perf_counter()
+        try:
+            fn(table, policy, n)
+            outcome = 'ok'
+        except ClientError:
+            outcome = 'throttled'
+        elapsed = time.perf_counter() - start
+        with results['lock']:
+            results[role][outcome] += 1
+            results['latency'][role] += elapsed
+        # Logins come as fast as they can, messages fall due at a steady
+        # rate within the table's capacity
+        if role == 'send':
+            stop.wait(max(0, 1 / send_rate - elapsed))
+
+
+def run(layout, seconds, logins, send_rate):
+    throttles = Counter()
+    with mock_dynamodb2():
+        boto3.setup_default_session()
+        dynamodb = boto3.resource('dynamodb')
+        create_tables(dynamodb)
+        resource = CapacityResource(dynamodb, throttles)
+        router = TableRouter(main_table, layouts[layout], lambda: resource)
+        results = {'login': Counter(), 'send': Counter(),
+                   'latency': Counter(), 'lock': threading.Lock()}
+        stop = threading.Event()
+        roles = ['send'] + ['login'] * logins
+        threads = [threading.Thread(
+            target=worker,
+            args=(role, router.table, stop, results, i * 10 ** 6,
+                  send_rate))
+            for i, role in enumerate(roles)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    send_ok = results['send']['ok']
+    send_total = sum(results['send'].values()) or 1
+    return {
+        'layout': layout,
+        'logins/s': results['login']['ok'] / seconds,
+        'sends/s': send_ok / seconds,
+        'send failed %': results['send']['throttled'] / send_total * 100,
+        'ms/send': results['latency']['send'] * 1000 / send_total,
+        'throttles': dict(throttles)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--logins', type=int, default=8,
+                        help='Concurrent login threads')
+    parser.add_argument('--send-rate', type=float, default=1.5,
+                        help='Messages due per second')
+    args = parser.parse_args()
+    print(f'{"layout":<8} {"logins/s":>9} {"sends/s":>8} '
+          f'{"send failed %":>14} {"ms/send":>8}  throttled calls')
+    for layout in layouts:
+        r = run(layout, args.seconds, args.logins, args.send_rate)
+        print(f'{r["layout"]:<8} {r["logins/s"]:>9.1f} {r["sends/s"]:>8.1f} '
+              f'{r["send failed %"]:>14.1f} {r["ms/send"]:>8.1f}  '
+              f'{r["throttles"]}')
+
+
+if __name__ == '__main__':
+    main()
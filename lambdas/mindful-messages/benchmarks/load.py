@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# Synthetic load against the app and the sender, with a local Webex
+# stand-in. Each profile reports latency percentiles, error rate and
+# throughput.
+#
+#   login-storm     /wbxauth then /auth for many new users
+#   reminder-burst  one sender run over many messages due now
+#   messages-poll   GET /messages polling, with If-None-Match
+#
+# By default DynamoDB is mocked with moto and the app runs in process
+# through chalice.test.Client, one request at a time. For concurrent load
+# start DynamoDB Local or moto_server and `chalice local`, then pass
+# --endpoint-url and --url.
+#
+# In process, DynamoDB calls go through the shared retry policies of the
+# app and the sender, with their limit raised to --db-rate so latencies are
+# not the client side limiter's. A running app keeps its own limit.
+#
+#   cd lambdas/mindful-messages
+#   python -m benchmarks.load login-storm --requests 500
+#   python -m benchmarks.load reminder-burst --messages 5000 --users 100
+#   python -m benchmarks.load messages-poll --requests 2000 --latency 0.05
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+import urllib.error
+import urllib.request
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+here = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(here)
+sender_dir = os.path.join(os.path.dirname(app_dir), 'mindful-messages-sender')
+sys.path.insert(0, app_dir)
+
+import boto3  # noqa: E402
+from moto import mock_dynamodb2  # noqa: E402
+from tests.fake_webex import FakeWebex  # noqa: E402
+from chalicelib.retry import botocore_config, TokenBucket  # noqa: E402
+
+table_name = 'mindful-messages-load'
+indexes = {
+    'listed-index': 'listed',
+    'due-index': 'due',
+    'user-index': 'user_id'
+}
+
+
+def percentile(values, p):
+    # Nearest rank, values must be sorted
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class Results(object):
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.outcomes = Counter()
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def record(self, seconds, outcome):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.outcomes[outcome] += 1
+
+    @contextlib.contextmanager
+    def timed(self):
+        # Yields a dict, set its outcome, anything raised counts as error
+        result = {'outcome': 'ok'}
+        start = time.perf_counter()
+        try:
+            yield result
+        except Exception as e:
+            print(e)
+            result['outcome'] = 'error'
+        self.record(time.perf_counter() - start, result['outcome'])
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        total = len(latencies)
+        # Answered from cache, or deferred by a Webex 429 as designed
+        ok = sum(self.outcomes[o] for o in ('ok', 'not_modified',
+                                            'rescheduled'))
+        print(f'\n{self.name}: {total} requests in {self.elapsed:.1f}s, '
+              f'{total / self.elapsed if self.elapsed else 0:.1f}/s')
+        for p in (50, 95, 99):
+            print(f'  p{p:<3} {percentile(latencies, p) * 1000:8.1f} ms')
+        print(f'  errors {(total - ok) / total * 100 if total else 0:.2f}%')
+        for outcome, n in sorted(self.outcomes.items()):
+            print(f'  {outcome:<14} {n}')
+
+
+class ClientTarget(object):
+    # chalice.test.Client in process. The app keeps the current request on
+    # a global, so requests are serialized.
+    def __init__(self, app):
+        from chalice.test import Client
+        self.client = Client(app)
+        self.lock = threading.Lock()
+
+    def get(self, path, headers=None):
+        with self.lock:
+            resp = self.client.http.get(path, headers=headers or {})
+        return resp.status_code, resp.headers, resp.json_body
+
+
+class HttpTarget(object):
+    # A running `chalice local` or deployed API
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def get(self, path, headers=None):
+        req = urllib.request.Request(self.url + path, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req) as resp:
+                status, resp_headers, body = (
+                    resp.status, dict(resp.headers), resp.read())
+        except urllib.error.HTTPError as e:
+            status, resp_headers, body = e.code, dict(e.headers), e.read()
+        return status, resp_headers, json.loads(body) if body else None
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # /auth answers with a redirect to the client, keep it as the response
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def resource_factory(endpoint_url=None):
+    # DynamoDB resources for the harness, the app and the sender. The
+    # endpoint is passed explicitly, the pinned botocore does not read
+    # AWS_ENDPOINT_URL_DYNAMODB.
+    return lambda: boto3.resource(
+        'dynamodb', endpoint_url=endpoint_url, config=botocore_config)
+
+
+def raise_limit(policy, rate):
+    # Paces the shared policy at rate, as benchmarks/isolation.py does
+    policy.bucket = TokenBucket(rate=rate)
+
+
+def create_table(dynamodb):
+    definitions = [{'AttributeName': 'pk', 'AttributeType': 'S'},
+                   {'AttributeName': 'sk', 'AttributeType': 'S'}]
+    definitions += [{'AttributeName': a, 'AttributeType': 'S'}
+                    for a in indexes.values()]
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {'AttributeName': 'pk', 'KeyType': 'HASH'},
+            {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=definitions,
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': name,
+                'KeySchema': [
+                    {'AttributeName': hash_key, 'KeyType': 'HASH'},
+                    {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            } for name, hash_key in indexes.items()
+        ],
+        BillingMode='PAY_PER_REQUEST')
+    table.meta.client.get_waiter('table_exists').wait(TableName=table_name)
+    return table
+
+
+def set_env(webex):
+    # What the app and the sender read at import time
+    os.environ.update({
+        'OAUTH_CLIENT_ID': 'load',
+        'OAUTH_CLIENT_SECRET': 'load',
+        'OAUTH_REDIRECT_URI': 'https://localhost/auth',
+        'TABLE_NAME': table_name,
+        'INDEX_NAME': 'listed-index',
+        'DUE_INDEX_NAME': 'due-index',
+        'USER_INDEX_NAME': 'user-index',
+        'CORS_ALLOW_ORIGIN': 'https://localhost',
+        'APP_NAME': 'mindful-messages-load',
+        'ALLOWED_DOMAINS': 'domain.com',
+        'WEBEX_BASE_URL': webex.base_url
+    })
+
+
+def create_users(table, users, messages_per_user=0, due=None):
+    # Users with a session each, and optionally messages
+    from chalicelib import UserItem, SessionItem, MessageItem
+    sessions = []
+    for n in range(users):
+        person = Mock(id=f'load-user-{n}', nickName=f'User {n}')
+        user_item = UserItem(table=table, wbx_person=person, wbx_token=f't{n}')
+        session_item = SessionItem(table=table, user_id=user_item.id)
+        user_item.add_session(session_item.id)
+        if messages_per_user:
+            items = MessageItem.batch_create(table, user_item.id, [
+                {'time': due or f'2030-01-01T{m % 24:02d}:00:00',
+                 'msg': f'Message {m}', 'person': 'someone@domain.com'}
+                for m in range(messages_per_user)])
+            user_item.add_messages([item['id'] for item in items])
+        sessions.append(session_item.id)
+    return sessions
+
+
+def login_storm(args, target, table):
+    results = Results('login-storm')
+
+    def login(n):
+        with results.timed() as result:
+            status, _, body = target.get('/wbxauth')
+            location = body['results']['location']
+            state = location.split('state=')[1]
+            status, _, body = target.get(f'/auth?code=load{n}&state={state}')
+            if status != 301:
+                result['outcome'] = f'status_{status}'
+    run_workers(args, login, args.requests)
+    results.finish()
+    return results
+
+
+def messages_poll(args, target, table):
+    sessions = create_users(table, args.users, args.messages_per_user)
+    results = Results('messages-poll')
+    etags = {}
+
+    def poll(n):
+        session_id = sessions[n % len(sessions)]
+        headers = {}
+        # Every other poll of a session is conditional
+        if n // len(sessions) % 2 and session_id in etags:
+            headers['If-None-Match'] = etags[session_id]
+        with results.timed() as result:
+            status, resp_headers, _ = target.get(
+                f'/messages?session={session_id}&limit=50', headers)
+            if status == 304:
+                result['outcome'] = 'not_modified'
+            elif status != 200:
+                result['outcome'] = f'status_{status}'
+            etags[session_id] = resp_headers.get('ETag') or resp_headers.get(
+                'etag')
+    run_workers(args, poll, args.requests)
+    results.finish()
+    return results
+
+
+def reminder_burst(args, target, table):
+    sys.path.insert(0, sender_dir)
+    import lambda_function
+    from models.retry import default_retry_policy
+    from models.webex import WebexClientPool
+    raise_limit(default_retry_policy, args.db_rate)
+    lambda_function.table_router.resource_factory = resource_factory(
+        args.endpoint_url)
+    now = datetime.utcnow()
+    # Due at the start of this hour, so the hour query finds them all
+    due = now.replace(minute=0, second=0, microsecond=0).isoformat()
+    per_user = max(1, args.messages // args.users)
+    create_users(table, args.users, per_user, due=due)
+    results = Results('reminder-burst')
+    send_message = lambda_function.send_message
+
+    def timed_send(*a, **kw):
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            outcome = send_message(*a, **kw)
+            return outcome
+        finally:
+            results.record(time.perf_counter() - start,
+                           'ok' if outcome == 'sent' else outcome)
+    pool = WebexClientPool(
+        base_url=os.environ['WEBEX_BASE_URL'],
+        token_rate=args.token_rate, global_rate=args.global_rate)
+    with patch.object(lambda_function, 'send_message', timed_send), \
+            patch.object(lambda_function, 'default_pool', pool):
+        counts = lambda_function.lambda_handler({}, None)
+    results.finish()
+    print(json.dumps(counts, default=str))
+    return results
+
+
+def run_workers(args, fn, n):
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(fn, range(n)))
+
+
+profiles = {
+    'login-storm': login_storm,
+    'reminder-burst': reminder_burst,
+    'messages-poll': messages_poll
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('profile', choices=sorted(profiles))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--messages-per-user', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every Webex response')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0,
+                        help='Share of Webex requests answered with 429')
+    parser.add_argument('--token-rate', type=float, default=5.0)
+    parser.add_argument('--global-rate', type=float, default=50.0)
+    parser.add_argument('--db-rate', type=float, default=10000.0,
+                        help='DynamoDB requests per second, in process')
+    parser.add_argument('--endpoint-url',
+                        help='DynamoDB Local or moto_server, moto if unset')
+    parser.add_argument('--url', help='Running app, in process if unset')
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    webex = FakeWebex(
+        latency=args.latency,
+        rate_limit_ratio=args.rate_limit_ratio,
+        person_per_token=True,
+        seed=1).start()
+    set_env(webex)
+    from chalicelib.retry import default_retry_policy
+    raise_limit(default_retry_policy, args.db_rate)
+    if args.endpoint_url:
+        dynamo_mock = contextlib.nullcontext()
+    else:
+        dynamo_mock = mock_dynamodb2()
+    try:
+        with dynamo_mock:
+            boto3.setup_default_session()
+            table = create_table(resource_factory(args.endpoint_url)())
+            if args.url:
+                urllib.request.install_opener(
+                    urllib.request.build_opener(NoRedirect))
+                target = HttpTarget(args.url)
+            else:
+                import app
+                app.table_router.resource_factory = resource_factory(
+                    args.endpoint_url)
+                target = ClientTarget(app.app)
+            try:
+                results = profiles[args.profile](args, target, table)
+            finally:
+                table.delete()
+        results.report()
+        print(f'  webex requests {webex.requests}')
+        if args.url:
+            print('  dynamodb limit set by the app, see DYNAMODB_MAX_RATE')
+        else:
+            print(f'  dynamodb limit {args.db_rate:.0f}/s')
+    finally:
+        webex.stop()
+
+
+if __name__ == '__main__':
+    main()
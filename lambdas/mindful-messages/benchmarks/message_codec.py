@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Capacity used by message items in the plain and the compact form. moto
+# does not meter capacity, so the items MessageItem writes are recorded and
+# sized by DynamoDB's rules: attribute names count, and writes are billed
+# per 1 KB, reads per 4 KB. Every index projects the whole item, so each
+# write is paid again per index. Messages are read back and compared.
+#
+#   cd lambdas/mindful-messages
+#   python -m benchmarks.message_codec --messages 500 --sizes 40,200,1000,3000
+import os
+import sys
+import math
+import time
+import random
+import argparse
+from decimal import Decimal
+from unittest.mock import patch
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3  # noqa: E402
+from moto import mock_dynamodb2  # noqa: E402
+from boto3.dynamodb.types import Binary  # noqa: E402
+import chalicelib  # noqa: E402
+from chalicelib import MessageItem  # noqa: E402
+from benchmarks.session_layout import create_table  # noqa: E402
+
+# Indexes a message is in, due-index and user-index
+index_count = 2
+# Messages per GET /messages page
+page_size = 50
+words = ('remember', 'to', 'take', 'a', 'break', 'and', 'stretch', 'drink',
+         'some', 'water', 'call', 'your', 'team', 'about', 'the', 'demo',
+         'review', 'notes', 'before', 'meeting', 'thanks', 'for', 'today',
+         'great', 'work', 'on', 'release', 'check', 'in', 'with', 'Alex',
+         'tomorrow', 'morning', 'deadline', 'is', 'Friday', 'please', 'send')
+
+
+def value_size(value):
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (int, Decimal)):
+        return math.ceil(len(str(value).lstrip('-')) / 2) + 1
+    if isinstance(value, (list, set)):
+        return 3 + sum(1 + value_size(v) for v in value)
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode()) + 1 + value_size(v)
+                       for k, v in value.items())
+    return 1
+
+
+def item_size(item):
+    return sum(len(name.encode()) + value_size(value)
+               for name, value in item.items())
+
+
+class RecordingTable(object):
+    # Keeps the items put through it
+    def __init__(self, table, items):
+        self.table = table
+        self.items = items
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+    def put_item(self, **kwargs):
+        self.items.append(kwargs['Item'])
+        return self.table.put_item(**kwargs)
+
+
+def message_text(rng, size):
+    text = []
+    while sum(len(w) + 1 for w in text) < size:
+        text.append(rng.choice(words))
+    return ' '.join(text)[:size]
+
+
+def run(form, messages, sizes, seed):
+    rng = random.Random(seed)
+    items = []
+    with mock_dynamodb2(), patch.object(
+            chalicelib, 'compact_messages', form == 'compact'):
+        boto3.setup_default_session()
+        table = RecordingTable(create_table('bench-codec'), items)
+        texts = [message_text(rng, sizes[n % len(sizes)])
+                 for n in range(messages)]
+        created = []
+        start = time.perf_counter()
+        for text in texts:
+            created.append(MessageItem(
+                table=table, user_id='1', time='2030-01-01T09:00:00',
+                msg=text, person='someone@example.com'))
+        write_s = time.perf_counter() - start
+        start = time.perf_counter()
+        for message_item, text in zip(created, texts):
+            read = MessageItem(table=table, msg_id=message_item.id)
+            assert read.msg == text and read.time == '2030-01-01T09:00:00'
+        read_s = time.perf_counter() - start
+    item_sizes = [item_size(item) for item in items]
+    wcu = sum(math.ceil(size / 1024) for size in item_sizes)
+    # Eventually consistent, as the app reads
+    rcu = sum(math.ceil(size / 4096) / 2 for size in item_sizes)
+    pages = [item_sizes[i:i + page_size]
+             for i in range(0, len(item_sizes), page_size)]
+    page_rcu = sum(math.ceil(sum(page) / 4096) / 2 for page in pages)
+    return {
+        'form': form,
+        'bytes/item': sum(item_sizes) / len(item_sizes),
+        'wcu/create': wcu * (1 + index_count) / len(items),
+        'rcu/get': rcu / len(items),
+        'rcu/page': page_rcu / len(pages),
+        'ms/write': write_s * 1000 / messages,
+        'ms/read': read_s * 1000 / messages
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--sizes', default='40,200,1000,3000',
+                        help='Message lengths in characters, used in turn')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(f'{"form":<8} {"bytes/item":>10} {"wcu/create":>10} '
+          f'{"rcu/get":>8} {"rcu/page":>8} {"ms/write":>8} {"ms/read":>8}')
+    for form in ('plain', 'compact'):
+        r = run(form, args.messages, sizes, args.seed)
+        print(f'{r["form"]:<8} {r["bytes/item"]:>10.0f} '
+              f'{r["wcu/create"]:>10.2f} {r["rcu/get"]:>8.2f} '
+              f'{r["rcu/page"]:>8.2f} {r["ms/write"]:>8.2f} '
+              f'{r["ms/read"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
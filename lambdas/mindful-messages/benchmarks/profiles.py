@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Tools for PROFILING=sample. `header` prints a signed X-Profile value for
+# one request, `flamegraph` turns collapsed stacks into an SVG flame graph.
+# Stacks are read from profile-*.collapsed files or from logs with PROFILE
+# lines, e.g. exported from CloudWatch.
+#
+#   cd lambdas/mindful-messages
+#   curl -H "X-Profile: $(PROFILE_SECRET=... python -m benchmarks.profiles \
+#       header)" "$API/messages?session=..."
+#   python -m benchmarks.profiles flamegraph logs.txt -o messages.svg
+#   python -m benchmarks.profiles flamegraph logs.txt --list
+import os
+import sys
+import zlib
+import argparse
+from html import escape
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chalicelib.oauth_state import sign_state  # noqa: E402
+
+frame_height = 16
+width = 1200
+# Frames narrower than this are left out
+min_width = 0.5
+
+
+def read_stacks(lines, profile_id=None):
+    # Collapsed stacks by profile id, '' for plain collapsed files
+    profiles = {}
+    for line in lines:
+        line = line.strip()
+        if 'PROFILE ' in line:
+            line = line[line.index('PROFILE ') + len('PROFILE '):]
+            current, _, line = line.partition(' ')
+        else:
+            current = ''
+        stack, _, count = line.rpartition(' ')
+        if not stack or ' ' in stack or not count.isdigit():
+            continue
+        if profile_id and current != profile_id:
+            continue
+        profiles.setdefault(current, Counter())[stack] += int(count)
+    return profiles
+
+
+def build_tree(stacks):
+    # Nested {'name', 'count', 'children'} from root to leaves
+    root = {'name': 'all', 'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['count'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(
+                name, {'name': name, 'count': 0, 'children': {}})
+            node['count'] += count
+    return root
+
+
+def depth(node):
+    return 1 + max((depth(c) for c in node['children'].values()), default=0)
+
+
+def colour(name):
+    # Warm colours, stable per function
+    h = zlib.crc32(name.encode())
+    return f'rgb({205 + h % 50},{80 + h // 50 % 130},{h // 6500 % 55})'
+
+
+def render(root, title):
+    total = root['count'] or 1
+    height = (depth(root) + 2) * frame_height
+    rects = []
+
+    def draw(node, x, level):
+        w = node['count'] / total * width
+        if w < min_width:
+            return
+        y = height - (level + 1) * frame_height
+        label = escape(node['name'])
+        pct = node['count'] / total * 100
+        # Roughly what fits at 7px a character
+        chars = int(w / 7)
+        text = escape(node['name'][:chars] if chars > 2 else '')
+        rects.append(
+            f'<g><title>{label} ({node["count"]} samples, {pct:.1f}%)'
+            f'</title><rect x="{x:.1f}" y="{y}" width="{w:.1f}" '
+            f'height="{frame_height - 1}" fill="{colour(node["name"])}"/>'
+            f'<text x="{x + 3:.1f}" y="{y + frame_height - 4}">'
+            f'{text}</text></g>')
+        for child in sorted(node['children'].values(),
+                            key=lambda c: c['name']):
+            draw(child, x, level + 1)
+            x += child['count'] / total * width
+    draw(root, 0, 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+            f'height="{height}" font-family="monospace" font-size="11">'
+            f'<text x="4" y="{frame_height}">{escape(title)}</text>'
+            + ''.join(rects) + '</svg>\n')
+
+
+def header(args):
+    secret = args.secret or os.environ.get('PROFILE_SECRET')
+    if not secret:
+        sys.exit('Set PROFILE_SECRET or pass --secret')
+    print(sign_state(secret))
+
+
+def flamegraph(args):
+    lines = []
+    for path in args.files or ['-']:
+        with (sys.stdin if path == '-' else open(path)) as f:
+            lines.extend(f)
+    profiles = read_stacks(lines, args.profile)
+    if args.list:
+        for profile_id, stacks in sorted(profiles.items()):
+            print(f'{profile_id or "-":<40} {sum(stacks.values())} samples')
+        return
+    # Several profiles of the same route merge into one graph
+    stacks = sum(profiles.values(), Counter())
+    if not stacks:
+        sys.exit('No stacks found')
+    title = args.profile or ', '.join(sorted(p for p in profiles if p))
+    with open(args.output, 'w') as f:
+        f.write(render(build_tree(stacks), title or 'profile'))
+    print(f'{sum(stacks.values())} samples written to {args.output}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    header_parser = commands.add_parser('header')
+    header_parser.add_argument('--secret')
+    header_parser.set_defaults(fn=header)
+    graph_parser = commands.add_parser('flamegraph')
+    graph_parser.add_argument('files', nargs='*')
+    graph_parser.add_argument('--profile', help='Only this profile id')
+    graph_parser.add_argument('--list', action='store_true')
+    graph_parser.add_argument('-o', '--output', default='flamegraph.svg')
+    graph_parser.set_defaults(fn=flamegraph)
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Compare the two session layouts on the GET /user and GET /messages auth
+# path: the session and user read separately, and the user snapshot kept
+# on the session. Runs against moto, so the read counts are what matters,
+# timings only show the relative cost of the extra round trip. Calls are
+# paced at a limit high enough not to show in them.
+#
+#   cd lambdas/mindful-messages
+#   python -m benchmarks.session_layout --requests 200
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+from unittest.mock import Mock, patch
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3  # noqa: E402
+from moto import mock_dynamodb2  # noqa: E402
+from chalicelib import Item, UserItem, SessionItem  # noqa: E402
+from chalicelib.retry import RetryPolicy, TokenBucket  # noqa: E402
+from chalicelib.context import RequestContext  # noqa: E402
+
+
+class CountingTable(object):
+    # Counts the table calls made through it, by method name
+    def __init__(self, table, counts):
+        self.table = table
+        self.counts = counts
+
+    def __getattr__(self, name):
+        attr = getattr(self.table, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.counts[name] += 1
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+def create_table(name):
+    table = boto3.resource('dynamodb').create_table(
+        TableName=name,
+        KeySchema=[
+            {'AttributeName': 'pk', 'KeyType': 'HASH'},
+            {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'pk', 'AttributeType': 'S'},
+            {'AttributeName': 'sk', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST')
+    table.meta.client.get_waiter('table_exists').wait(TableName=name)
+    return table
+
+
+def auth_request(table_factory, session_id):
+    # What the routes do before their own work
+    ctx = RequestContext(table_factory, session_id)
+    if ctx.session_expired():
+        raise RuntimeError('Session expired')
+    user_item = ctx.user
+    return user_item.displayname, user_item.etag
+
+
+def run(snapshot, requests):
+    table = create_table(f'bench-{int(snapshot)}')
+    counts = Counter()
+    wbx_person = Mock(id='123', nickName='Bench')
+    with patch.object(UserItem, 'session_snapshot', snapshot):
+        user_item = UserItem(
+            table=table, wbx_person=wbx_person, wbx_token='123')
+        session_item = SessionItem(table=table, user_id=user_item.id)
+        user_item.add_session(session_item.id)
+        user_item.add_messages([str(n) for n in range(20)])
+        start = time.perf_counter()
+        for _ in range(requests):
+            auth_request(
+                lambda: CountingTable(table, counts), session_item.id)
+        elapsed = time.perf_counter() - start
+    table.delete()
+    return {
+        'layout': 'snapshot' if snapshot else 'separate',
+        'reads': sum(counts.values()) / requests,
+        'ms': elapsed * 1000 / requests
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    policy = RetryPolicy(bucket=TokenBucket(rate=10000))
+    with mock_dynamodb2(), patch.object(Item, 'retry_policy', policy):
+        boto3.setup_default_session()
+        results = [run(False, args.requests), run(True, args.requests)]
+    print(f'{"layout":<10} {"reads/request":>14} {"ms/request":>11}')
+    for r in results:
+        print(f'{r["layout"]:<10} {r["reads"]:>14.2f} {r["ms"]:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
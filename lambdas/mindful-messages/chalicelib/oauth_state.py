@@ -0,0 +1,73 @@
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+
+# Signed states are accepted for this long after /wbxauth hands them out
+state_max_age_seconds = 600
+# Nonces remembered per process for single use
+nonce_cache_size = 10000
+
+
+def _signature(secret, payload):
+    digest = hmac.new(
+        secret.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip('=')
+
+
+def sign_state(secret, now=None):
+    # e.g. 1639065882.q3Xz0pL9mK2aW8vE.Zx... timestamp, nonce, signature
+    timestamp = int(time.time() if now is None else now)
+    payload = f'{timestamp}.{secrets.token_urlsafe(12)}'
+    return f'{payload}.{_signature(secret, payload)}'
+
+
+def verify_state(secret, state, max_age=state_max_age_seconds, now=None):
+    # The state's nonce if we signed it and it is fresh, otherwise None
+    try:
+        timestamp, nonce, signature = state.split('.')
+        age = (time.time() if now is None else now) - int(timestamp)
+    except (AttributeError, ValueError):
+        return None
+    expected = _signature(secret, f'{timestamp}.{nonce}')
+    # As bytes, compare_digest refuses non-ASCII strings
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        return None
+    if not 0 <= age <= max_age:
+        return None
+    return nonce
+
+
+class NonceCache(object):
+    # Remembers used nonces until their state could no longer verify. Only
+    # covers this process, a conditional table write covers all of them.
+    def __init__(
+            self,
+            size=nonce_cache_size,
+            max_age=state_max_age_seconds,
+            clock=time.time):
+        self.size = size
+        self.max_age = max_age
+        self.clock = clock
+        self.used = OrderedDict()
+        self.lock = threading.Lock()
+
+    def use(self, nonce):
+        # True the first time a nonce is seen
+        now = self.clock()
+        with self.lock:
+            while self.used:
+                oldest, used_at = next(iter(self.used.items()))
+                if now - used_at <= self.max_age:
+                    break
+                self.used.popitem(last=False)
+            if nonce in self.used:
+                return False
+            self.used[nonce] = now
+            if len(self.used) > self.size:
+                self.used.popitem(last=False)
+            return True
@@ -0,0 +1,172 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import contextlib
+from collections import Counter
+from .oauth_state import verify_state
+
+
+# off, sample (collapsed stacks for flame graphs) or cprofile (a pstats
+# report). Even when on, only requests that ask for it are profiled.
+profiling_mode = os.environ.get('PROFILING', 'off')
+# API requests ask with an X-Profile header signed with this secret, the
+# sender with {"profile": true} in its event
+profile_secret = os.environ.get('PROFILE_SECRET')
+# 'log' prints PROFILE lines, anything else is a directory such as /tmp
+profile_output = os.environ.get('PROFILE_OUTPUT', 'log')
+profile_max_bytes = int(os.environ.get('PROFILE_MAX_BYTES', '65536'))
+# Seconds between stack samples
+profile_interval = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+# Functions listed in a cprofile report
+cprofile_limit = 40
+
+
+def frame_label(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f'{module}:{code.co_name}'
+
+
+def collapse(frame):
+    # Root first, e.g. app:profile_request;app:messages;__init__:get
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def cap_lines(lines, max_bytes):
+    # Keep lines until max_bytes, returns them and the number dropped
+    kept = []
+    size = 0
+    for line in lines:
+        size += len(line.encode()) + 1
+        if size > max_bytes:
+            return kept, len(lines) - len(kept)
+        kept.append(line)
+    return kept, 0
+
+
+class StackSampler(object):
+    # Samples one thread's stack from a background thread. Costs the
+    # profiled thread a GIL switch per sample rather than a hook per call.
+    def __init__(self, interval=profile_interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.target = None
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        # Heaviest stacks first, so the size cap drops the rarest
+        return [f'{stack} {n}' for stack, n in self.stacks.most_common()]
+
+
+class CProfiler(object):
+    # Deterministic, every call is timed, so expect the request to be slower
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        buf = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=buf)
+        stats.sort_stats('cumulative').print_stats(cprofile_limit)
+        return [line for line in buf.getvalue().splitlines() if line.strip()]
+
+
+class Profiler(object):
+    def __init__(self, mode=profiling_mode, secret=profile_secret,
+                 output=profile_output, max_bytes=profile_max_bytes,
+                 interval=profile_interval):
+        self.mode = mode
+        self.secret = secret
+        self.output = output
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+    @property
+    def enabled(self):
+        return self.mode in ('sample', 'cprofile')
+
+    def allowed(self, header):
+        # A signed header is good for the same 10 minutes as an OAuth state
+        if not self.enabled or not self.secret or not header:
+            return False
+        return verify_state(self.secret, header) is not None
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        if self.mode == 'sample':
+            profiler = StackSampler(self.interval)
+        else:
+            profiler = CProfiler()
+        label = name.strip('/').replace('/', '-') or 'root'
+        profile_id = f'{label}-{int(time.time() * 1000)}'
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            yield profile_id
+        finally:
+            lines = profiler.stop()
+            elapsed = time.perf_counter() - start
+            self.write(profile_id, lines, elapsed)
+
+    def profiled(self, name=None):
+        # Decorator for Lambda handlers, profiles events with "profile": true
+        def decorator(fn):
+            profile_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(event, context):
+                if (self.enabled and isinstance(event, dict)
+                        and event.get('profile')):
+                    with self.profile(profile_name):
+                        return fn(event, context)
+                return fn(event, context)
+            return wrapper
+        return decorator
+
+    def write(self, profile_id, lines, elapsed):
+        try:
+            lines, dropped = cap_lines(lines, self.max_bytes)
+            print(f'Profile {profile_id}: {self.mode}, '
+                  f'{elapsed * 1000:.1f} ms, {len(lines)} lines, '
+                  f'{dropped} dropped')
+            if self.output == 'log':
+                print('\n'.join(f'PROFILE {profile_id} {line}'
+                                for line in lines))
+            else:
+                suffix = 'collapsed' if self.mode == 'sample' else 'txt'
+                path = os.path.join(
+                    self.output, f'profile-{profile_id}.{suffix}')
+                with open(path, 'w') as f:
+                    f.write('\n'.join(lines) + '\n')
+        except Exception as e:
+            # Never fail the request over its profile
+            print(e)
+
+
+default_profiler = Profiler()
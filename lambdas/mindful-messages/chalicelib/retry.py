@@ -0,0 +1,163 @@
+import os
+import time
+import random
+import threading
+from collections import Counter
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from .tracing import span
+
+
+# DynamoDB error codes that mean the table is throttling us
+throttle_error_codes = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+)
+# Error codes that are safe to retry, throttles plus transient server errors
+retryable_error_codes = throttle_error_codes + (
+    'InternalServerError',
+    'ServiceUnavailable',
+)
+
+# Retry and rate limit defaults. Calls are not paced until DynamoDB first
+# throttles, after which the rate recovers up to the ceiling.
+max_attempts = 5
+base_delay_seconds = 0.05
+max_delay_seconds = 2.0
+max_requests_per_second = float(os.environ.get('DYNAMODB_MAX_RATE', '20'))
+min_requests_per_second = 1.0
+# The policy retries, so botocore makes one attempt per call
+botocore_config = Config(retries={'total_max_attempts': 1})
+
+# Counters for data layer calls, e.g. metrics['throttled']
+metrics = Counter()
+
+
+def error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_retryable(e):
+    return error_code(e) in retryable_error_codes
+
+
+def is_throttle(e):
+    return error_code(e) in throttle_error_codes
+
+
+class TokenBucket(object):
+    # Client side rate limiter. The refill rate is adaptive: it is halved
+    # when DynamoDB throttles and creeps back up after each success. An
+    # unpaced bucket lets calls through until the first throttle, and again
+    # once the rate is back at its ceiling.
+    def __init__(
+            self,
+            rate=max_requests_per_second,
+            min_rate=min_requests_per_second,
+            capacity=None,
+            clock=time.monotonic,
+            sleep=time.sleep,
+            paced=True):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+        self.always_paced = paced
+        self.paced = paced
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.paced:
+                    return
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            if not self.paced:
+                # Start from an empty bucket, the burst was too much
+                self.paced = True
+                self.tokens = 0
+                self.last = self.clock()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+            if self.rate >= self.max_rate and not self.always_paced:
+                self.paced = False
+
+
+class RetryPolicy(object):
+    def __init__(
+            self,
+            bucket=None,
+            attempts=max_attempts,
+            base_delay=base_delay_seconds,
+            max_delay=max_delay_seconds,
+            sleep=time.sleep,
+            counter=metrics):
+        self.bucket = bucket or TokenBucket(sleep=sleep, paced=False)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.metrics = counter
+
+    def backoff(self, attempt):
+        # Full jitter exponential backoff
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call(self, fn, *args, **kwargs):
+        # One span per DynamoDB operation, covering its retries
+        operation = getattr(fn, '__name__', 'call')
+        with span(f'dynamodb.{operation}', {
+                'db.system': 'dynamodb', 'db.operation': operation}):
+            return self._call(fn, *args, **kwargs)
+
+    def _call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self.metrics['calls'] += 1
+            try:
+                resp = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.metrics['fatal'] += 1
+                    raise
+                if is_throttle(e):
+                    self.metrics['throttled'] += 1
+                    self.bucket.throttled()
+                attempt += 1
+                if attempt >= self.attempts:
+                    self.metrics['exhausted'] += 1
+                    raise
+                self.metrics['retried'] += 1
+                self.sleep(self.backoff(attempt))
+            else:
+                self.bucket.succeeded()
+                return resp
+
+
+default_retry_policy = RetryPolicy()
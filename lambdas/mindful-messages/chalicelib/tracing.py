@@ -0,0 +1,82 @@
+import os
+import functools
+import contextlib
+
+
+# off, otlp (to OTEL_EXPORTER_OTLP_ENDPOINT, a local collector by default)
+# or console. OpenTelemetry is only imported when tracing is on.
+tracing_mode = os.environ.get('TRACING', 'off')
+# Share of traces kept, decided once at the root span
+trace_sample_ratio = float(os.environ.get('TRACE_SAMPLE_RATIO', '0.1'))
+
+# Returned for every span while tracing is off
+null_span = contextlib.nullcontext()
+
+
+class Tracer(object):
+    # Thin layer over an OpenTelemetry tracer. While tracing is off span()
+    # returns a shared no-op context, so instrumented code costs a call.
+    def __init__(self):
+        self.tracer = None
+        self.provider = None
+
+    def init(self, service_name, mode=tracing_mode,
+             ratio=trace_sample_ratio, exporter=None):
+        if mode == 'off' and exporter is None:
+            return self
+        try:
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import (
+                BatchSpanProcessor, SimpleSpanProcessor, ConsoleSpanExporter)
+            from opentelemetry.sdk.trace.sampling import (
+                ParentBased, TraceIdRatioBased)
+            if exporter is not None:
+                processor = SimpleSpanProcessor(exporter)
+            elif mode == 'console':
+                processor = SimpleSpanProcessor(ConsoleSpanExporter())
+            else:
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter \
+                    import OTLPSpanExporter
+                processor = BatchSpanProcessor(OTLPSpanExporter())
+        except ImportError as e:
+            # Tracing is optional, carry on without it
+            print(e)
+            return self
+        self.provider = TracerProvider(
+            resource=Resource.create({'service.name': service_name}),
+            sampler=ParentBased(TraceIdRatioBased(ratio)))
+        self.provider.add_span_processor(processor)
+        self.tracer = self.provider.get_tracer('mindful-messages')
+        return self
+
+    def span(self, name, attributes=None):
+        if self.tracer is None:
+            return null_span
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+    def traced(self, name=None, flush=False):
+        # Decorator, runs the function in a span named after it. Handlers
+        # flush so their spans are exported before Lambda freezes.
+        def decorator(fn):
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                try:
+                    with self.span(span_name):
+                        return fn(*args, **kwargs)
+                finally:
+                    if flush:
+                        self.flush()
+            return wrapper
+        return decorator
+
+    def flush(self):
+        if self.provider is not None:
+            self.provider.force_flush()
+
+
+default_tracer = Tracer()
+span = default_tracer.span
+traced = default_tracer.traced
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copies rows out of the source table into the tables TABLE_ROUTES gives
+# their record types. Nothing is written without --apply.
+#
+#   1. Create the new tables, with the same indexes as the records need
+#   2. python migrate.py --routes session=mindful-sessions --apply
+#   3. Deploy the app and the sender with the same TABLE_ROUTES
+#   4. python migrate.py --routes session=mindful-sessions --apply \
+#          --only-missing --delete
+#
+# The second pass copies rows written to the source between the first
+# pass and the deploy, without overwriting rows changed since in their new
+# table, and removes the moved rows from the source.
+#
+#   cd lambdas/mindful-messages
+#   python migrate.py --source mindful-messages \
+#       --routes session=mindful-sessions,state=mindful-sessions
+import os
+import sys
+import argparse
+from collections import Counter
+
+import boto3
+from botocore.exceptions import ClientError
+from admin import chunks, run_segments
+from chalicelib.retry import RetryPolicy, TokenBucket, error_code
+from chalicelib.retry import botocore_config
+from chalicelib.routing import TableRouter, kind_of_pk
+
+
+def copy_items(table, policy, items, only_missing, counts):
+    if not only_missing:
+        for chunk in chunks(items):
+            def batch_write_item():
+                with table.batch_writer() as batch:
+                    for item in chunk:
+                        batch.put_item(Item=item)
+            policy.call(batch_write_item)
+        counts['copied'] += len(items)
+        return
+    # One conditional put each, rows already in the target win
+    for item in items:
+        try:
+            policy.call(
+                table.put_item, Item=item,
+                ConditionExpression='attribute_not_exists(pk)')
+            counts['copied'] += 1
+        except ClientError as e:
+            if error_code(e) != 'ConditionalCheckFailedException':
+                raise
+            counts['already copied'] += 1
+
+
+def delete_items(table, policy, items, counts):
+    for chunk in chunks(items):
+        def batch_write_item():
+            with table.batch_writer() as batch:
+                for item in chunk:
+                    batch.delete_item(
+                        Key={'pk': item['pk'], 'sk': item['sk']})
+        policy.call(batch_write_item)
+    counts['deleted'] += len(items)
+
+
+def migrate_segment(options):
+    # Runs in a worker process, or in process with one worker
+    (source, routes, endpoint_url, segment, segments, rate, apply,
+     only_missing, delete) = options
+    dynamodb = boto3.resource(
+        'dynamodb', endpoint_url=endpoint_url, config=botocore_config)
+    router = TableRouter(source, routes)
+    policy = RetryPolicy(bucket=TokenBucket(rate=rate))
+    source_table = dynamodb.Table(source)
+    counts = Counter()
+    kwargs = {'Segment': segment, 'TotalSegments': segments}
+    while True:
+        resp = policy.call(source_table.scan, **kwargs)
+        moving = {}
+        for item in resp.get('Items', []):
+            counts['scanned'] += 1
+            kind = kind_of_pk(item['pk'])
+            target = router.table_name(kind)
+            if target != source:
+                moving.setdefault(target, []).append(item)
+                counts[f'{kind} to {target}'] += 1
+        if apply:
+            for target, items in moving.items():
+                copy_items(
+                    dynamodb.Table(target), policy, items, only_missing,
+                    counts)
+            if delete:
+                delete_items(source_table, policy, [
+                    item for items in moving.values() for item in items],
+                    counts)
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+    return segment, counts
+
+
+def migrate(source, routes, endpoint_url=None, segments=8, workers=4,
+            rate=50.0, apply=False, only_missing=False, delete=False):
+    options = [(source, routes, endpoint_url, segment, segments,
+                rate / max(1, workers), apply, only_missing, delete)
+               for segment in range(segments)]
+    totals = Counter()
+    done = 0
+    for segment, counts in run_segments(migrate_segment, options, workers):
+        totals.update(counts)
+        done += 1
+        print(f'Segment {segment + 1}/{segments}, {done} done, '
+              f'{totals["scanned"]} items')
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Move rows to their routed tables. Dry run unless '
+                    '--apply.')
+    parser.add_argument('--source', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--routes', default=os.environ.get('TABLE_ROUTES'),
+                        help='e.g. session=mindful-sessions')
+    parser.add_argument('--endpoint-url',
+                        help='e.g. DynamoDB Local at http://localhost:8000')
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='DynamoDB requests per second, all workers')
+    parser.add_argument('--only-missing', action='store_true',
+                        help='Keep rows already in their new table')
+    parser.add_argument('--delete', action='store_true',
+                        help='Remove moved rows from the source')
+    parser.add_argument('--apply', action='store_true')
+    args = parser.parse_args()
+    if not args.source or not args.routes:
+        sys.exit('Pass --source and --routes, or set TABLE_NAME and '
+                 'TABLE_ROUTES')
+    totals = migrate(
+        args.source, args.routes, args.endpoint_url, args.segments,
+        args.workers, args.rate, args.apply, args.only_missing, args.delete)
+    for name, n in sorted(totals.items()):
+        print(f'{name:<40} {n}')
+    if not args.apply:
+        print('Dry run, pass --apply to copy')
+
+
+if __name__ == '__main__':
+    main()
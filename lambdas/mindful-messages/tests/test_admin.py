@@ -0,0 +1,205 @@
+import sys
+import boto3
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from datetime import datetime, timedelta
+from moto import mock_dynamodb2
+from chalicelib import Item, UserItem, SessionItem, MessageItem
+from chalicelib import ScheduleItem
+from chalicelib import DeleteUserJob
+from chalicelib.retry import RetryPolicy, TokenBucket, default_retry_policy
+import admin
+
+
+@mock_dynamodb2
+class TestAdmin(TestCase):
+    def setUp(self):
+        self.wbx_person = Mock()
+        self.wbx_person.id = '123'
+        self.wbx_person.nickName = 'Test'
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[
+                {
+                    'AttributeName': 'pk',
+                    'KeyType': 'HASH'  # Partition key
+                },
+                {
+                    'AttributeName': 'sk',
+                    'KeyType': 'RANGE'  # Sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'pk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'sk',
+                    'AttributeType': 'S'
+                },
+
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        self.table.meta.client.get_waiter('table_exists').wait(
+            TableName='test-table')
+        self.user_item = UserItem(
+            table=self.table, wbx_person=self.wbx_person, wbx_token='123')
+        self.session_item = SessionItem(
+            table=self.table, user_id=self.user_item.id)
+        self.message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2030-12-25T12:00:00',
+            msg='Test',
+            person='test@domain.com')
+        self.user_item.add_messages([self.message_item.id, 'missing'])
+        self.policy = RetryPolicy(bucket=TokenBucket(sleep=lambda s: None))
+
+    def tearDown(self):
+        Item.retry_policy = default_retry_policy
+        self.table.delete()
+        self.dynamodb = None
+
+    def create_drift(self):
+        expired = SessionItem(table=self.table, user_id=self.user_item.id)
+        self.table.update_item(
+            Key={'pk': f'sessionid#{expired.id}',
+                 'sk': f'sessionid#{expired.id}'},
+            UpdateExpression='SET expires = :e',
+            ExpressionAttributeValues={
+                ':e': (datetime.utcnow() - timedelta(hours=1)).isoformat()})
+        self.table.put_item(Item={'pk': 'state#old', 'sk': 'state#old'})
+        self.table.put_item(Item={'pk': 'state#new', 'sk': 'state#new',
+                                  'ttl': 2 ** 40})
+        past = (datetime.utcnow() - timedelta(days=1)).strftime(
+            '%Y-%m-%dT%H:%M:%S')
+        missed = MessageItem(
+            table=self.table, user_id=self.user_item.id, time=past,
+            msg='Missed', person='test@domain.com')
+        self.user_item.add_message(missed.id)
+        orphan = MessageItem(
+            table=self.table, user_id='gone', time='2030-12-25T12:00:00',
+            msg='Orphan', person='test@domain.com')
+        # Messages of a user being deleted are left to the job
+        MessageItem(
+            table=self.table, user_id='deleting', time='2030-12-25T12:00:00',
+            msg='Deleting', person='test@domain.com')
+        DeleteUserJob(table=self.table, user_id='deleting').create()
+        self.table.update_item(
+            Key=self.message_item.key, UpdateExpression='REMOVE due')
+        return expired, missed, orphan
+
+    def test_scan_and_fix(self):
+        expired, missed, orphan = self.create_drift()
+        # moto returns the whole table for every segment, so one segment
+        scanned = admin.scan('test-table', segments=1, workers=1)
+        self.assertEqual(scanned['kinds']['message'], 4)
+        fixes = admin.plan(scanned)
+        self.assertEqual(admin.count_fixes(fixes), {
+            'expired_sessions': 1,
+            'stale_states': 1,
+            'orphan_message_ids': 1,
+            'orphan_messages': 1,
+            'missed_messages': 1,
+            'reindex': 1,
+            'relist': 0,
+            'enqueue': 0
+        })
+        outcomes = admin.apply(self.table, self.policy, fixes)
+        self.assertEqual(outcomes['missed_messages'], 1)
+        self.assertFalse(SessionItem(
+            table=self.table, session_id=expired.id).is_valid)
+        self.assertTrue(SessionItem(
+            table=self.table, session_id=self.session_item.id).is_valid)
+        self.assertNotIn('Item', self.table.get_item(
+            Key={'pk': 'state#old', 'sk': 'state#old'}))
+        self.assertFalse(MessageItem(
+            table=self.table, msg_id=orphan.id).is_valid)
+        self.assertIn('Item', self.table.get_item(Key={
+            'pk': f'deadletter#{missed.id}', 'sk': f'deadletter#{missed.id}'}))
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertNotIn('missing', user_item.messages)
+        message_item = MessageItem(
+            table=self.table, msg_id=self.message_item.id)
+        self.assertTrue(message_item.due.startswith('due#2030-12-25T12#'))
+        self.assertNotIn(missed.id, user_item.messages)
+        fixes = admin.plan(admin.scan('test-table', segments=1, workers=1))
+        self.assertEqual(sum(admin.count_fixes(fixes).values()), 0)
+
+    def test_apply_rechecks_orphans(self):
+        expired, missed, orphan = self.create_drift()
+        late = MessageItem.get_uuid()
+        self.user_item.add_message(late)
+        fixes = admin.plan(admin.scan('test-table', segments=1, workers=1))
+        self.assertIn(late, fixes['orphan_message_ids'][self.user_item.id])
+        # The orphan's user signs up and the missing message is written
+        # after the scan
+        wbx_person = Mock()
+        wbx_person.id = 'gone'
+        wbx_person.nickName = 'Gone'
+        UserItem(table=self.table, wbx_person=wbx_person, wbx_token='123')
+        MessageItem.batch_create(self.table, self.user_item.id, [{
+            'id': late, 'time': '2030-12-25T12:00:00', 'msg': 'Late',
+            'person': 'test@domain.com'}])
+        outcomes = admin.apply(self.table, self.policy, fixes)
+        self.assertEqual(outcomes['orphan_messages'], 0)
+        # Only the ID that is still missing is dropped
+        self.assertEqual(outcomes['orphan_message_ids'], 1)
+        self.assertTrue(MessageItem(
+            table=self.table, msg_id=orphan.id).is_valid)
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertIn(late, user_item.messages)
+        self.assertNotIn('missing', user_item.messages)
+
+    def test_relist(self):
+        schedule_item = ScheduleItem(
+            table=self.table, user_id=self.user_item.id,
+            start='2030-12-25T12:00:00', timezone='UTC', msg='Daily',
+            person='test@domain.com', freq='daily')
+        key = {'pk': f'schedule#{schedule_item.id}', 'sk': schedule_item.time}
+        # Written before the listed index
+        self.table.update_item(Key=key, UpdateExpression='REMOVE listed')
+        fixes = admin.plan(admin.scan('test-table', segments=1, workers=1))
+        self.assertEqual(fixes['relist'], [(key, 'schedule')])
+        outcomes = admin.apply(self.table, self.policy, fixes)
+        self.assertEqual(outcomes['relist'], 1)
+        item = self.table.get_item(Key=key)['Item']
+        self.assertEqual(item['listed'], 'schedule')
+
+    def test_enqueue(self):
+        # self.message_item was written while the queue was off
+        chalicelib = sys.modules[MessageItem.__module__]
+        with patch.object(chalicelib, 'due_queue', True):
+            queued = MessageItem(
+                table=self.table, user_id=self.user_item.id,
+                time='2030-12-25T13:00:00', msg='Queued',
+                person='test@domain.com')
+            self.user_item.add_message(queued.id)
+            fixes = admin.plan(
+                admin.scan('test-table', segments=1, workers=1), queue=True)
+            self.assertEqual(fixes['enqueue'], [self.message_item.id])
+            outcomes = admin.apply(self.table, self.policy, fixes)
+            self.assertEqual(outcomes['enqueue'], 1)
+            resp = self.table.get_item(Key={
+                'pk': 'due#2030-12-25T12:00',
+                'sk': f'2030-12-25T12:00:00#{self.message_item.id}'})
+            self.assertEqual(resp['Item']['user_id'], self.user_item.id)
+            fixes = admin.plan(
+                admin.scan('test-table', segments=1, workers=1), queue=True)
+            self.assertEqual(fixes['enqueue'], [])
+
+    def test_requeue_missed(self):
+        expired, missed, orphan = self.create_drift()
+        fixes = admin.plan(admin.scan('test-table', segments=1, workers=1))
+        admin.apply(self.table, self.policy, fixes, missed_action='requeue')
+        message_item = MessageItem(table=self.table, msg_id=missed.id)
+        self.assertTrue(message_item.is_valid)
+        self.assertTrue(message_item.expired)
+        self.assertGreater(message_item.sk, missed.time)
@@ -3,10 +3,16 @@ import boto3
 # from webexteamssdk import WebexTeamsAPI
 from unittest import TestCase, mock
 from urllib.parse import urlparse
+import json
 from json import dumps
 from moto import mock_dynamodb2
 from chalice.test import Client
-from chalicelib import SessionItem, UserItem, MessageItem
+from chalicelib import SessionItem, UserItem, MessageItem, DeleteUserJob
+from chalicelib import db_error
+from chalicelib.tracing import default_tracer
+from chalicelib.webex import WebexClientPool
+from tests.fake_webex import FakeWebex
+from tests.test_tracing import RecordingTracer
 
 
 @mock_dynamodb2
@@ -21,8 +27,7 @@ class TestApp(TestCase):
             'TABLE_NAME': self.table_name,
             'CORS_ALLOW_ORIGIN': 'https://test.domain.com',
             'APP_NAME': 'test_app',
-            'ALLOWED_DOMAINS': 'domain.com',
-            'EPSAGON_TOKEN': '123'
+            'ALLOWED_DOMAINS': 'domain.com'
         }
         self.env_patch = mock.patch.dict(os.environ, self.env_vars)
         self.env_patch.start()
@@ -53,7 +58,30 @@ class TestApp(TestCase):
                     'AttributeName': 'sk',
                     'AttributeType': 'S'
                 },
-
+                {
+                    'AttributeName': 'user_id',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': 'user-index',
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'user_id',
+                            'KeyType': 'HASH'
+                        },
+                        {
+                            'AttributeName': 'sk',
+                            'KeyType': 'RANGE'
+                        }
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                    'ProvisionedThroughput': {
+                        'ReadCapacityUnits': 1,
+                        'WriteCapacityUnits': 1
+                    }
+                }
             ],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 1,
@@ -116,6 +144,24 @@ class TestApp(TestCase):
                 self.wbx_person.nickName
             )
 
+    def test_user_get_profiled(self):
+        from chalicelib.oauth_state import sign_state
+        from chalicelib.profiling import Profiler
+        profiler = Profiler(mode='cprofile', secret='secret')
+        with mock.patch('app.default_profiler', profiler), \
+                mock.patch.object(profiler, 'write') as write, \
+                self.client as client:
+            url = f'/user?session={self.session_item.id}'
+            # Unsigned requests are not profiled
+            client.http.get(url, headers={'X-Profile': 'nope'})
+            write.assert_not_called()
+            response = client.http.get(
+                url, headers={'X-Profile': sign_state('secret')})
+            self.assertTrue(response.json_body['success'])
+            profile_id, lines, elapsed = write.call_args[0]
+            self.assertTrue(profile_id.startswith('user-'))
+            self.assertTrue(any('get_user' in line for line in lines))
+
     def test_user_delete(self):
         with self.client as client:
             response = client.http.delete(
@@ -123,6 +169,26 @@ class TestApp(TestCase):
                 headers={'Content-Type': 'application/json'}
             )
             self.assertTrue(response.json_body['success'])
+            message_item = MessageItem(
+                table=self.table, msg_id=self.message_item.id)
+            self.assertFalse(message_item.is_valid)
+            user_item = UserItem(table=self.table, user_id=self.user_item.id)
+            self.assertFalse(user_item.is_valid)
+
+    def test_user_delete_resumes(self):
+        MessageItem.batch_create(
+            self.table, self.user_item.id,
+            [{'time': '2030-12-25T12:00:00', 'msg': 'Test msg',
+              'person': 'test@domain.com'}] * 30)
+        self.user_item.tombstone()
+        job = DeleteUserJob(table=self.table, user_id=self.user_item.id)
+        # No time left, stops after the first page with a checkpoint
+        self.assertFalse(job.run('user-index', time_left=lambda: 0))
+        job = DeleteUserJob(table=self.table, user_id=self.user_item.id)
+        self.assertTrue(job.cursor)
+        self.assertTrue(job.run('user-index'))
+        resp = self.table.scan()
+        self.assertEqual(resp['Items'], [])
 
     def test_logout_get(self):
         with self.client as client:
@@ -143,6 +209,61 @@ class TestApp(TestCase):
             )
             self.assertTrue(response.json_body['success'])
 
+    def test_schedule_repeat_post(self):
+        body = self.message_item.to_dict()
+        body['timezone'] = 'US/Alaska'
+        body['repeat'] = {'freq': 'weekly', 'interval': 2}
+        with self.client as client:
+            response = client.http.post(
+                f'/schedule?session={self.session_item.id}',
+                headers={'Content-Type': 'application/json'},
+                body=dumps(body)
+            )
+            schedule_id = response.json_body['results']['id']
+            response = client.http.get(
+                f'/schedules?session={self.session_item.id}',
+                headers={'Content-Type': 'application/json'}
+            )
+            self.assertEqual(response.json_body['results'][0]['id'],
+                             schedule_id)
+            response = client.http.delete(
+                (f'/schedule?session={self.session_item.id}'
+                 f'&schedule={schedule_id}'),
+                headers={'Content-Type': 'application/json'}
+            )
+            self.assertTrue(response.json_body['success'])
+            user_item = UserItem(table=self.table, user_id=self.user_item.id)
+            self.assertNotIn(schedule_id, user_item.schedules)
+
+    def test_schedule_batch_post(self):
+        good = self.message_item.to_dict()
+        good['timezone'] = 'US/Alaska'
+        bad = dict(good, timezone='Not/AZone')
+        with self.client as client:
+            response = client.http.post(
+                f'/schedule/batch?session={self.session_item.id}',
+                headers={'Content-Type': 'application/json'},
+                body=dumps({'messages': [good, bad, {'msg': 'Test'}]})
+            )
+            results = response.json_body['results']
+            self.assertFalse(response.json_body['success'])
+            self.assertTrue(results[0]['success'])
+            self.assertFalse(results[1]['success'])
+            self.assertFalse(results[2]['success'])
+            user_item = UserItem(table=self.table, user_id=self.user_item.id)
+            self.assertIn(results[0]['id'], user_item.messages)
+
+    def test_schedule_batch_post_limit(self):
+        body = self.message_item.to_dict()
+        body['timezone'] = 'US/Alaska'
+        with self.client as client:
+            response = client.http.post(
+                f'/schedule/batch?session={self.session_item.id}',
+                headers={'Content-Type': 'application/json'},
+                body=dumps({'messages': [body] * 26})
+            )
+            self.assertFalse(response.json_body['success'])
+
     def test_messages_get(self):
         with self.client as client:
             response = client.http.get(
@@ -153,25 +274,294 @@ class TestApp(TestCase):
             self.assertIn(
                 self.message_item.to_dict(), response.json_body['results'])
 
-    def test_message_delete(self):
+    def test_messages_get_timezone(self):
+        # Either side of the start of summer time in Oslo
+        MessageItem.batch_create(
+            self.table, self.user_item.id,
+            [{'time': t, 'msg': 'Test', 'person': 'test@domain.com'}
+             for t in ('2031-03-30T00:30:00', '2031-03-30T01:30:00')])
         with self.client as client:
-            response = client.http.delete(
-                (f'/message?session={self.session_item.id}'
-                 f'&message={self.message_item.id}'),
+            response = client.http.get(
+                f'/messages?session={self.session_item.id}'
+                '&timezone=Europe/Oslo&fields=time')
+            self.assertEqual(response.json_body['timezone'], 'Europe/Oslo')
+            times = [r['time'] for r in response.json_body['results']]
+            self.assertEqual(times[-2:], ['2031-03-30T01:30:00',
+                                          '2031-03-30T03:30:00'])
+            response = client.http.get(
+                f'/messages/export?session={self.session_item.id}'
+                '&timezone=Europe/Oslo')
+            line = json.loads(response.body.decode().splitlines()[-1])
+            self.assertEqual(line['time'], '2031-03-30T03:30:00')
+            self.assertEqual(line['timezone'], 'Europe/Oslo')
+            response = client.http.get(
+                f'/messages?session={self.session_item.id}&timezone=Mars')
+            self.assertFalse(response.json_body['success'])
+
+    def test_messages_export(self):
+        MessageItem.batch_create(
+            self.table, self.user_item.id,
+            [{'time': f'2031-01-01T12:00:{n:02d}', 'msg': f'Msg {n}',
+              'person': 'test@domain.com'} for n in range(150)])
+        lines = []
+        cursor = None
+        parts = 0
+        with mock.patch('app.export_max_bytes', 1), self.client as client:
+            while True:
+                url = f'/messages/export?session={self.session_item.id}'
+                if cursor:
+                    url += f'&cursor={cursor}'
+                response = client.http.get(url)
+                self.assertEqual(
+                    response.headers['Content-Type'], 'application/x-ndjson')
+                lines += response.body.decode().splitlines()
+                parts += 1
+                cursor = response.headers.get('X-Cursor')
+                if not cursor:
+                    break
+        self.assertGreater(parts, 1)
+        exported = [json.loads(line) for line in lines]
+        self.assertEqual(len(exported), 151)
+        self.assertEqual(exported[0], dict(
+            self.message_item.to_dict(), timezone='UTC'))
+
+    def test_messages_import(self):
+        good = dict(self.message_item.to_dict(), timezone='US/Alaska')
+        del good['id']
+        body = '\n'.join([
+            dumps(good),
+            '{not json',
+            '',
+            dumps(dict(good, timezone='Not/AZone')),
+            dumps({'msg': 'Test', 'time': '2030-12-25T12:00:00',
+                   'person': 'test@domain.com'})
+        ]) + '\n'
+        url = f'/messages/import?session={self.session_item.id}'
+        headers = {'Content-Type': 'application/x-ndjson'}
+        with self.client as client:
+            response = client.http.post(url, headers=headers, body=body)
+            results = response.json_body['results']
+            self.assertFalse(response.json_body['success'])
+            self.assertEqual(results['imported'], 1)
+            self.assertEqual(
+                [e['line'] for e in results['errors']], [2, 4, 5])
+            self.assertIsNone(results['next_line'])
+            # Importing again overwrites rather than duplicates
+            client.http.post(url, headers=headers, body=body)
+            # A default timezone fills in the last line
+            response = client.http.post(
+                url + '&start=5&timezone=UTC', headers=headers, body=body)
+            self.assertTrue(response.json_body['success'])
+            self.assertEqual(response.json_body['results']['imported'], 1)
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(len(user_item.messages), 3)
+        imported = MessageItem(table=self.table, msg_id=user_item.messages[1])
+        self.assertEqual(imported.time, '2030-12-25T21:00:00')
+
+    def test_messages_import_resumes(self):
+        body = ''.join(
+            dumps({'msg': f'Msg {n}', 'time': '2030-12-25T12:00:00',
+                   'person': 'test@domain.com', 'timezone': 'UTC'}) + '\n'
+            for n in range(30))
+        url = f'/messages/import?session={self.session_item.id}'
+        headers = {'Content-Type': 'application/x-ndjson'}
+        # Out of time after the first chunk
+        time_left = iter([10000, 0])
+        with mock.patch('app.remaining_time_fn',
+                        return_value=lambda: next(time_left)), \
+                self.client as client:
+            response = client.http.post(url, headers=headers, body=body)
+            results = response.json_body['results']
+            self.assertFalse(response.json_body['success'])
+            self.assertEqual(results['imported'], 25)
+            self.assertEqual(results['next_line'], 26)
+        with self.client as client:
+            response = client.http.post(
+                url + '&start=26', headers=headers, body=body)
+            self.assertEqual(response.json_body['results']['imported'], 5)
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(len(user_item.messages), 31)
+
+    def test_messages_get_pages(self):
+        later_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2031-12-25T12:00:00',
+            msg='Later msg',
+            person='test@domain.com'
+        )
+        with self.client as client:
+            response = client.http.get(
+                f'/messages?session={self.session_item.id}'
+                '&limit=1&order=desc&fields=id,time',
+                headers={'Content-Type': 'application/json'}
+            )
+            self.assertEqual(response.json_body['results'],
+                             [{'id': later_item.id, 'time': later_item.time}])
+            cursor = response.json_body['cursor']
+            self.assertTrue(cursor)
+            response = client.http.get(
+                f'/messages?session={self.session_item.id}'
+                f'&limit=1&order=desc&fields=id,time&cursor={cursor}',
                 headers={'Content-Type': 'application/json'}
             )
+            self.assertEqual(response.json_body['results'][0]['id'],
+                             self.message_item.id)
+
+    def test_messages_get_not_modified(self):
+        url = f'/messages?session={self.session_item.id}'
+        with self.client as client:
+            response = client.http.get(url)
+            etag = response.headers['ETag']
+            response = client.http.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.user_item.remove_message(self.message_item.id)
+            response = client.http.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_messages_get_error_not_cached(self):
+        url = f'/messages?session={self.session_item.id}'
+        with self.client as client:
+            with mock.patch.object(
+                    MessageItem, 'query_by_user',
+                    return_value=(db_error, None)):
+                response = client.http.get(url)
+            self.assertFalse(response.json_body['success'])
+            self.assertNotIn('ETag', response.headers)
+            self.assertEqual(response.headers['Cache-Control'], 'no-store')
+            response = client.http.get(url)
             self.assertTrue(response.json_body['success'])
+            self.assertIn('ETag', response.headers)
 
+    def test_user_get_not_modified(self):
+        url = f'/user?session={self.session_item.id}'
+        with self.client as client:
+            etag = client.http.get(url).headers['ETag']
+            response = client.http.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+
+    def test_messages_get_bad_cursor(self):
+        with self.client as client:
+            response = client.http.get(
+                f'/messages?session={self.session_item.id}&cursor=abc',
+                headers={'Content-Type': 'application/json'}
+            )
+            self.assertFalse(response.json_body['success'])
 
-''' TODO: Tests that require webexteamssdk mocked
     def test_people_get(self):
+        webex = FakeWebex().start()
+        pool = WebexClientPool(base_url=webex.base_url)
+        try:
+            with mock.patch('app.default_pool', pool):
+                with self.client as client:
+                    response = client.http.get(
+                        f'/people?session={self.session_item.id}&q=Test',
+                        headers={'Content-Type': 'application/json'}
+                    )
+                    self.assertTrue(response.json_body['success'])
+                    self.assertEqual(
+                        response.json_body['results'][0]['email'],
+                        'test@domain.com')
+                    webex.rate_limit_next(1, retry_after=30)
+                    response = client.http.get(
+                        f'/people?session={self.session_item.id}&q=Test',
+                        headers={'Content-Type': 'application/json'}
+                    )
+                    self.assertFalse(response.json_body['success'])
+        finally:
+            webex.stop()
+
+    def test_auth_keeps_refresh_token(self):
+        webex = FakeWebex().start()
+        try:
+            with mock.patch('app.webex_base_url', webex.base_url):
+                with self.client as client:
+                    response = client.http.get(
+                        '/wbxauth',
+                        headers={'Content-Type': 'application/json'}
+                    )
+                    location = response.json_body['results']['location']
+                    state = location.split('state=')[1]
+                    response = client.http.get(
+                        f'/auth?code={self.code}&state={state}')
+                    self.assertEqual(response.status_code, 301)
+        finally:
+            webex.stop()
+        user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.assertEqual(user_item.wbx_token, f'token-{self.code}')
+        self.assertEqual(user_item.wbx_refresh_token, 'refresh-token')
+        self.assertFalse(user_item.wbx_refresh_token_expired)
+
+    def test_auth_traces_people_me(self):
+        webex = FakeWebex().start()
+        recording = RecordingTracer()
+        default_tracer.tracer = recording
+        try:
+            with mock.patch('app.webex_base_url', webex.base_url):
+                with self.client as client:
+                    response = client.http.get(
+                        '/wbxauth',
+                        headers={'Content-Type': 'application/json'}
+                    )
+                    location = response.json_body['results']['location']
+                    state = location.split('state=')[1]
+                    client.http.get(f'/auth?code={self.code}&state={state}')
+        finally:
+            default_tracer.tracer = None
+            webex.stop()
+        self.assertIn(('webex.people.me', None), recording.spans)
+
+    def test_auth_signed_state(self):
+        webex = FakeWebex().start()
+        try:
+            for single_use in ('memory', 'table'):
+                with self.subTest(single_use=single_use), \
+                        mock.patch('app.webex_base_url', webex.base_url), \
+                        mock.patch('app.state_secret', 'secret'), \
+                        mock.patch('app.state_single_use', single_use):
+                    self.login_with_signed_state()
+        finally:
+            webex.stop()
+
+    def test_auth_signed_state_non_ascii(self):
+        with self.client as client, \
+                mock.patch('app.state_secret', 'secret'):
+            response = client.http.get(
+                f'/auth?code={self.code}&state=1.abc.%C3%A9')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.json_body['success'])
+
+    def login_with_signed_state(self):
         with self.client as client:
             response = client.http.get(
-                f'/people?session={self.session_item.id}&q={self.person_name}',
-                headers={'Content-Type':'application/json'}
+                '/wbxauth',
+                headers={'Content-Type': 'application/json'}
+            )
+            location = response.json_body['results']['location']
+            state = location.split('state=')[1]
+            # Nothing is stored for the state
+            self.assertNotIn('Item', self.table.get_item(
+                Key={'pk': f'state#{state}', 'sk': f'state#{state}'}))
+            response = client.http.get(
+                f'/auth?code={self.code}&state={state}')
+            self.assertEqual(response.status_code, 301)
+            # A replayed state is refused
+            response = client.http.get(
+                f'/auth?code={self.code}&state={state}')
+            self.assertFalse(response.json_body['success'])
+
+    def test_message_delete(self):
+        with self.client as client:
+            response = client.http.delete(
+                (f'/message?session={self.session_item.id}'
+                 f'&message={self.message_item.id}'),
+                headers={'Content-Type': 'application/json'}
             )
             self.assertTrue(response.json_body['success'])
 
+
+''' TODO: Tests that require webexteamssdk mocked
     def test_auth_webex_fail(self):
         with self.client as client:
             auth_url_response = client.http.get(
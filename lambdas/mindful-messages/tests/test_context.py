@@ -0,0 +1,129 @@
+import boto3
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from datetime import datetime, timedelta
+from moto import mock_dynamodb2
+from chalicelib import UserItem, SessionItem, MessageItem
+from chalicelib.context import RequestContext
+
+
+@mock_dynamodb2
+class TestRequestContext(TestCase):
+    def setUp(self):
+        self.wbx_person = Mock()
+        self.wbx_person.id = '123'
+        self.wbx_person.nickName = 'Test'
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[
+                {
+                    'AttributeName': 'pk',
+                    'KeyType': 'HASH'  # Partition key
+                },
+                {
+                    'AttributeName': 'sk',
+                    'KeyType': 'RANGE'  # Sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'pk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'sk',
+                    'AttributeType': 'S'
+                },
+
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        self.table.meta.client.get_waiter('table_exists').wait(
+            TableName='test-table')
+        self.user_item = UserItem(
+            table=self.table, wbx_person=self.wbx_person, wbx_token='123')
+        self.session_item = SessionItem(
+            table=self.table, user_id=self.user_item.id)
+        self.tables = 0
+
+    def tearDown(self):
+        self.table.delete()
+        self.dynamodb = None
+
+    def table_factory(self):
+        self.tables += 1
+        return boto3.resource('dynamodb').Table('test-table')
+
+    def test_loads_once(self):
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        self.assertFalse(ctx.session_expired())
+        self.assertEqual(ctx.user.id, self.user_item.id)
+        self.assertIs(ctx.user, ctx.user)
+        self.assertEqual(ctx.loads, {'session': 1, 'user': 1})
+        self.assertEqual(self.tables, 1)
+
+    def test_load_many(self):
+        message_item = MessageItem(
+            table=self.table,
+            user_id=self.user_item.id,
+            time='2030-12-25T12:00:00',
+            msg='Test',
+            person='test@domain.com')
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        ctx.session_expired()
+        loaded = ctx.load_many(
+            user=ctx.load_user,
+            message=lambda table: MessageItem(
+                table=table, msg_id=message_item.id))
+        self.assertEqual(loaded['user'].id, self.user_item.id)
+        self.assertTrue(loaded['message'].is_valid)
+        self.assertIs(ctx.user, loaded['user'])
+        self.assertEqual(sum(ctx.loads.values()), 3)
+        # All on the request's table
+        self.assertEqual(self.tables, 1)
+
+    def test_session_expired(self):
+        self.session_item.expires = (
+            datetime.utcnow() - timedelta(hours=1)).isoformat()
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        ctx.loaded['session'] = self.session_item
+        self.assertTrue(ctx.session_expired())
+        session_item = SessionItem(
+            table=self.table, session_id=self.session_item.id)
+        self.assertFalse(session_item.is_valid)
+        # The user is never loaded for an expired session
+        self.assertNotIn('user', ctx.loads)
+
+    @patch.object(UserItem, 'session_snapshot', True)
+    def test_session_snapshot(self):
+        self.user_item.add_session(self.session_item.id)
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        self.assertFalse(ctx.session_expired())
+        user_item = ctx.user
+        self.assertTrue(user_item.is_snapshot)
+        self.assertTrue(user_item.is_valid)
+        self.assertEqual(user_item.displayname, self.wbx_person.nickName)
+        self.assertEqual(user_item.etag, self.user_item.etag)
+        # Writes to the user keep the snapshot in step
+        self.user_item.add_message('1')
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        self.assertEqual(ctx.user.etag, self.user_item.etag)
+        self.assertEqual(ctx.user.message_count, 1)
+        self.assertEqual(ctx.full_user.messages, ['1'])
+        self.user_item.tombstone()
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        self.assertFalse(ctx.user.is_valid)
+
+    @patch.object(UserItem, 'session_snapshot', True)
+    def test_session_snapshot_not_replaced_by_older(self):
+        self.user_item.add_session(self.session_item.id)
+        stale_user_item = UserItem(table=self.table, user_id=self.user_item.id)
+        self.user_item.add_message('1')
+        stale_user_item.sync_session()
+        ctx = RequestContext(self.table_factory, self.session_item.id)
+        self.assertEqual(ctx.user.etag, self.user_item.etag)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from chalicelib.oauth_state import sign_state, verify_state, NonceCache
+
+
+class TestOAuthState(TestCase):
+    def test_verify(self):
+        state = sign_state('secret', now=1000)
+        nonce = verify_state('secret', state, now=1010)
+        self.assertTrue(nonce)
+        self.assertIn(nonce, state)
+
+    def test_verify_wrong_secret(self):
+        state = sign_state('secret', now=1000)
+        self.assertIsNone(verify_state('other', state, now=1010))
+
+    def test_verify_tampered(self):
+        timestamp, nonce, signature = sign_state('secret', now=1000).split('.')
+        state = f'{int(timestamp) + 600}.{nonce}.{signature}'
+        self.assertIsNone(verify_state('secret', state, now=1010))
+        self.assertIsNone(verify_state('secret', 'None', now=1010))
+        self.assertIsNone(verify_state('secret', None, now=1010))
+        self.assertIsNone(verify_state('secret', '1000.abc.\u00e9', now=1010))
+
+    def test_verify_expired(self):
+        state = sign_state('secret', now=1000)
+        self.assertIsNone(verify_state('secret', state, max_age=60, now=1061))
+        # Nor from the future
+        self.assertIsNone(verify_state('secret', state, now=999))
+
+    def test_nonce_cache(self):
+        now = [0]
+        cache = NonceCache(size=2, max_age=60, clock=lambda: now[0])
+        self.assertTrue(cache.use('a'))
+        self.assertFalse(cache.use('a'))
+        # Forgotten once its state could no longer verify
+        now[0] = 61
+        self.assertTrue(cache.use('b'))
+        self.assertNotIn('a', cache.used)
+        self.assertTrue(cache.use('c'))
+        self.assertTrue(cache.use('d'))
+        self.assertEqual(list(cache.used), ['c', 'd'])
@@ -0,0 +1,85 @@
+import os
+import time
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from chalicelib.oauth_state import sign_state
+from chalicelib.profiling import Profiler, StackSampler, cap_lines
+from benchmarks.profiles import read_stacks, build_tree, render
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiler(TestCase):
+    def test_sampler(self):
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        busy(0.05)
+        lines = sampler.stop()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(stack.endswith('test_profiling:busy'))
+        self.assertGreater(int(count), 0)
+
+    def test_cap_lines(self):
+        lines = ['a 1', 'b 2', 'c 3']
+        self.assertEqual(cap_lines(lines, 8), (['a 1', 'b 2'], 1))
+        self.assertEqual(cap_lines(lines, 100), (lines, 0))
+
+    def test_allowed(self):
+        self.assertFalse(Profiler(mode='off', secret='secret').allowed(
+            sign_state('secret')))
+        profiler = Profiler(mode='sample', secret='secret')
+        self.assertTrue(profiler.allowed(sign_state('secret')))
+        self.assertFalse(profiler.allowed(sign_state('other')))
+        self.assertFalse(profiler.allowed(None))
+        self.assertFalse(profiler.allowed('1.abc.\u00e9'))
+        self.assertFalse(Profiler(mode='sample').allowed(
+            sign_state('secret')))
+
+    def test_profiled(self):
+        calls = []
+
+        def handler(event, context):
+            calls.append(event)
+            busy(0.02)
+            return 'done'
+        profiler = Profiler(mode='sample', interval=0.001)
+        with patch.object(profiler, 'write') as write:
+            handler = profiler.profiled()(handler)
+            self.assertEqual(handler({}, None), 'done')
+            write.assert_not_called()
+            self.assertEqual(handler({'profile': True}, None), 'done')
+            self.assertEqual(write.call_count, 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_write_to_directory(self):
+        with tempfile.TemporaryDirectory() as output:
+            profiler = Profiler(
+                mode='sample', output=output, max_bytes=20, interval=0.001)
+            with profiler.profile('/messages') as profile_id:
+                busy(0.02)
+            path = os.path.join(output, f'profile-{profile_id}.collapsed')
+            with open(path) as f:
+                self.assertLessEqual(len(f.read()), 20)
+            self.assertTrue(profile_id.startswith('messages-'))
+
+    def test_flamegraph(self):
+        lines = [
+            'START RequestId: 1',
+            'PROFILE messages-1 app:messages;__init__:get 3',
+            'PROFILE messages-1 app:messages 1',
+            'PROFILE user-2 app:user_get 2'
+        ]
+        profiles = read_stacks(lines)
+        self.assertEqual(sorted(profiles), ['messages-1', 'user-2'])
+        stacks = read_stacks(lines, 'messages-1')['messages-1']
+        tree = build_tree(stacks)
+        self.assertEqual(tree['count'], 4)
+        self.assertEqual(tree['children']['app:messages']['count'], 4)
+        svg = render(tree, 'messages-1')
+        self.assertIn('__init__:get (3 samples, 75.0%)', svg)
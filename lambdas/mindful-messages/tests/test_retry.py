@@ -0,0 +1,175 @@
+import boto3
+from unittest import TestCase
+from unittest.mock import Mock
+from collections import Counter
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb2
+from chalicelib import UserItem, db_error
+from chalicelib.retry import RetryPolicy, TokenBucket
+from chalicelib.routing import TableRouter
+
+
+def client_error(code, operation='PutItem'):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FaultyTable(object):
+    # Local table stub that raises the queued errors before each real call
+    def __init__(self, table, faults=None):
+        self.table = table
+        self.faults = list(faults or [])
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.table, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            if self.faults:
+                raise self.faults.pop(0)
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+@mock_dynamodb2
+class TestRetryPolicy(TestCase):
+    def setUp(self):
+        self.wbx_person = Mock()
+        self.wbx_person.id = '123'
+        self.wbx_person.nickName = 'Test'
+        self.wbx_token = '123'
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        self.table = self.dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[
+                {
+                    'AttributeName': 'pk',
+                    'KeyType': 'HASH'  # Partition key
+                },
+                {
+                    'AttributeName': 'sk',
+                    'KeyType': 'RANGE'  # Sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'pk',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'sk',
+                    'AttributeType': 'S'
+                },
+
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        self.table.meta.client.get_waiter('table_exists').wait(
+            TableName='test-table')
+        assert self.table.table_status == 'ACTIVE'
+        self.sleeps = []
+        self.metrics = Counter()
+        self.policy = RetryPolicy(
+            bucket=TokenBucket(rate=1000, sleep=self.sleeps.append),
+            attempts=3,
+            sleep=self.sleeps.append,
+            counter=self.metrics)
+
+    def tearDown(self):
+        self.table.delete()
+        self.dynamodb = None
+
+    def get_user_item(self, faults):
+        self.faulty_table = FaultyTable(self.table, faults)
+        user_item = UserItem(table=self.faulty_table)
+        user_item.retry_policy = self.policy
+        user_item.wbx_person = self.wbx_person
+        user_item.wbx_token = self.wbx_token
+        return user_item
+
+    def test_throttle_retried(self):
+        user_item = self.get_user_item([
+            client_error('ProvisionedThroughputExceededException')])
+        user_item.create()
+        self.assertTrue(user_item.is_valid)
+        self.assertEqual(self.metrics['throttled'], 1)
+        self.assertEqual(self.metrics['retried'], 1)
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_throttle_slows_bucket(self):
+        user_item = self.get_user_item([client_error('ThrottlingException')])
+        user_item.create()
+        self.assertLess(self.policy.bucket.rate, self.policy.bucket.max_rate)
+
+    def test_throttle_exhausted(self):
+        user_item = self.get_user_item(
+            [client_error('ProvisionedThroughputExceededException')] * 3)
+        resp = user_item._create_item({'pk': '1', 'sk': '1'})
+        self.assertEqual(resp, db_error)
+        self.assertEqual(self.faulty_table.calls, 3)
+        self.assertEqual(self.metrics['exhausted'], 1)
+
+    def test_fatal_not_retried(self):
+        user_item = self.get_user_item(
+            [client_error('ValidationException')])
+        resp = user_item._create_item({'pk': '1', 'sk': '1'})
+        self.assertEqual(resp, db_error)
+        self.assertEqual(self.faulty_table.calls, 1)
+        self.assertEqual(self.metrics['fatal'], 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_backoff_capped(self):
+        for attempt in range(1, 20):
+            self.assertLessEqual(
+                self.policy.backoff(attempt), self.policy.max_delay)
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.bucket = TokenBucket(
+            rate=4, clock=lambda: self.now, sleep=self.sleep, paced=False)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_unpaced_until_throttled(self):
+        for _ in range(100):
+            self.bucket.acquire()
+        self.assertEqual(self.sleeps, [])
+        self.bucket.throttled()
+        self.assertEqual(self.bucket.rate, 2)
+        self.bucket.acquire()
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_unpaced_once_recovered(self):
+        self.bucket.throttled()
+        self.bucket.succeeded()
+        self.assertTrue(self.bucket.paced)
+        self.bucket.succeeded()
+        self.assertFalse(self.bucket.paced)
+        for _ in range(10):
+            self.bucket.acquire()
+        self.assertEqual(self.sleeps, [])
+
+    def test_paced_bucket(self):
+        bucket = TokenBucket(
+            rate=4, clock=lambda: self.now, sleep=self.sleep)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertEqual(self.sleeps, [0.25])
+        bucket.succeeded()
+        self.assertTrue(bucket.paced)
+
+    def test_botocore_does_not_retry(self):
+        table = TableRouter('test-table').table()
+        self.assertEqual(
+            table.meta.client.meta.config.retries['total_max_attempts'], 1)
@@ -0,0 +1,178 @@
+import boto3
+from unittest import TestCase
+from unittest.mock import Mock
+from moto import mock_dynamodb2
+from boto3.dynamodb.conditions import Key
+from chalicelib import UserItem, SessionItem, MessageItem, DeleteUserJob
+from chalicelib.routing import TableRouter, RoutedTable, parse_routes
+from migrate import migrate
+
+
+def create_table(dynamodb, name, indexes):
+    definitions = [{'AttributeName': 'pk', 'AttributeType': 'S'},
+                   {'AttributeName': 'sk', 'AttributeType': 'S'}]
+    definitions += [{'AttributeName': a, 'AttributeType': 'S'}
+                    for a in indexes.values()]
+    table = dynamodb.create_table(
+        TableName=name,
+        KeySchema=[
+            {'AttributeName': 'pk', 'KeyType': 'HASH'},
+            {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=definitions,
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': index_name,
+                'KeySchema': [
+                    {'AttributeName': hash_key, 'KeyType': 'HASH'},
+                    {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            } for index_name, hash_key in indexes.items()
+        ],
+        BillingMode='PAY_PER_REQUEST')
+    table.meta.client.get_waiter('table_exists').wait(TableName=name)
+    return table
+
+
+@mock_dynamodb2
+class TestRouting(TestCase):
+    def setUp(self):
+        self.wbx_person = Mock()
+        self.wbx_person.id = '123'
+        self.wbx_person.nickName = 'Test'
+        boto3.setup_default_session()
+        self.dynamodb = boto3.resource('dynamodb')
+        indexes = {'listed-index': 'listed', 'user-index': 'user_id'}
+        self.main = create_table(self.dynamodb, 'test-table', indexes)
+        self.sessions = create_table(
+            self.dynamodb, 'test-sessions', indexes)
+        self.router = TableRouter(
+            'test-table', 'session=test-sessions,state=test-sessions')
+        self.table = self.router.table()
+
+    def tearDown(self):
+        self.main.delete()
+        self.sessions.delete()
+        self.dynamodb = None
+
+    def test_parse_routes(self):
+        self.assertEqual(parse_routes(' session = s, state=s '),
+                         {'session': 's', 'state': 's'})
+        self.assertEqual(parse_routes(None), {})
+        with self.assertRaises(ValueError):
+            parse_routes('sessions=s')
+
+    def test_single_table(self):
+        self.assertNotIsInstance(
+            TableRouter('test-table').table(), RoutedTable)
+        self.assertIsInstance(self.table, RoutedTable)
+        self.assertEqual(self.router.table_names,
+                         ['test-table', 'test-sessions'])
+
+    def test_models(self):
+        user_item = UserItem(
+            table=self.table, wbx_person=self.wbx_person, wbx_token='123')
+        session_item = SessionItem(table=self.table, user_id=user_item.id)
+        user_item.add_session(session_item.id)
+        message_item = MessageItem(
+            table=self.table,
+            user_id=user_item.id,
+            time='2030-12-25T12:00:00',
+            msg='Test',
+            person='test@domain.com')
+        user_item.add_message(message_item.id)
+        session_key = {'pk': f'sessionid#{session_item.id}',
+                       'sk': f'sessionid#{session_item.id}'}
+        self.assertIn('Item', self.sessions.get_item(Key=session_key))
+        self.assertNotIn('Item', self.main.get_item(Key=session_key))
+        self.assertTrue(SessionItem(
+            table=self.table, session_id=session_item.id).is_valid)
+        results, cursor = MessageItem.query_by_user(
+            self.table, 'user-index', user_item.id)
+        self.assertEqual([r['id'] for r in results], [message_item.id])
+        # Deleting the user follows the user's items into both tables
+        job = DeleteUserJob(table=self.table, user_id=user_item.id)
+        self.assertTrue(job.run('user-index'))
+        self.assertEqual(self.main.scan()['Count'], 0)
+        self.assertEqual(self.sessions.scan()['Count'], 0)
+
+    def test_delete_user_with_queue_table(self):
+        # The queue table has no indexes, a user's deletion must not query it
+        queue = self.dynamodb.create_table(
+            TableName='test-queue',
+            KeySchema=[
+                {'AttributeName': 'pk', 'KeyType': 'HASH'},
+                {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'pk', 'AttributeType': 'S'},
+                {'AttributeName': 'sk', 'AttributeType': 'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST')
+        table = TableRouter(
+            'test-table', 'session=test-sessions,queue=test-queue').table()
+        user_item = UserItem(
+            table=table, wbx_person=self.wbx_person, wbx_token='123')
+        session_item = SessionItem(table=table, user_id=user_item.id)
+        user_item.add_session(session_item.id)
+        queue.put_item(Item={'pk': 'due#2030-01-01T09:00',
+                             'sk': '2030-01-01T09:00:00#1',
+                             'user_id': user_item.id})
+        job = DeleteUserJob(table=table, user_id=user_item.id)
+        self.assertTrue(job.run('user-index'))
+        self.assertEqual(self.main.scan()['Count'], 0)
+        self.assertEqual(self.sessions.scan()['Count'], 0)
+        queue.delete()
+
+    def test_query_pages_across_tables(self):
+        with self.table.batch_writer() as batch:
+            for n in range(3):
+                batch.put_item(Item={
+                    'pk': f'sessionid#{n}', 'sk': f'sessionid#{n}',
+                    'user_id': '123', 'record_type': 'session'})
+                batch.put_item(Item={
+                    'pk': f'message#{n}', 'sk': f'2030-01-0{n + 1}',
+                    'user_id': '123', 'record_type': 'message'})
+        self.assertEqual(self.sessions.scan()['Count'], 3)
+        kwargs = {
+            'IndexName': 'user-index',
+            'KeyConditionExpression': Key('user_id').eq('123'),
+            'Limit': 2
+        }
+        pks = []
+        pages = 0
+        while True:
+            resp = self.table.query(**kwargs)
+            pks += [item['pk'] for item in resp['Items']]
+            pages += 1
+            if 'LastEvaluatedKey' not in resp:
+                break
+            kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+        self.assertEqual(len(pks), 6)
+        self.assertEqual(len(set(pks)), 6)
+        self.assertGreater(pages, 2)
+
+    def test_migrate(self):
+        single = TableRouter('test-table').table()
+        user_item = UserItem(
+            table=single, wbx_person=self.wbx_person, wbx_token='123')
+        session_item = SessionItem(table=single, user_id=user_item.id)
+        other = SessionItem(table=single, user_id=user_item.id)
+        self.sessions.put_item(Item={
+            'pk': f'sessionid#{other.id}', 'sk': f'sessionid#{other.id}',
+            'user_id': user_item.id, 'expires': 'newer'})
+        routes = 'session=test-sessions'
+        totals = migrate('test-table', routes, segments=1, workers=1)
+        self.assertEqual(totals['session to test-sessions'], 2)
+        self.assertEqual(self.sessions.scan()['Count'], 1)
+        totals = migrate('test-table', routes, segments=1, workers=1,
+                         apply=True, only_missing=True, delete=True)
+        self.assertEqual(totals['copied'], 1)
+        self.assertEqual(totals['already copied'], 1)
+        self.assertEqual(totals['deleted'], 2)
+        self.assertEqual(self.main.scan()['Count'], 1)
+        self.assertTrue(SessionItem(
+            table=self.table, session_id=session_item.id).is_valid)
+        self.assertEqual(SessionItem(
+            table=self.table, session_id=other.id).expires, 'newer')
@@ -0,0 +1,52 @@
+import contextlib
+from unittest import TestCase
+from unittest.mock import Mock
+from chalicelib import UserItem
+from chalicelib.retry import RetryPolicy, TokenBucket
+from chalicelib.tracing import Tracer, default_tracer, null_span
+
+
+class RecordingTracer(object):
+    # Stands in for an OpenTelemetry tracer, records span names
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        self.spans.append((name, attributes))
+        yield
+
+
+class TestTracer(TestCase):
+    def setUp(self):
+        self.recording = RecordingTracer()
+
+    def tearDown(self):
+        default_tracer.tracer = None
+
+    def test_off(self):
+        tracer = Tracer().init('test', mode='off')
+        self.assertIs(tracer.span('test'), null_span)
+
+    def test_traced(self):
+        tracer = Tracer()
+        tracer.tracer = self.recording
+
+        @tracer.traced()
+        def handler(event):
+            return event
+        self.assertEqual(handler(1), 1)
+        self.assertEqual(self.recording.spans, [('handler', None)])
+
+    def test_dynamodb_span(self):
+        default_tracer.tracer = self.recording
+        table = Mock()
+        table.get_item.__name__ = 'get_item'
+        table.get_item.return_value = {}
+        user_item = UserItem(table=table)
+        user_item.retry_policy = RetryPolicy(
+            bucket=TokenBucket(sleep=lambda s: None))
+        user_item._get_item({'pk': '1', 'sk': '1'})
+        self.assertEqual(self.recording.spans, [(
+            'dynamodb.get_item',
+            {'db.system': 'dynamodb', 'db.operation': 'get_item'})])
@@ -0,0 +1,73 @@
+from unittest import TestCase
+from chalicelib.webex import WebexClientPool, WebexRateLimited
+from tests.fake_webex import FakeWebex
+
+
+class TestWebexClientPool(TestCase):
+    def setUp(self):
+        self.webex = FakeWebex().start()
+        self.now = 0.0
+        self.pool = WebexClientPool(
+            base_url=self.webex.base_url,
+            size=2,
+            clock=lambda: self.now,
+            sleep=self.advance)
+
+    def tearDown(self):
+        self.webex.stop()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def send(self, token):
+        return self.pool.call(
+            token,
+            lambda api: api.messages.create(
+                toPersonEmail='test@domain.com', text='Test'))
+
+    def test_client_reused(self):
+        client = self.pool.get_client('a')
+        self.send('a')
+        self.assertIs(self.pool.get_client('a'), client)
+        self.assertEqual(len(self.webex.messages), 1)
+
+    def test_client_evicted(self):
+        client = self.pool.get_client('a')
+        self.pool.get_client('b')
+        self.pool.get_client('c')
+        self.assertIsNot(self.pool.get_client('a'), client)
+
+    def test_token_rate_limited(self):
+        for i in range(10):
+            self.send('a')
+        # 5 per second per token, the first 5 are the initial burst
+        self.assertGreaterEqual(self.now, 1.0)
+
+    def test_retry_after(self):
+        self.webex.rate_limit_next(1, retry_after=30)
+        with self.assertRaises(WebexRateLimited) as cm:
+            self.send('a')
+        self.assertEqual(cm.exception.retry_after, 30)
+        requests = self.webex.requests
+        # Blocked locally until Retry-After has passed
+        with self.assertRaises(WebexRateLimited):
+            self.send('a')
+        self.assertEqual(self.webex.requests, requests)
+        # Other tokens are unaffected
+        self.send('b')
+        self.now += 30
+        self.send('a')
+        self.assertEqual(len(self.webex.messages), 2)
+
+    def test_rate_recovers(self):
+        bucket = self.pool._get('a')[1]
+        for _ in range(3):
+            self.webex.rate_limit_next(1, retry_after=1)
+            with self.assertRaises(WebexRateLimited):
+                self.send('a')
+            self.now += 1
+        self.assertEqual(bucket.rate, 1.0)
+        for _ in range(4):
+            self.send('a')
+        # Back up to 5 per second
+        self.assertEqual(bucket.rate, self.pool.token_rate)